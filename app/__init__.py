@@ -50,6 +50,14 @@ class App(BaseApp):
         from app.controllers.api.v1.open import open_ctrl
         self.flask.register_blueprint(open_ctrl, url_prefix="/api/v1/open")
 
+        self.logger.debug("metrics_ctrl at /metrics")
+        from app.controllers.metrics import metrics_ctrl
+        self.flask.register_blueprint(metrics_ctrl, url_prefix="/metrics")
+
+        # inventory changes made by a request are written once it's over
+        from app.models.inventory_generation import flush_inventory_changes
+        self.flask.teardown_request(flush_inventory_changes)
+
         if self.envtype == 'development':
             from app.models import ApiAction
             self.logger.info("checking action handlers")
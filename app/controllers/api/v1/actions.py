@@ -11,6 +11,8 @@ def index(id=None):
     from app.models import ApiAction
 
     if id is None:
+        from library.db import db
+        db.allow_secondary_reads()
         query = {}
         if "_users" in request.values:
             users = request.values["_users"]
@@ -20,10 +22,10 @@ def index(id=None):
             action_types = request.values["_action_types"]
             action_types = action_types.split(",")
             query["action_type"] = {"$in": action_types}
-        actions = ApiAction.find(query).sort([('created_at', -1)])
+        actions = ApiAction.find(query, read_only=True).sort([('created_at', -1)])
     else:
         action_id = resolve_id(id)
-        actions = ApiAction.find({"_id": action_id})
+        actions = ApiAction.find({"_id": action_id}, read_only=True)
     return json_response(paginated_data(actions))
 
 
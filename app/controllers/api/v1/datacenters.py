@@ -14,18 +14,20 @@ datacenters_ctrl = AuthController("datacenters", __name__, require_auth=True)
 def show(datacenter_id=None):
     from app.models import Datacenter
     if datacenter_id is None:
+        from library.db import db
+        db.allow_secondary_reads()
         query = {}
         if "_filter" in request.values:
             name_filter = request.values["_filter"]
             if len(name_filter) > 0:
                 query["name"] = filter_query(name_filter)
-        datacenters = Datacenter.find(query)
+        datacenters = Datacenter.find(query, read_only=True)
     else:
         datacenter_id = resolve_id(datacenter_id)
         datacenters = Datacenter.find({ "$or": [
             { "_id": datacenter_id },
             { "name": datacenter_id }
-        ]})
+        ]}, read_only=True)
         if datacenters.count() == 0:
             raise DatacenterNotFound("datacenter not found")
     data = paginated_data(datacenters.sort("name"))
@@ -4,8 +4,9 @@ from app.controllers.auth_controller import AuthController
 from library.engine.errors import GroupNotFound, Forbidden, ApiError, WorkGroupNotFound, \
     NotFound, IntegrityError, InputDataError
 from library.engine.utils import resolve_id, json_response, paginated_data, diff,\
-    get_request_fields, json_body_required, filter_query, get_boolean_request_param
+    get_request_fields, json_body_required, filter_query, get_boolean_request_param, inventory_conditional
 from library.engine.action_log import logged_action
+from library.engine.cache import invalidate_inherited
 
 groups_ctrl = AuthController("groups", __name__, require_auth=True)
 
@@ -15,6 +16,8 @@ groups_ctrl = AuthController("groups", __name__, require_auth=True)
 def show(group_id=None):
     from app.models import Group
     if group_id is None:
+        from library.db import db
+        db.allow_secondary_reads()
         query = {}
         if "_filter" in request.values:
             name_filter = request.values["_filter"]
@@ -34,13 +37,13 @@ def show(group_id=None):
         elif "all_tags" in request.values:
             tags = request.values["all_tags"].split(",")
             query = Group.query_by_tags_recursive(tags, query)
-        groups = Group.find(query)
+        groups = Group.find(query, read_only=True)
     else:
         group_id = resolve_id(group_id)
         groups = Group.find({"$or": [
             { "_id": group_id },
             { "name": group_id }
-        ]})
+        ]}, read_only=True)
         if groups.count() == 0:
             raise GroupNotFound("group not found")
 
@@ -59,7 +62,14 @@ def get_custom_data(group_id, key):
     })
 
 
+def structure_inventory_keys():
+    # a structure may span several work groups
+    from app.models.inventory_generation import ALL_KEY
+    return [ALL_KEY]
+
+
 @groups_ctrl.route("/<group_id>/structure", methods=["GET"])
+@inventory_conditional(structure_inventory_keys)
 def structure(group_id):
     from app.models import Group
     from library.engine.graph import group_structure
@@ -129,25 +139,16 @@ def set_hosts(group_id):
     upd = request.json["host_ids"]
     upd = [ObjectId(x) for x in upd if x is not None]
     d = diff(orig, upd)
-    exs = []
-    for item in d.remove:
-        try:
-            h = Host.find_one({ "_id": item })
-            if h is not None:
-                h.group_id = None
-                h.save()
-        except Exception as e:
-            exs.append(e)
-    for item in d.add:
-        try:
-            h = Host.find_one({ "_id": item })
-            if h is not None:
-                h.group_id = group._id
-                h.save()
-        except Exception as e:
-            exs.append(e)
-    if len(exs) > 0:
-        raise ApiError(["%s: %s" % (x.__class__.__name__, x.message) for x in exs])
+    hosts = []
+    for h in Host.find({"_id": {"$in": d.remove}}):
+        h.group_id = None
+        hosts.append(h)
+    for h in Host.find({"_id": {"$in": d.add}}):
+        h.group_id = group._id
+        hosts.append(h)
+    failed = Host.save_many(hosts)
+    if len(failed) > 0:
+        raise ApiError(["%s: %s" % (e.__class__.__name__, ", ".join(e.errors)) for _, e in failed])
     return json_response({ "data": group.to_dict(get_request_fields()), "status": "ok" })
 
 
@@ -215,7 +216,7 @@ def mass_move():
     if "work_group_id" not in request.json:
         raise ApiError("no work_group_id provided")
 
-    from app.models import Group, WorkGroup
+    from app.models import Group, WorkGroup, InventoryGeneration
     # resolving WorkGroup
     work_group = WorkGroup.get(request.json["work_group_id"], WorkGroupNotFound("work_group not found"))
     # resolving Groups and their children
@@ -249,10 +250,21 @@ def mass_move():
         group.remove_all_parents()
 
     # moving all groups and their children to the new work_group
+    # groups are saved without callbacks so the inventory changes and moves are registered here
+    work_group_ids = set([x.work_group_id for x in all_groups] + [work_group._id])
+    InventoryGeneration.touch(work_group_ids=list(work_group_ids))
+    for work_group_id in work_group_ids:
+        invalidate_inherited("WorkGroup", work_group_id)
+    Group.record_moves([(x._id, x.work_group_id) for x in all_groups])
     for group in all_groups:
         group.work_group_id = work_group._id
+        group.touch()
         group.save(skip_callback=True)
 
+    # the instances above were loaded before detaching thus their
+    # ancestor/descendant index may have been saved outdated
+    Group.rebuild_related_closure(all_groups)
+
     result = {
         "status": "ok",
         "data": {
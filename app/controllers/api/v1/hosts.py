@@ -18,6 +18,8 @@ hosts_ctrl = AuthController('hosts', __name__, require_auth=True)
 def show(host_id=None):
     from app.models import Host
     if host_id is None:
+        from library.db import db
+        db.allow_secondary_reads()
         query = {}
         if "_filter" in request.values:
             name_filter = request.values["_filter"]
@@ -46,14 +48,8 @@ def show(host_id=None):
 
         elif "all_tags" in request.values:
             tags = request.values["all_tags"].split(",")
-            from app.models import Group
-            groups = Group.find_by_tags_recursive(tags)
-            group_ids = [x._id for x in groups]
-            query["$or"] = [
-                {"tags": {"$in": tags}},
-                {"group_id": {"$in": group_ids}}
-            ]
-        hosts = Host.find(query)
+            query["effective_tags"] = {"$in": tags}
+        hosts = Host.find(query, read_only=True)
         return json_response(paginated_data(hosts.sort("fqdn")))
     else:
         host = Host.get(host_id)
@@ -123,7 +119,7 @@ def create():
         host = Host(**attrs)
         host.save()
 
-    hosts = Host.find({"fqdn": {"$in": list(hostnames) }})
+    hosts = Host.find({"fqdn": {"$in": list(hostnames) }}, read_only=True)
     data = paginated_data(hosts.sort("fqdn"))
     return json_response(data, 201)
 
@@ -291,7 +287,9 @@ def mass_move():
     # moving hosts
     for host in hosts:
         host.group_id = group._id
-        host.save()
+    failed = Host.save_many(hosts)
+    if len(failed) > 0:
+        raise ApiError(["%s: %s" % (h.fqdn, ", ".join(e.errors)) for h, e in failed])
 
     result = {
         "status": "ok",
@@ -337,7 +335,9 @@ def mass_set_datacenter():
     # setting hosts' datacenter
     for host in hosts:
         host.datacenter_id = datacenter._id
-        host.save()
+    failed = Host.save_many(hosts)
+    if len(failed) > 0:
+        raise ApiError(["%s: %s" % (h.fqdn, ", ".join(e.errors)) for h, e in failed])
 
     result = {
         "status": "ok",
@@ -378,7 +378,9 @@ def mass_detach():
     # moving hosts
     for host in hosts:
         host.group_id = None
-        host.save()
+    failed = Host.save_many(hosts)
+    if len(failed) > 0:
+        raise ApiError(["%s: %s" % (h.fqdn, ", ".join(e.errors)) for h, e in failed])
 
     result = {
         "status": "ok",
@@ -399,7 +401,7 @@ def mass_delete():
     if type(request.json["host_ids"]) != list:
         raise ApiError("host_ids must be an array type")
 
-    from app.models import Host
+    from app.models import Host, InventoryGeneration
 
     # resolving hosts
     host_ids = [resolve_id(x) for x in request.json["host_ids"]]
@@ -416,8 +418,11 @@ def mass_delete():
         failed_hosts = ', '.join([h.fqdn for h in failed_hosts])
         raise Forbidden("you don't have permission to modify hosts: %s" % failed_hosts)
 
+    # hosts are removed with a single query, so the inventory changes are registered here
+    Host.destroy_many({"_id": {"$in": [x._id for x in hosts]}})
+    InventoryGeneration.touch(group_ids=[x.group_id for x in hosts])
     for host in hosts:
-        host.destroy()
+        host._id = None
 
     result = {
         "status": "ok",
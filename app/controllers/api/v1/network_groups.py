@@ -14,6 +14,8 @@ network_groups_ctrl = AuthController('network_groups', __name__, require_auth=Tr
 def show(network_group_id=None):
     from app.models import NetworkGroup
     if network_group_id is None:
+        from library.db import db
+        db.allow_secondary_reads()
         query = {}
         if "_filter" in request.values:
             name_filter = request.values["_filter"]
@@ -29,13 +31,13 @@ def show(network_group_id=None):
                 query["work_group_id"] = None
             else:
                 query["work_group_id"] = wg._id
-        network_groups = NetworkGroup.find(query)
+        network_groups = NetworkGroup.find(query, read_only=True)
     else:
         network_group_id = resolve_id(network_group_id)
         network_groups = NetworkGroup.find({"$or": [
             { "_id": network_group_id },
             { "name": network_group_id }
-        ]})
+        ]}, read_only=True)
         if network_groups.count() == 0:
             raise NetworkGroupNotFound("server group not found")
     data = paginated_data(network_groups.sort("name"))
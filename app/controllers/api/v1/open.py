@@ -1,10 +1,68 @@
-from flask import request, make_response
-from datetime import datetime
+import calendar
+from datetime import datetime, timedelta
+from flask import request, Response, stream_with_context
 from app.controllers.auth_controller import AuthController
-from library.engine.utils import json_response, cursor_to_list, get_app_version, get_boolean_request_param
+from library.engine.utils import json_response, cursor_to_list, get_app_version, get_boolean_request_param, \
+    iter_dicts, ndjson_response, StreamedList, buffered, inventory_conditional
 from library.engine.errors import ApiError, WorkGroupNotFound
 
-open_ctrl = AuthController("open", __name__, require_auth=False)
+open_ctrl = AuthController("open", __name__, require_auth=False, secondary_reads=True)
+
+# computed properties which have their values stored in the database
+EFFECTIVE_FIELDS = {
+    "all_tags": "effective_tags",
+    "all_custom_fields": "effective_custom_fields",
+}
+
+# changes are looked up this many seconds before the sync token to catch
+# writes which have been in flight or haven't reached a secondary yet
+SYNC_TOKEN_OVERLAP = 120
+# the token is passed in a header as the body of a full response may be cached
+SYNC_TOKEN_HEADER = "X-Sync-Token"
+
+
+def inventory_keys():
+    # inventory generations the response depends on, see InventoryGeneration
+    from app.models.inventory_generation import ALL_KEY, SHARED_KEY, work_group_key
+    work_group_names = [x for x in request.values.get("work_groups", "").split(",") if x != ""]
+    if len(work_group_names) == 0 or get_boolean_request_param("include_unattached"):
+        return [ALL_KEY]
+    return [SHARED_KEY] + [work_group_key(x) for x in sorted(set(work_group_names))]
+
+
+def sync_token(dt):
+    return str(calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000)
+
+
+def sync_token_headers():
+    # the token is taken before the data is read so no changes are missed
+    from app.models.storable_model import now
+    return {SYNC_TOKEN_HEADER: sync_token(now())}
+
+
+def parse_sync_token(token):
+    try:
+        return datetime.utcfromtimestamp(int(token) / 1000.0)
+    except (TypeError, ValueError, OverflowError):
+        raise ApiError("invalid since token")
+
+
+def iter_effective_dicts(cursor, fields):
+    # all_tags and all_custom_fields are served from the stored effective
+    # fields instead of being computed object by object
+    stored_fields = []
+    for field in fields:
+        field = EFFECTIVE_FIELDS.get(field, field)
+        if field not in stored_fields:
+            stored_fields.append(field)
+    for item in iter_dicts(cursor, fields=stored_fields):
+        for field, stored_field in EFFECTIVE_FIELDS.iteritems():
+            if field in fields:
+                if stored_field in fields:
+                    item[field] = item[stored_field]
+                else:
+                    item[field] = item.pop(stored_field)
+        yield item
 
 
 def get_executer_data(query, recursive=False, include_unattached=False):
@@ -17,21 +75,23 @@ def get_executer_data(query, recursive=False, include_unattached=False):
         host_fields += ["all_tags", "all_custom_fields"]
         group_fields += ["all_tags", "all_custom_fields"]
 
-    work_groups = WorkGroup.find(query)
+    work_groups = WorkGroup.find(query, read_only=True)
     work_groups = cursor_to_list(work_groups)
     work_group_ids = [x["_id"] for x in work_groups]
 
-    groups = Group.find({ "work_group_id": { "$in": work_group_ids }})
-    groups = cursor_to_list(groups, fields=group_fields)
-    group_ids = [x["_id"] for x in groups]
+    # groups and hosts are streamed to the client by json_response
+    group_query = { "work_group_id": { "$in": work_group_ids }}
+    groups = Group.find(group_query, read_only=True)
+    groups = StreamedList(iter_effective_dicts(groups, group_fields))
 
     if include_unattached:
-        hosts = Host.find({})
+        hosts = Host.find({}, read_only=True)
     else:
-        hosts = Host.find({ "group_id": { "$in": group_ids }})
-    hosts = cursor_to_list(hosts, fields=host_fields)
+        group_ids = [x._id for x in Group.find(group_query, fields=["_id"])]
+        hosts = Host.find({ "group_id": { "$in": group_ids }}, read_only=True)
+    hosts = StreamedList(iter_effective_dicts(hosts, host_fields))
 
-    datacenters = Datacenter.find({})
+    datacenters = Datacenter.find({}, read_only=True)
     datacenters = cursor_to_list(datacenters)
     return {
         "datacenters": datacenters,
@@ -41,8 +101,72 @@ def get_executer_data(query, recursive=False, include_unattached=False):
     }
 
 
+def get_executer_data_changes(query, since, recursive=False, include_unattached=False):
+    """
+    get_executer_data_changes returns executer data objects changed since the given time.
+    Ids of objects deleted or moved out of the requested work groups (see Tombstone)
+    are listed in "deleted".
+    Hosts of the changed groups are returned too as their inherited fields and responsibles
+    are updated without touching the hosts themselves
+    """
+    from app.models import WorkGroup, Datacenter, Group, Host, Tombstone
+
+    host_fields = list(Host.FIELDS)
+    group_fields = list(Group.FIELDS)
+
+    if recursive:
+        host_fields += ["all_tags", "all_custom_fields"]
+        group_fields += ["all_tags", "all_custom_fields"]
+
+    changed = {"updated_at": {"$gte": since}}
+
+    work_group_ids = [x._id for x in WorkGroup.find(query, fields=["_id"])]
+    work_groups = WorkGroup.find({"$and": [query, changed]}, read_only=True)
+    work_groups = cursor_to_list(work_groups)
+
+    group_query = {"work_group_id": {"$in": work_group_ids}}
+    group_ids = [x._id for x in Group.find(group_query, fields=["_id"])]
+    groups = Group.find({"$and": [group_query, changed]}, read_only=True)
+    groups = list(iter_effective_dicts(groups, group_fields))
+    changed_group_ids = [x["_id"] for x in groups]
+    # groups moved between the requested work groups are returned as changed
+    moved_groups = set(Tombstone.moved_ids(Group, work_group_ids, since)).difference(group_ids)
+
+    host_changed = {"$or": [changed, {"group_id": {"$in": changed_group_ids}}]}
+    if include_unattached:
+        hosts = Host.find(host_changed, read_only=True)
+        moved_hosts = []
+    else:
+        hosts = Host.find({"$and": [{"group_id": {"$in": group_ids}}, host_changed]}, read_only=True)
+        moved_hosts = Tombstone.moved_ids(Host, work_group_ids, since)
+        if len(moved_hosts) > 0:
+            kept = Host.find({"_id": {"$in": moved_hosts}, "group_id": {"$in": group_ids}}, fields=["_id"])
+            moved_hosts = set(moved_hosts).difference([x._id for x in kept])
+    hosts = StreamedList(iter_effective_dicts(hosts, host_fields))
+
+    datacenters = Datacenter.find(changed, read_only=True)
+    datacenters = cursor_to_list(datacenters)
+
+    return {
+        "datacenters": datacenters,
+        "work_groups": work_groups,
+        "groups": groups,
+        "hosts": hosts,
+        "deleted": {
+            "datacenters": Tombstone.deleted_ids(Datacenter, since),
+            "work_groups": Tombstone.deleted_ids(WorkGroup, since),
+            "groups": Tombstone.deleted_ids(Group, since) + list(moved_groups),
+            "hosts": Tombstone.deleted_ids(Host, since) + list(moved_hosts),
+        }
+    }
+
+
 @open_ctrl.route("/executer_data")
+@inventory_conditional(inventory_keys, cached=lambda: "since" not in request.values, get_headers=sync_token_headers)
 def executer_data():
+    from app.models.storable_model import now
+    from app.models.tombstone import TOMBSTONE_TTL
+
     query = {}
     if "work_groups" in request.values:
         work_group_names = [x for x in request.values["work_groups"].split(",") if x != ""]
@@ -52,14 +176,23 @@ def executer_data():
     recursive = get_boolean_request_param("recursive")
     include_unattached = get_boolean_request_param("include_unattached")
 
+    # the token returned in SYNC_TOKEN_HEADER is passed back as since to get the changes made
+    # after this request, clients with a token older than tombstones are kept for get the full data
+    if "since" in request.values:
+        since = parse_sync_token(request.values["since"]) - timedelta(seconds=SYNC_TOKEN_OVERLAP)
+        if since > now() - timedelta(seconds=TOMBSTONE_TTL):
+            results = get_executer_data_changes(query, since, recursive, include_unattached)
+            return json_response({"data": results, "full": False})
+
     results = get_executer_data(query, recursive, include_unattached)
-    return json_response({"data": results})
+    return json_response({"data": results, "full": True})
 
 
 @open_ctrl.route("/ansible")
+@inventory_conditional(inventory_keys, cached=True)
 def ansible():
     from app.models import WorkGroup
-    from library.engine.utils import full_group_structure, ansible_group_structure
+    from library.engine.utils import iter_ansible_inventory, ansible_group_structure
 
     if "work_groups" not in request.values:
         raise ApiError("work_groups query param is mandatory")
@@ -71,37 +204,11 @@ def ansible():
         raise WorkGroupNotFound("can't find any workgroup on your request")
 
     include_vars = get_boolean_request_param("vars")
-    if include_vars:
-        host_fields = ["fqdn", "group_id", "ansible_vars"]
-    else:
-        host_fields = ["fqdn", "group_id"]
 
     fmt = request.values.get("format", "plain")
     if fmt == "plain":
-        structure = full_group_structure(work_group_ids, host_fields=host_fields)
-        render = "# This ansible inventory file was rendered from inventoree database, %s\n# For more info on inventoree please refer to https://github.com/viert/inventoree\n\n" % datetime.now().isoformat()
-        for group_id, group in structure.items():
-            if len(group["all_hosts"]) > 0:
-                render += "[%s]\n" % group["name"]
-                if include_vars:
-                    hosts = group["all_hosts"].values()
-                    hosts.sort(key=lambda x: x["fqdn"])
-                    for host in hosts:
-                        render += host["fqdn"]
-                        if host["ansible_vars"] is not None:
-                            for key, value in host["ansible_vars"].iteritems():
-                                render += " %s=%s" % (key, value)
-                        render += "\n"
-                else:
-                    host_names = [x["fqdn"] for x in group["all_hosts"].values()]
-                    host_names.sort()
-                    for fqdn in host_names:
-                        render += fqdn + "\n"
-                    render += "\n\n"
-
-        response = make_response(render)
-        response.headers["Content-Type"] = "text/plain"
-        return response
+        inventory = iter_ansible_inventory(work_group_ids, include_vars)
+        return Response(stream_with_context(buffered(inventory)), 200, {"Content-Type": "text/plain"})
     elif fmt == "json":
         return json_response(ansible_group_structure(work_group_ids, include_vars))
     else:
@@ -127,37 +234,29 @@ def info():
     import flask
     results["flask_version"] = flask.__version__
 
-    from library.engine.cache import check_cache
+    from library.engine.cache import check_cache, inherited_cache_stats, request_cache_stats
     results["cache"] = {
         "type": app.cache.__class__.__name__,
-        "active": check_cache()
+        "active": check_cache(),
+        "inherited": inherited_cache_stats(),
+        "request": request_cache_stats(),
     }
 
     return json_response({ "app_info": results })
 
 
 def _get_hosts(group_names=None, tags=None):
-    from app.models import Group
-    if group_names is None:
-        tag_query = [{ "tags": x } for x in tags]
-        groups = Group.find({ "$or": tag_query })
-    else:
-        groups = Group.find({"name": {"$in": group_names}})
-
-    all_hosts = set()
-    for group in groups:
-        all_hosts = all_hosts.union(group.all_hosts.all())
-
+    from app.models import Group, Host
+    query = {}
+    if group_names is not None:
+        group_ids = set()
+        for group in Group.find({"name": {"$in": group_names}}, read_only=True):
+            group_ids.add(group._id)
+            group_ids.update(group.descendant_ids)
+        query["group_id"] = {"$in": list(group_ids)}
     if tags is not None:
-        hosts = []
-        for host in all_hosts:
-            for tag in tags:
-                if tag in host.all_tags:
-                    hosts.append(host)
-    else:
-        hosts = list(all_hosts)
-
-    return hosts
+        query["effective_tags"] = {"$in": tags}
+    return Host.find(query, read_only=True)
 
 
 @open_ctrl.route("/resolve_hosts")
@@ -182,4 +281,7 @@ def resolve():
         fields = list(Host.FIELDS) + ["all_tags"]
 
     hosts = _get_hosts(group_names, tags)
-    return json_response({ "data": cursor_to_list(hosts,fields) })
+    data = iter_effective_dicts(hosts, fields)
+    if request.values.get("format") == "ndjson":
+        return ndjson_response(data)
+    return json_response({ "data": StreamedList(data) })
@@ -13,12 +13,14 @@ users_ctrl = AuthController("users", __name__, require_auth=True)
 def show(user_id=None):
     from app.models import User
     if user_id is None:
+        from library.db import db
+        db.allow_secondary_reads()
         query = {}
         if "_filter" in request.values:
             name_filter = request.values["_filter"]
             if len(name_filter) > 0:
                 query["username"] = filter_query(name_filter)
-        users = User.find(query)
+        users = User.find(query, read_only=True)
     else:
         user_id = resolve_id(user_id)
         users = User.find({
@@ -26,7 +28,7 @@ def show(user_id=None):
                 { "_id": user_id },
                 { "username": user_id }
             ]
-        })
+        }, read_only=True)
         if users.count() == 0:
             raise UserNotFound("user not found")
 
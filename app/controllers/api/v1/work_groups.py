@@ -12,6 +12,8 @@ work_groups_ctrl = AuthController("work_groups", __name__, require_auth=True)
 def show(work_group_id=None):
     from app.models import WorkGroup
     if work_group_id is None:
+        from library.db import db
+        db.allow_secondary_reads()
         query = {}
         if "_filter" in request.values:
             name_filter = request.values["_filter"]
@@ -23,13 +25,13 @@ def show(work_group_id=None):
                 {"member_ids": user_id},
                 {"owner_id": user_id}
             ]
-        work_groups = WorkGroup.find(query)
+        work_groups = WorkGroup.find(query, read_only=True)
     else:
         work_group_id = resolve_id(work_group_id)
         work_groups = WorkGroup.find({"$or": [
             { "_id": work_group_id },
             { "name": work_group_id }
-        ] })
+        ] }, read_only=True)
         if work_groups.count() == 0:
             raise WorkGroupNotFound("work_group not found")
     return json_response(paginated_data(work_groups.sort("name")))
@@ -7,7 +7,11 @@ class AuthController(Blueprint):
         self.require_auth = kwargs.get("require_auth") or False
         if "require_auth" in kwargs:
             del(kwargs["require_auth"])
+        self.secondary_reads = kwargs.get("secondary_reads") or False
+        if "secondary_reads" in kwargs:
+            del(kwargs["secondary_reads"])
         Blueprint.__init__(self, *args, **kwargs)
+        self.before_request(self.set_read_preference)
         self.before_request(self.set_current_user)
 
     @staticmethod
@@ -16,9 +20,7 @@ class AuthController(Blueprint):
             auth = request.headers["Authorization"].split()
             if len(auth) == 2 and auth[0] == "Token":
                 from app.models import Token
-                token = Token.find_one({"token": auth[1]})
-                if token is not None and not token.expired():
-                    return token.user
+                return Token.find_user(auth[1])
         return None
 
     @staticmethod
@@ -33,11 +35,16 @@ class AuthController(Blueprint):
     def _get_user_from_x_api_auth_token():
         if "X-Api-Auth-Token" in request.headers:
             from app.models import Token
-            token = Token.find_one({"token": request.headers["X-Api-Auth-Token"]})
-            if token is not None and not token.expired():
-                return token.user
-            else:
-                return None
+            return Token.find_user(request.headers["X-Api-Auth-Token"])
+
+    def set_read_preference(self):
+        # modifying requests read from the primary to work with up-to-date data,
+        # see READ PREFERENCES in library/db.py
+        from library.db import db
+        if request.method not in ("GET", "HEAD"):
+            db.pin_primary()
+        elif self.secondary_reads:
+            db.allow_secondary_reads()
 
     def set_current_user(self):
         g.user = self._get_user_from_x_api_auth_token() or \
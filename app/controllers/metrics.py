@@ -0,0 +1,23 @@
+from flask import Blueprint, Response, request
+from library.engine.metrics import render_metrics
+from library.engine.errors import Forbidden
+
+metrics_ctrl = Blueprint("metrics", __name__)
+
+# metrics are served to these addresses only unless METRICS_ALLOWED_ADDRESSES is set,
+# None allows any address (i.e. access is restricted by a proxy, see extconf/nginx/nginx.conf)
+DEFAULT_METRICS_ALLOWED_ADDRESSES = ["127.0.0.1", "::1"]
+
+
+@metrics_ctrl.before_request
+def check_remote_address():
+    from app import app
+    allowed = app.config.app.get("METRICS_ALLOWED_ADDRESSES", DEFAULT_METRICS_ALLOWED_ADDRESSES)
+    if allowed is not None and request.remote_addr not in allowed:
+        raise Forbidden("Metrics are not available from this address")
+
+
+@metrics_ctrl.route("")
+def metrics():
+    data, content_type = render_metrics()
+    return Response(data, 200, {"Content-Type": content_type})
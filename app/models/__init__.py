@@ -5,4 +5,6 @@ from user import User
 from host import Host
 from token import Token
 from api_action import ApiAction
-from network_group import NetworkGroup
\ No newline at end of file
+from network_group import NetworkGroup
+from tombstone import Tombstone
+from inventory_generation import InventoryGeneration
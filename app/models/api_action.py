@@ -1,7 +1,9 @@
-from copy import deepcopy
 from storable_model import StorableModel, now, FieldRequired
 from library.engine.utils import resolve_id, convert_keys
 from library.engine.permutation import expand_pattern
+from library.engine.metrics import API_ACTION_WRITE_DURATION
+
+DEFAULT_ACTION_LOG_TTL = 86400 * 31 * 6 # approximately half a year
 
 
 class ApiAction(StorableModel):
@@ -51,6 +53,13 @@ class ApiAction(StorableModel):
 
     __slots__ = list(FIELDS)
 
+    @classmethod
+    def get_indexes(cls):
+        # actions older than ACTION_LOG_TTL are removed by mongodb
+        from app import app
+        ttl = app.config.app.get("ACTION_LOG_TTL", DEFAULT_ACTION_LOG_TTL)
+        return [x for x in cls.INDEXES if x != "created_at"] + [["created_at", {"expireAfterSeconds": ttl}]]
+
     @classmethod
     def check_compute_handlers(cls):
         from library.engine.action_log import action_types
@@ -771,9 +780,10 @@ class ApiAction(StorableModel):
             self._before_save()
 
         from app import app
-        app.alogger.info("Action[%s] by %s (%s): params=%s kwargs=%s computed=%s errors=%s",
-                         self.action_type, self.username, self.status,
-                         self.params, self.kwargs, self.computed, self.errors)
+        with API_ACTION_WRITE_DURATION.time():
+            app.alogger.info("Action[%s] by %s (%s): params=%s kwargs=%s computed=%s errors=%s",
+                             self.action_type, self.username, self.status,
+                             self.params, self.kwargs, self.computed, self.errors)
 
-        setattr(self, '_initial_state', deepcopy(self.to_dict(self.FIELDS)))
+        self._save_initial_state()
         return self
@@ -1,4 +1,5 @@
 from app.models.storable_model import StorableModel, save_required, now
+from app.models.inventory_generation import InventoryGeneration
 from bson.objectid import ObjectId
 from library.engine.errors import ParentAlreadyExists, ParentDoesNotExist, ParentCycle, DatacenterNotEmpty
 from library.engine.errors import ChildAlreadyExists, ChildDoesNotExist, ObjectSaveRequired, DatacenterNotFound
@@ -37,8 +38,11 @@ class Datacenter(StorableModel):
         ["name", { "unique": True }],
         "parent_id",
         "root_id",
+        "updated_at",
     )
 
+    TOMBSTONES = True
+
     REJECTED_FIELDS = (
         "parent_id",
         "root_id",
@@ -160,6 +164,13 @@ class Datacenter(StorableModel):
             self.parent_id = None
         self.touch()
 
+    def _after_save(self):
+        if self._initial_state.get("_id") is None or self.is_dirty:
+            InventoryGeneration.touch(shared=True)
+
+    def _after_delete(self):
+        InventoryGeneration.touch(shared=True)
+
     def _before_delete(self):
         if len(self.child_ids) > 0:
             raise DatacenterNotEmpty("Can not delete datacenter because it's not empty")
@@ -169,7 +180,7 @@ class Datacenter(StorableModel):
 
     @property
     def children(self):
-        return self.__class__.find({ "_id": { "$in": self.child_ids } }).all()
+        return self.__class__.find_by_ids(self.child_ids)
 
     @property
     @save_required
@@ -1,9 +1,11 @@
 from library.engine.errors import ParentDoesNotExist, ParentAlreadyExists, ParentCycle, InvalidCustomFields
 from library.engine.errors import InvalidTags, ChildDoesNotExist, ChildAlreadyExists, GroupNotEmpty, GroupNotFound
 from library.engine.errors import InvalidWorkGroupId, InvalidCustomData
-from library.engine.cache import request_time_cache, cache_custom_data, invalidate_custom_data
-from library.engine.utils import merge, check_dicts_are_equal, check_lists_are_equal, convert_keys, get_data_by_key
-from app.models.storable_model import StorableModel, now, save_required
+from library.engine.cache import request_time_cache, cache_inherited, invalidate_inherited
+from library.engine.utils import merge, check_dicts_are_equal, check_lists_are_equal, convert_keys, get_data_by_key, \
+                                merge_tags, merge_custom_fields
+from app.models.storable_model import StorableModel, now, save_required, relation
+from app.models.inventory_generation import InventoryGeneration
 from bson.objectid import ObjectId, InvalidId
 
 
@@ -22,8 +24,12 @@ class Group(StorableModel):
         "work_group_id",
         "parent_ids",
         "child_ids",
+        "ancestor_ids",
+        "descendant_ids",
         "tags",
         "custom_fields",
+        "effective_tags",
+        "effective_custom_fields",
         "local_custom_data",
         "responsibles_usernames_cache"
     )
@@ -35,8 +41,12 @@ class Group(StorableModel):
         "updated_at": now,
         "parent_ids": [],
         "child_ids": [],
+        "ancestor_ids": [],
+        "descendant_ids": [],
         "tags": [],
         "custom_fields": [],
+        "effective_tags": [],
+        "effective_custom_fields": [],
         "local_custom_data": {},
         "responsibles_usernames_cache": []
     }
@@ -51,6 +61,10 @@ class Group(StorableModel):
     REJECTED_FIELDS = (
         "parent_ids",
         "child_ids",
+        "ancestor_ids",
+        "descendant_ids",
+        "effective_tags",
+        "effective_custom_fields",
         "created_at",
         "updated_at",
         "responsibles_usernames_cache",
@@ -59,13 +73,40 @@ class Group(StorableModel):
     INDEXES = (
         "parent_ids",
         "child_ids",
+        "ancestor_ids",
+        "descendant_ids",
         ["name", { "unique": True }],
         "tags",
         "local_custom_data",
         ["custom_fields.key", "custom_fields.value"],
-        "responsibles_usernames_cache"
+        "effective_tags",
+        ["effective_custom_fields.key", "effective_custom_fields.value"],
+        "responsibles_usernames_cache",
+        "updated_at",
     )
 
+    TOMBSTONES = True
+
+    FIELD_DEPENDENCIES = {
+        "host_ids": [],
+        "empty": ["child_ids"],
+        "work_group_name": ["work_group_id"],
+        "modification_allowed": ["work_group_id"],
+        "is_root": ["parent_ids"],
+        "all_tags": ["effective_tags"],
+        "all_custom_fields": ["effective_custom_fields"],
+        "custom_data": ["local_custom_data", "parent_ids", "work_group_id"],
+    }
+
+    RELATIONS = {
+        "work_group": ("work_group_id", "WorkGroup"),
+    }
+
+    FIELD_RELATIONS = {
+        "work_group_name": ["work_group"],
+        "modification_allowed": ["work_group.owner"],
+    }
+
     __slots__ = FIELDS
 
     def __hash__(self):
@@ -94,7 +135,7 @@ class Group(StorableModel):
             raise ParentAlreadyExists("Group %s is already a parent of group %s" % (parent.name, self.name))
         if parent_id == self._id:
             raise ParentCycle("Can't make group parent of itself")
-        if self in parent.get_all_parents():
+        if self._id in [x._id for x in parent.get_all_parents()]:
             raise ParentCycle("Can't add one of (grand)child group as a parent")
         if self.work_group_id != parent.work_group_id:
             raise InvalidWorkGroupId("Can not add parent from different work_group")
@@ -102,6 +143,7 @@ class Group(StorableModel):
         self.parent_ids.append(parent._id)
         parent.save()
         self.save()
+        self._update_closure(parent)
 
     @save_required
     def remove_parent(self, parent):
@@ -120,6 +162,7 @@ class Group(StorableModel):
             else:
                 self.parent_ids.remove(parent_id)
                 self.save()
+                self._update_closure()
                 return
 
         if parent_id not in self.parent_ids:
@@ -128,6 +171,7 @@ class Group(StorableModel):
         self.parent_ids.remove(parent._id)
         parent.save()
         self.save()
+        self._update_closure(parent)
 
     @save_required
     def add_child(self, child):
@@ -136,7 +180,7 @@ class Group(StorableModel):
             raise ChildAlreadyExists("Group %s is already a child of group %s" % (child.name, self.name))
         if child_id == self._id:
             raise ParentCycle("Can't make group child of itself")
-        if self in child.get_all_children():
+        if self._id in [x._id for x in child.get_all_children()]:
             raise ParentCycle("Can't add one of (grand)parent group as a child")
         if self.work_group_id != child.work_group_id:
             raise InvalidWorkGroupId("Can not add child from different work_group")
@@ -144,6 +188,7 @@ class Group(StorableModel):
         self.child_ids.append(child._id)
         child.save()
         self.save()
+        self._update_closure(child)
 
     @save_required
     def remove_child(self, child):
@@ -162,6 +207,7 @@ class Group(StorableModel):
             else:
                 self.child_ids.remove(child_id)
                 self.save()
+                self._update_closure()
                 return
 
         if child_id not in self.child_ids:
@@ -170,6 +216,7 @@ class Group(StorableModel):
         self.child_ids.remove(child._id)
         child.save()
         self.save()
+        self._update_closure(child)
 
     @save_required
     def remove_all_children(self):
@@ -178,6 +225,7 @@ class Group(StorableModel):
             child.parent_ids.remove(self._id)
             child.save()
         self.save()
+        self._update_closure()
 
     @save_required
     def remove_all_parents(self):
@@ -186,12 +234,105 @@ class Group(StorableModel):
             parent.child_ids.remove(self._id)
             parent.save()
         self.save()
+        self._update_closure()
+
+    def _update_closure(self, *groups):
+        # recomputes the ancestor/descendant index after an edge change
+        # and refreshes the given in-memory instances
+        self.rebuild_related_closure((self,) + groups)
+
+    @classmethod
+    def rebuild_closure(cls, query=None, dry_run=False, groups=(), group_ids=None):
+        """
+        rebuild_closure recomputes ancestor_ids and descendant_ids of groups matching
+        the query (the whole collection by default) and writes the outdated ones back
+        using a single bulk write. If group_ids are given only these groups are written,
+        the query must match all their ancestors and descendants then. The given in-memory
+        instances are updated with the written values. Returns a dict
+        { group_id: (ancestor_ids, descendant_ids) } of groups having an outdated index
+        """
+        from library.db import db
+        from library.engine.graph import transitive_closure
+        from pymongo import UpdateOne
+
+        if query is None:
+            query = {}
+        projection = ["parent_ids", "ancestor_ids", "descendant_ids"]
+        docs = list(db.conn[cls.collection].find(query, projection=projection))
+        edges = dict([(x["_id"], x.get("parent_ids") or []) for x in docs])
+        ancestors, descendants = transitive_closure(edges)
+
+        updated_at = now()
+        outdated = {}
+        requests = []
+        for doc in docs:
+            group_id = doc["_id"]
+            if group_ids is not None and group_id not in group_ids:
+                continue
+            ancestor_ids = sorted(ancestors[group_id])
+            descendant_ids = sorted(descendants[group_id])
+            if ancestor_ids != doc.get("ancestor_ids") or descendant_ids != doc.get("descendant_ids"):
+                outdated[group_id] = (ancestor_ids, descendant_ids)
+                requests.append(UpdateOne(
+                    {"_id": group_id},
+                    {"$set": {"ancestor_ids": ancestor_ids, "descendant_ids": descendant_ids,
+                              "updated_at": updated_at}}
+                ))
+
+        if len(requests) > 0 and not dry_run:
+            db.bulk_write(cls.collection, requests)
+            for group in groups:
+                if group._id in outdated:
+                    ancestor_ids, descendant_ids = outdated[group._id]
+                    group._set_stored_fields({"ancestor_ids": ancestor_ids, "descendant_ids": descendant_ids,
+                                              "updated_at": updated_at})
+        return outdated
+
+    @classmethod
+    def rebuild_related_closure(cls, groups):
+        """
+        rebuild_related_closure rebuilds the index of the given groups, their ancestors and
+        descendants after their edges have changed. The instances must have the index they
+        had before the change, then only the groups related to them are read and written
+        """
+        from library.db import db
+        affected = set()
+        for group in groups:
+            affected.add(group._id)
+            affected.update(group.ancestor_ids)
+            affected.update(group.descendant_ids)
+        related = set(affected)
+        projection = ["ancestor_ids", "descendant_ids"]
+        for doc in db.conn[cls.collection].find({"_id": {"$in": list(affected)}}, projection=projection):
+            related.update(doc.get("ancestor_ids") or [])
+            related.update(doc.get("descendant_ids") or [])
+        return cls.rebuild_closure({"_id": {"$in": list(related)}}, groups=groups, group_ids=affected)
+
+    @classmethod
+    def record_moves(cls, moves):
+        """
+        record_moves registers groups moved to another work group along with their hosts
+        for incremental syncs, moves is a list of (group_id, work_group_id) tuples of groups
+        and work groups they have left. Hosts are touched to be synced to their new work group
+        """
+        from app.models import Host, Tombstone
+        if len(moves) == 0:
+            return
+        left = dict(moves)
+        group_ids = list(left.keys())
+        hosts = Host.find({"group_id": {"$in": group_ids}}, fields=["_id", "group_id"])
+        Tombstone.record_moves(cls, moves)
+        Tombstone.record_moves(Host, [(x._id, left[x.group_id]) for x in hosts])
+        Host.update_many({"group_id": {"$in": group_ids}}, {"$set": {"updated_at": now()}})
 
     @save_required
     def remove_all_hosts(self):
-        for host in self.hosts:
+        hosts = self.hosts.all()
+        for host in hosts:
             host.group_id = None
-            host.save()
+        failed = self.host_class.save_many(hosts)
+        if len(failed) > 0:
+            raise failed[0][1]
 
     @property
     def hosts(self):
@@ -207,7 +348,7 @@ class Group(StorableModel):
     def all_hosts(self):
         if self.is_new:
             return self.host_class.find({"group_id": ObjectId('000000000000000000000000')})
-        group_ids = [self._id] + [x._id for x in self.get_all_children()]
+        group_ids = [self._id] + self.descendant_ids
         return self.host_class.find({"group_id": {"$in": group_ids}})
 
     @property
@@ -218,15 +359,16 @@ class Group(StorableModel):
     def parents(self):
         if len(self.parent_ids) == 0:
             return []
-        return self.__class__.find({ "_id": { "$in": self.parent_ids }}).all()
+        return self.__class__.find_by_ids(self.parent_ids)
 
     @property
     def children(self):
         if len(self.child_ids) == 0:
             return []
-        return self.__class__.find({ "_id": { "$in": self.child_ids }}).all()
+        return self.__class__.find_by_ids(self.child_ids)
 
     @property
+    @relation("work_group")
     def work_group(self):
         if self.work_group_id is None:
             return None
@@ -238,28 +380,36 @@ class Group(StorableModel):
 
     @request_time_cache()
     def get_all_children(self):
-        children = self.children[:]
-        for child in self.children:
-            children += child.get_all_children()
-        return children
+        if self.is_new:
+            return []
+        return self.__class__.find({"ancestor_ids": self._id}).all()
 
     @request_time_cache()
     def get_all_parents(self):
-        parents = self.parents[:]
-        for parent in self.parents:
-            parents += parent.get_all_parents()
-        return parents
+        if self.is_new:
+            return []
+        return self.__class__.find({"descendant_ids": self._id}).all()
 
     @property
-    @cache_custom_data
+    @cache_inherited
     def custom_data(self):
         if len(self.parent_ids) == 0:
             return self.local_custom_data
-
-        parent_data = self.parents[0].custom_data
-        for other_parent in self.parents[1:]:
-            parent_data = merge(parent_data, other_parent.custom_data)
-
+        # all the ancestors are loaded at once
+        ancestors = dict([(x._id, x) for x in self.get_all_parents()])
+        return self._merge_custom_data(ancestors, {})
+
+    def _merge_custom_data(self, ancestors, merged):
+        # parents' data is merged in parent_ids order, each parent's data being
+        # merged the same way recursively. merged keeps the results by group id
+        parent_data = {}
+        for parent_id in self.parent_ids:
+            parent = ancestors.get(parent_id)
+            if parent is None:
+                continue
+            if parent_id not in merged:
+                merged[parent_id] = parent._merge_custom_data(ancestors, merged)
+            parent_data = merge(parent_data, merged[parent_id])
         return merge(parent_data, self.local_custom_data)
 
     def touch(self):
@@ -299,22 +449,32 @@ class Group(StorableModel):
                 else:
                     custom_keys.add(cf["key"])
 
-    def _invalidate_custom_data(self):
-        invalidate_custom_data(self)
-        for group in self.children:
-            group._invalidate_custom_data()
-        for host in self.hosts:
-            invalidate_custom_data(host)
+    def inherited_scope(self):
+        # groups inherit from the groups of their own work group only, see _check_work_group_ids
+        if self.work_group_id is None:
+            return None
+        return "WorkGroup", self.work_group_id
+
+    def _invalidate_inherited(self):
+        # a single generation covers all the groups of the work group
+        for work_group_id in set([self.work_group_id, self._initial_state.get("work_group_id")]):
+            if work_group_id is not None:
+                invalidate_inherited("WorkGroup", work_group_id)
 
     def _check_custom_data(self):
         # Custom data validation
         if type(self.local_custom_data) is not dict:
             raise InvalidCustomData("Custom data must be a dict")
-        # Custom data invalidation
+
+    def _check_inherited(self):
+        # Inherited data cache invalidation, it's done after the group is saved
+        # so other workers can't cache the values computed from the outdated data
         if not check_lists_are_equal(self.parent_ids, self._initial_state["parent_ids"]):
-            self._invalidate_custom_data()
+            self._invalidate_inherited()
         elif not check_dicts_are_equal(self.local_custom_data, self._initial_state["local_custom_data"]):
-            self._invalidate_custom_data()
+            self._invalidate_inherited()
+        elif self.work_group_id != self._initial_state["work_group_id"]:
+            self._invalidate_inherited()
 
     def _before_save(self):
         self._check_work_group_ids()
@@ -325,6 +485,25 @@ class Group(StorableModel):
             self.touch()
         if self.is_new or self.work_group_id != self._initial_state.get("work_group_id"):
             self.reset_responsibles_cache()
+        self.reset_effective_fields()
+
+    def _after_save(self):
+        if self._initial_state.get("_id") is None or self.is_dirty:
+            InventoryGeneration.touch(work_group_ids=[self.work_group_id, self._initial_state.get("work_group_id")])
+        if self._initial_state.get("_id") is None:
+            # a newly created group has neither children nor hosts yet
+            return
+        if self.work_group_id != self._initial_state.get("work_group_id"):
+            self.record_moves([(self._id, self._initial_state.get("work_group_id"))])
+        if self.effective_tags != self._initial_state.get("effective_tags") or \
+                self.effective_custom_fields != self._initial_state.get("effective_custom_fields"):
+            self.propagate_effective_fields()
+            # descendants may belong to other work groups
+            InventoryGeneration.touch(group_ids=self.descendant_ids)
+        self._check_inherited()
+
+    def _after_delete(self):
+        InventoryGeneration.touch(work_group_ids=[self.work_group_id])
 
     def _before_delete(self):
         if len(self.child_ids) > 0:
@@ -340,26 +519,20 @@ class Group(StorableModel):
         self.destroy(skip_callback)
 
     @property
-    @request_time_cache()
     def all_tags(self):
-        tags = set(self.tags)
-        for parent in self.parents:
-            tags = tags.union(parent.all_tags)
-        return tags
+        # effective values are stored on save and updated by the ancestors' changes,
+        # see propagate_effective_fields, they're computed for new groups only
+        if self.is_new:
+            return set(merge_tags(self.tags, *[x.effective_tags for x in self.parents]))
+        return set(self.effective_tags)
 
     @property
-    @request_time_cache()
     def all_custom_fields(self):
-        cf_dict = {}
-        for parent in self.parents:
-            for cf in parent.all_custom_fields:
-                cf_dict[cf["key"]] = cf["value"]
-        for cf in self.custom_fields:
-            cf_dict[cf["key"]] = cf["value"]
-        custom_fields = []
-        for k, v in cf_dict.items():
-            custom_fields.append({ "key": k, "value": v })
-        return custom_fields
+        if self.is_new:
+            cf_lists = [x.effective_custom_fields for x in self.parents]
+            cf_lists.append(self.custom_fields)
+            return merge_custom_fields(*cf_lists)
+        return self.effective_custom_fields
 
     @property
     def work_group_name(self):
@@ -391,11 +564,7 @@ class Group(StorableModel):
     def query_by_tags_recursive(cls, tags, query={}):
         if type(tags) == "str":
             tags = [tags]
-        tagged_groups = cls.find({ "tags": { "$in": tags }}).all()
-        tagged_group_ids = [x._id for x in tagged_groups]
-        for g in tagged_groups:
-            tagged_group_ids += [x._id for x in g.get_all_children()]
-        query["_id"] = {"$in": tagged_group_ids}
+        query["effective_tags"] = {"$in": tags}
         return query
 
     @classmethod
@@ -446,6 +615,80 @@ class Group(StorableModel):
         if self.hosts.count() > 0:
             Host.update_many({"group_id": self._id}, {"$set": {"responsibles_usernames_cache": responsibles}})
 
+    def reset_effective_fields(self):
+        # effective values of the parents are read from the db, so they must
+        # be consistent for the result to be correct
+        parents = self.parents
+        self.effective_tags = merge_tags(self.tags, *[x.effective_tags for x in parents])
+        cf_lists = [x.effective_custom_fields for x in parents]
+        cf_lists.append(self.custom_fields)
+        self.effective_custom_fields = merge_custom_fields(*cf_lists)
+
+    def propagate_effective_fields(self):
+        """
+        propagate_effective_fields recomputes effective tags and custom fields of all
+        the descendants of the group and of all the hosts belonging to the group or
+        its descendants. The group's own effective fields are taken as they are.
+        Outdated documents are updated with bulk writes, no callbacks are run
+        """
+        from library.db import db
+        from pymongo import UpdateOne
+
+        projection = ["parent_ids", "ancestor_ids", "tags", "custom_fields",
+                      "effective_tags", "effective_custom_fields"]
+        descendants = list(db.conn[self.collection].find({"ancestor_ids": self._id}, projection=projection))
+        # a group always has more ancestors than any of its own ancestors so sorting
+        # by the closure size processes parents before their children
+        descendants.sort(key=lambda x: len(x.get("ancestor_ids") or []))
+
+        effective = {self._id: (self.effective_tags, self.effective_custom_fields)}
+        subtree_ids = [self._id] + [x["_id"] for x in descendants]
+
+        # parents from outside of the subtree are not affected and keep their stored values
+        outer_ids = set()
+        for doc in descendants:
+            outer_ids.update(doc.get("parent_ids") or [])
+        outer_ids.difference_update(subtree_ids)
+        if len(outer_ids) > 0:
+            outer = db.conn[self.collection].find({"_id": {"$in": list(outer_ids)}},
+                                                  projection=["effective_tags", "effective_custom_fields"])
+            for doc in outer:
+                effective[doc["_id"]] = (doc.get("effective_tags") or [], doc.get("effective_custom_fields") or [])
+
+        requests = []
+        for doc in descendants:
+            parents = [effective[x] for x in doc.get("parent_ids") or [] if x in effective]
+            tags = merge_tags(doc.get("tags") or [], *[x[0] for x in parents])
+            cf_lists = [x[1] for x in parents]
+            cf_lists.append(doc.get("custom_fields") or [])
+            custom_fields = merge_custom_fields(*cf_lists)
+            effective[doc["_id"]] = (tags, custom_fields)
+            if tags != doc.get("effective_tags") or custom_fields != doc.get("effective_custom_fields"):
+                requests.append(UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$set": {"effective_tags": tags, "effective_custom_fields": custom_fields,
+                              "updated_at": now()}}
+                ))
+        if len(requests) > 0:
+            db.bulk_write(self.collection, requests)
+
+        # hosts are not touched as their updated_at is the optimistic lock, incremental
+        # syncs pick up hosts of the updated groups instead, see get_executer_data_changes
+        projection = ["group_id", "tags", "custom_fields", "effective_tags", "effective_custom_fields"]
+        hosts = db.conn[self.host_class.collection].find({"group_id": {"$in": subtree_ids}}, projection=projection)
+        requests = []
+        for doc in hosts:
+            group_tags, group_custom_fields = effective[doc["group_id"]]
+            tags = merge_tags(doc.get("tags") or [], group_tags)
+            custom_fields = merge_custom_fields(group_custom_fields, doc.get("custom_fields") or [])
+            if tags != doc.get("effective_tags") or custom_fields != doc.get("effective_custom_fields"):
+                requests.append(UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$set": {"effective_tags": tags, "effective_custom_fields": custom_fields}}
+                ))
+        if len(requests) > 0:
+            db.bulk_write(self.host_class.collection, requests)
+
     def add_local_custom_data(self, data):
         self.local_custom_data = merge(self.local_custom_data, convert_keys(data))
 
@@ -1,13 +1,15 @@
 import re
 from datetime import timedelta
-from storable_model import StorableModel, now, save_required
-from library.engine.errors import InvalidTags, InvalidCustomFields, DatacenterNotFound, \
+from storable_model import StorableModel, now, save_required, relation
+from library.engine.errors import ApiError, InvalidTags, InvalidCustomFields, DatacenterNotFound, \
                                 GroupNotFound, InvalidAliases, InvalidFQDN, \
                                 InvalidIpAddresses, NetworkGroupNotFound, InvalidHardwareAddresses, \
                                 InvalidCustomData, InvalidNetInterfaces
 from library.engine.permissions import get_user_from_app_context
-from library.engine.utils import merge, check_dicts_are_equal, convert_keys, get_data_by_key, uuid4_string
-from library.engine.cache import request_time_cache, cache_custom_data, invalidate_custom_data
+from library.engine.utils import merge, convert_keys, get_data_by_key, uuid4_string, \
+                                merge_tags, merge_custom_fields
+from library.engine.cache import request_time_cache
+from app.models.inventory_generation import InventoryGeneration
 
 FQDN_EXPR = re.compile('^[_a-z0-9\-.]+$')
 ANSIBLE_CD_KEY = "ansible_vars"
@@ -30,6 +32,8 @@ class Host(StorableModel):
         "aliases",
         "tags",
         "custom_fields",
+        "effective_tags",
+        "effective_custom_fields",
         "local_custom_data",
         "created_at",
         "updated_at",
@@ -45,6 +49,9 @@ class Host(StorableModel):
 
     KEY_FIELD = "fqdn"
 
+    # hosts are modified concurrently by users and discovery agents
+    OPTIMISTIC_LOCK_FIELD = "updated_at"
+
     REQUIRED_FIELDS = (
         "fqdn",
     )
@@ -54,7 +61,9 @@ class Host(StorableModel):
         "updated_at",
         "security_key",
         "security_key_expires_at",
-        "responsibles_usernames_cache"
+        "responsibles_usernames_cache",
+        "effective_tags",
+        "effective_custom_fields",
     )
 
     RESTRICTED_FIELDS = (
@@ -67,6 +76,8 @@ class Host(StorableModel):
         "updated_at": now,
         "tags": [],
         "custom_fields": [],
+        "effective_tags": [],
+        "effective_custom_fields": [],
         "local_custom_data": {},
         "aliases": [],
         "ip_addrs": [],
@@ -79,6 +90,7 @@ class Host(StorableModel):
         ["fqdn", {"unique": True}],
         "ext_id",
         "group_id",
+        ["group_id", "fqdn"],
         "datacenter_id",
         "network_group_id",
         "tags",
@@ -86,9 +98,14 @@ class Host(StorableModel):
         "local_custom_data",
         "responsibles_usernames_cache",
         "security_key",
-        ["custom_fields.key", "custom_fields.value"]
+        ["custom_fields.key", "custom_fields.value"],
+        "effective_tags",
+        ["effective_custom_fields.key", "effective_custom_fields.value"],
+        "updated_at",
     )
 
+    TOMBSTONES = True
+
     SYSTEM_FIELDS = (
         "ip_addrs",
         "hw_addrs",
@@ -97,6 +114,39 @@ class Host(StorableModel):
         "provision_state",
     )
 
+    FIELD_DEPENDENCIES = {
+        "group_name": ["group_id"],
+        "network_group_name": ["network_group_id"],
+        "work_group_name": ["group_id"],
+        "responsibles": ["group_id"],
+        "datacenter_name": ["datacenter_id"],
+        "root_datacenter_name": ["datacenter_id"],
+        "modification_allowed": ["group_id"],
+        "destruction_allowed": ["group_id"],
+        "all_tags": ["effective_tags"],
+        "all_custom_fields": ["effective_custom_fields"],
+        "custom_data": ["local_custom_data", "group_id"],
+        "ansible_vars": ["local_custom_data", "group_id"],
+    }
+
+    RELATIONS = {
+        "group": ("group_id", "Group"),
+        "datacenter": ("datacenter_id", "Datacenter"),
+        "network_group": ("network_group_id", "NetworkGroup"),
+    }
+
+    FIELD_RELATIONS = {
+        "group_name": ["group"],
+        "network_group_name": ["network_group"],
+        "work_group_name": ["group.work_group"],
+        "responsibles": ["group.work_group"],
+        "datacenter_name": ["datacenter"],
+        "modification_allowed": ["group.work_group.owner"],
+        "destruction_allowed": ["group.work_group.owner"],
+        "custom_data": ["group"],
+        "ansible_vars": ["group"],
+    }
+
     __slots__ = FIELDS
 
     def touch(self):
@@ -106,14 +156,61 @@ class Host(StorableModel):
         return hash(self.fqdn + "." + str(self._id))
 
     def _before_save(self):
+        self._prepare_save(self.group, self.datacenter, self.network_group)
+
+    @classmethod
+    def _before_save_many(cls, hosts):
+        from app.models import Group, Datacenter, NetworkGroup, WorkGroup, User
+
+        def fetch(model, ids, fields):
+            ids = list(set([x for x in ids if x is not None]))
+            if len(ids) == 0:
+                return {}
+            objs = model.find({"_id": {"$in": ids}}, read_only=True, fields=fields)
+            return dict([(x._id, x) for x in objs])
+
+        # referenced objects are fetched once for the whole batch, only the fields
+        # used by _prepare_save are loaded
+        groups = fetch(Group, [x.group_id for x in hosts],
+                       ["work_group_id", "effective_tags", "effective_custom_fields"])
+        datacenters = fetch(Datacenter, [x.datacenter_id for x in hosts], ["_id"])
+        network_groups = fetch(NetworkGroup, [x.network_group_id for x in hosts], ["_id"])
+        work_groups = fetch(WorkGroup, [x.work_group_id for x in groups.values()], ["owner_id", "member_ids"])
+        participant_ids = set()
+        for work_group in work_groups.values():
+            participant_ids.update(work_group.member_ids + [work_group.owner_id])
+        usernames = dict([(x._id, x.username) for x in fetch(User, participant_ids, ["username"]).values()])
+        responsibles = {None: []}
+        for group in groups.values():
+            work_group = work_groups.get(group.work_group_id)
+            if work_group is None:
+                responsibles[group._id] = []
+            else:
+                user_ids = set(work_group.member_ids + [work_group.owner_id])
+                responsibles[group._id] = [usernames[x] for x in user_ids if x in usernames]
+
+        failed = []
+        for host in hosts:
+            try:
+                host._prepare_save(
+                    groups.get(host.group_id),
+                    datacenters.get(host.datacenter_id),
+                    network_groups.get(host.network_group_id),
+                    responsibles.get(host.group_id)
+                )
+            except ApiError as e:
+                failed.append((host, e))
+        return failed
+
+    def _prepare_save(self, group, datacenter, network_group, responsibles=None):
         # sanity checks
         if not FQDN_EXPR.match(self.fqdn):
             raise InvalidFQDN("FQDN %s is invalid" % self.fqdn)
-        if self.group_id is not None and self.group is None:
+        if self.group_id is not None and group is None:
             raise GroupNotFound("can not find group with id %s" % self.group_id)
-        if self.datacenter_id is not None and self.datacenter is None:
+        if self.datacenter_id is not None and datacenter is None:
             raise DatacenterNotFound("can not find datacenter with id %s" % self.datacenter_id)
-        if self.network_group_id is not None and self.network_group is None:
+        if self.network_group_id is not None and network_group is None:
             raise NetworkGroupNotFound("can not find network group with id %s" % self.network_group_id)
         if not hasattr(self.tags, "__getitem__") or type(self.tags) is str:
             raise InvalidTags("tags must be of array type")
@@ -153,22 +250,55 @@ class Host(StorableModel):
         if type(self.local_custom_data) is not dict:
             raise InvalidCustomData("Custom data must be a dict")
 
-        # Custom data cache invalidation
-
-        # if group has changed
-        if self.group_id != self._initial_state.get("group_id"):
-            invalidate_custom_data(self)
-
         # if group has changed or the host has been just created
         if self.is_new or self.group_id != self._initial_state.get("group_id"):
-            self.reset_responsibles_cache()
-
-        # if local custom data has changed
-        elif not check_dicts_are_equal(self.local_custom_data, self._initial_state.get("local_custom_data")):
-            invalidate_custom_data(self)
+            self.reset_responsibles_cache(responsibles)
 
+        self.reset_effective_fields(group)
         self.touch()
 
+    def _after_save(self):
+        self._after_save_many([self])
+
+    @classmethod
+    def _after_save_many(cls, hosts):
+        # inventory changes and moves of the whole batch are recorded at once
+        group_ids = []
+        moved = []
+        for host in hosts:
+            previous_group_id = host._initial_state.get("group_id")
+            if host._initial_state.get("_id") is None or host.is_dirty:
+                group_ids += [host.group_id, previous_group_id]
+            if host._initial_state.get("_id") is not None and host.group_id != previous_group_id:
+                moved.append((host, previous_group_id))
+        if len(group_ids) > 0:
+            InventoryGeneration.touch(group_ids=group_ids)
+        cls._record_moves(moved)
+
+    def _after_delete(self):
+        InventoryGeneration.touch(group_ids=[self.group_id])
+
+    @classmethod
+    def _record_moves(cls, moved):
+        # hosts leaving a work group are passed to the clients syncing it as deleted,
+        # moved is a list of (host, previous_group_id) tuples
+        from app.models import Group, Tombstone
+        moved = [x for x in moved if x[1] is not None]
+        if len(moved) == 0:
+            return
+        group_ids = set([x[1] for x in moved] + [x[0].group_id for x in moved if x[0].group_id is not None])
+        groups = Group.find({"_id": {"$in": list(group_ids)}}, read_only=True, fields=["work_group_id"])
+        work_group_ids = dict([(x._id, x.work_group_id) for x in groups])
+        moves = []
+        for host, previous_group_id in moved:
+            if previous_group_id not in work_group_ids:
+                continue
+            previous_work_group_id = work_group_ids[previous_group_id]
+            if work_group_ids.get(host.group_id) != previous_work_group_id:
+                moves.append((host._id, previous_work_group_id))
+        if len(moves) > 0:
+            Tombstone.record_moves(cls, moves)
+
     def reset_responsibles_cache(self, responsibles=None):
         if responsibles is None:
             if self.group_id is None:
@@ -180,6 +310,17 @@ class Host(StorableModel):
             # optimization for recursive calls from parent group
             self.responsibles_usernames_cache = responsibles
 
+    def reset_effective_fields(self, group=None):
+        # the group is looked up unless it's given
+        if group is None and self.group_id is not None:
+            group = self.group
+        if group is None:
+            self.effective_tags = merge_tags(self.tags)
+            self.effective_custom_fields = merge_custom_fields(self.custom_fields)
+        else:
+            self.effective_tags = merge_tags(self.tags, group.effective_tags)
+            self.effective_custom_fields = merge_custom_fields(group.effective_custom_fields, self.custom_fields)
+
     def security_key_expired(self):
         return self.security_key_expires_at is None or self.security_key_expires_at < now()
 
@@ -230,12 +371,14 @@ class Host(StorableModel):
         return res
 
     @property
+    @relation("group")
     def group(self):
         if self.group_id is None:
             return None
         return self.group_class.find_one({ "_id": self.group_id })
 
     @property
+    @relation("network_group")
     def network_group(self):
         from app.models import NetworkGroup
         if self.network_group_id is None:
@@ -277,6 +420,7 @@ class Host(StorableModel):
         return work_group.participants
 
     @property
+    @relation("datacenter")
     def datacenter(self):
         if self.datacenter_id is None:
             return None
@@ -359,34 +503,26 @@ class Host(StorableModel):
         return self.group.modification_allowed
 
     @property
-    @request_time_cache()
     def all_tags(self):
-        tags = set(self.tags)
-        if self.is_new or self.group is None:
-            return tags
-        return tags.union(self.group.all_tags)
+        # effective values are stored on save and updated by the group changes,
+        # see Group.propagate_effective_fields, they're computed for new hosts only
+        if self.is_new:
+            if self.group is None:
+                return set(self.tags)
+            return set(merge_tags(self.tags, self.group.effective_tags))
+        return set(self.effective_tags)
 
     @property
-    @request_time_cache()
     def all_custom_fields(self):
-        # the handler may be a bit heavy, be sure to benchmark it
-        if self.is_new or self.group is None:
-            return self.custom_fields
-
-        cf_dict = {}
-        for cf in self.group.all_custom_fields:
-            cf_dict[cf["key"]] = cf["value"]
-        for cf in self.custom_fields:
-            cf_dict[cf["key"]] = cf["value"]
-        custom_fields = []
-        for k,v in cf_dict.items():
-            custom_fields.append({"key": k, "value": v})
-
-        return custom_fields
+        if self.is_new:
+            if self.group is None:
+                return self.custom_fields
+            return merge_custom_fields(self.group.effective_custom_fields, self.custom_fields)
+        return self.effective_custom_fields
 
     @property
-    @cache_custom_data
     def custom_data(self):
+        # the group's custom data is cached, see Group.custom_data
         if self.group_id is None:
             return self.local_custom_data
         return merge(self.group.custom_data, self.local_custom_data)
@@ -420,7 +556,8 @@ class Host(StorableModel):
     @classmethod
     def unset_datacenter(cls, datacenter_id):
         from library.db import db
-        db.conn[cls.collection].update_many({"datacenter_id": datacenter_id}, {"$set": {"datacenter_id": None}})
+        db.update_query(cls.collection, {"datacenter_id": datacenter_id},
+                        {"$set": {"datacenter_id": None, "updated_at": now()}})
 
     @classmethod
     def unset_location(cls, location_id):
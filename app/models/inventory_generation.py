@@ -0,0 +1,119 @@
+from flask import g, has_app_context
+from storable_model import StorableModel, now
+
+# bumped on any change of the inventory
+ALL_KEY = "*"
+# bumped on changes of data shared by all work groups, i.e. datacenters
+SHARED_KEY = "shared"
+
+
+def work_group_key(name):
+    return "work_group:%s" % name
+
+
+class InventoryGeneration(StorableModel):
+    """
+    InventoryGeneration is a counter bumped on every change of inventory data,
+    one per work group (its hosts, groups and the work group itself) plus ALL_KEY
+    and SHARED_KEY ones. Counters let inventory endpoints build ETags without
+    reading the data. Work groups are identified by name as requests refer to them so.
+
+    Changes made during a request are collected with touch() and written
+    by flush_inventory_changes() once the request is over
+    """
+
+    FIELDS = (
+        "_id",
+        "generation",
+        "updated_at",
+    )
+
+    __slots__ = list(FIELDS)
+
+    @classmethod
+    def get_state(cls, keys):
+        """
+        get_state returns a tuple (generations, last_modified) of the given counters,
+        counters which have never been bumped have generation 0
+        """
+        from library.db import db
+        # counters are read from the primary so that the state never goes back in time
+        docs = db.conn[cls.collection].find({"_id": {"$in": list(keys)}})
+        docs = dict([(x["_id"], x) for x in docs])
+        generations = tuple([docs[k]["generation"] if k in docs else 0 for k in keys])
+        modified = [x["updated_at"] for x in docs.itervalues()]
+        last_modified = max(modified) if len(modified) > 0 else None
+        return generations, last_modified
+
+    @classmethod
+    def bump(cls, keys):
+        """
+        bump increments the given counters along with ALL_KEY one, returns the set of keys bumped
+        """
+        from library.db import db
+        from pymongo import UpdateOne
+        updated_at = now()
+        keys = set(keys) | {ALL_KEY}
+        requests = [
+            UpdateOne({"_id": key}, {"$inc": {"generation": 1}, "$set": {"updated_at": updated_at}}, upsert=True)
+            for key in keys
+        ]
+        db.conn[cls.collection].bulk_write(requests, ordered=False)
+        return keys
+
+    @classmethod
+    def touch(cls, work_group_ids=(), work_group_names=(), group_ids=(), shared=False):
+        """
+        touch registers a change of the inventory of work groups given by ids or names
+        or of the work groups the groups given by ids belong to
+        """
+        if has_app_context():
+            changes = getattr(g, "_inventory_changes", None)
+            if changes is None:
+                changes = g._inventory_changes = _new_changes()
+        else:
+            changes = _new_changes()
+        changes["work_group_ids"].update([x for x in work_group_ids if x is not None])
+        changes["work_group_names"].update([x for x in work_group_names if x is not None])
+        changes["group_ids"].update([x for x in group_ids if x is not None])
+        changes["shared"] = changes["shared"] or shared
+        if not has_app_context():
+            cls.flush(changes)
+
+    @classmethod
+    def flush(cls, changes):
+        from app.models import Group, WorkGroup
+        work_group_ids = set(changes["work_group_ids"])
+        if len(changes["group_ids"]) > 0:
+            groups = Group.find({"_id": {"$in": list(changes["group_ids"])}}, fields=["work_group_id"])
+            work_group_ids.update([x.work_group_id for x in groups if x.work_group_id is not None])
+        work_group_names = set(changes["work_group_names"])
+        if len(work_group_ids) > 0:
+            work_groups = WorkGroup.find({"_id": {"$in": list(work_group_ids)}}, fields=["name"])
+            work_group_names.update([x.name for x in work_groups])
+        keys = [work_group_key(x) for x in work_group_names]
+        if changes["shared"]:
+            keys.append(SHARED_KEY)
+        return cls.bump(keys)
+
+
+def _new_changes():
+    return {"work_group_ids": set(), "work_group_names": set(), "group_ids": set(), "shared": False}
+
+
+def flush_inventory_changes(exc=None):
+    # a teardown_request handler, runs even if the request has failed
+    # as some of the changes may have been written anyway
+    changes = getattr(g, "_inventory_changes", None)
+    if changes is None:
+        return
+    g._inventory_changes = None
+    from app import app
+    from library.engine.cache import prewarm_rendered
+    try:
+        keys = InventoryGeneration.flush(changes)
+    except Exception as e:
+        app.logger.error("Error updating inventory generations: %s" % e)
+        return
+    if app.config.cache.get("RENDER_CACHE_PREWARM", False):
+        prewarm_rendered(keys)
@@ -1,8 +1,10 @@
 from datetime import datetime
 from functools import wraps
-from library.engine.errors import FieldRequired, ObjectSaveRequired
-from library.engine.cache import request_time_cache
+from bson.objectid import ObjectId
+from library.engine.errors import ApiError, FieldRequired, ObjectSaveRequired, ReadOnlyObject
+from library.engine.cache import request_time_cache, freeze
 from library.engine.permissions import current_user_is_system
+from library.engine import identity_map
 from copy import deepcopy
 
 
@@ -27,6 +29,24 @@ def now():
     return dt
 
 
+IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None), datetime, ObjectId)
+
+
+def copy_state(value):
+    """
+    copy_state is a faster replacement of deepcopy for bson-like data: dicts and lists
+    are copied recursively while immutable values are shared with the original.
+    Values of unknown types are deepcopied
+    """
+    if isinstance(value, IMMUTABLE_TYPES):
+        return value
+    if type(value) is dict:
+        return dict([(k, copy_state(v)) for k, v in value.iteritems()])
+    if type(value) is list:
+        return [copy_state(x) for x in value]
+    return deepcopy(value)
+
+
 class ModelMeta(type):
     _collection = None
 
@@ -49,6 +69,16 @@ class StorableModel(object):
     KEY_FIELD = None
     DEFAULTS = {}
     INDEXES = []
+    # a field checked on updates to detect concurrent modifications, e.g. "updated_at"
+    OPTIMISTIC_LOCK_FIELD = None
+    # stored fields computed properties depend on, used to build projections
+    FIELD_DEPENDENCIES = {}
+    # relations to other models, name -> (id field, model class name), see prefetch()
+    RELATIONS = {}
+    # relations computed properties use, prefetched for batches of objects being rendered
+    FIELD_RELATIONS = {}
+    # deletions are recorded as tombstones for incremental syncs, see Tombstone
+    TOMBSTONES = False
 
     AUXILIARY_SLOTS = (
         "AUXILIARY_SLOTS",
@@ -60,11 +90,22 @@ class StorableModel(object):
         "KEY_FIELD",
         "DEFAULTS",
         "INDEXES",
+        "OPTIMISTIC_LOCK_FIELD",
+        "FIELD_DEPENDENCIES",
+        "RELATIONS",
+        "FIELD_RELATIONS",
+        "TOMBSTONES",
     )
 
     __hash__ = None
 
     def __init__(self, **kwargs):
+        # read-only objects are used for serialization only, they don't keep
+        # the initial state and can't be saved
+        self._read_only = kwargs.pop("_read_only", False)
+        # partial objects loaded with a projection don't get defaults
+        # for the fields which haven't been fetched
+        loaded_fields = kwargs.pop("_fields", None)
         if "_id" not in kwargs:
             self._id = None
         for field, value in kwargs.iteritems():
@@ -72,7 +113,7 @@ class StorableModel(object):
                 setattr(self, field, value)
         self.__slots__ = []
         for field in self.FIELDS:
-            if field not in kwargs:
+            if field not in kwargs and (loaded_fields is None or field in loaded_fields):
                 value = self.DEFAULTS.get(field)
                 if callable(value):
                     value = value()
@@ -81,18 +122,99 @@ class StorableModel(object):
                 elif hasattr(value, "__getitem__"):
                     value = value[:]
                 setattr(self, field, value)
-        setattr(self, '_initial_state', deepcopy(self.to_dict(self.FIELDS)))
+        self._save_initial_state()
+
+    def _save_initial_state(self):
+        if self._read_only:
+            state = None
+        else:
+            state = copy_state(self.to_dict(self.FIELDS, include_restricted=True))
+        setattr(self, '_initial_state', state)
+
+    def get_changes(self):
+        """
+        get_changes compares the object with the state it had been loaded or saved in
+        and returns a tuple (changed, removed) where changed is a dict of modified fields
+        and removed is a list of fields which are not set anymore
+        """
+        current = self.to_dict(self.FIELDS, include_restricted=True)
+        changed = {}
+        for field, value in current.iteritems():
+            if field == "_id":
+                continue
+            if field not in self._initial_state:
+                changed[field] = value
+                continue
+            initial = self._initial_state[field]
+            # 1 == 1.0 == True in python but not in mongo
+            if value != initial or type(value) != type(initial):
+                changed[field] = value
+        removed = [x for x in self._initial_state if x not in current and x != "_id"]
+        return changed, removed
+
+    @property
+    def is_dirty(self):
+        changed, removed = self.get_changes()
+        return len(changed) + len(removed) > 0
+
+    @property
+    def is_read_only(self):
+        return self._read_only
 
     def save(self, skip_callback=False):
         from library.db import db
+        if self._read_only:
+            raise ReadOnlyObject("%s has been loaded as a read-only object" % self.__class__.__name__)
         for field in self.missing_fields:
             raise FieldRequired(field)
         if not skip_callback:
             self._before_save()
         db.save_obj(self)
-        setattr(self, '_initial_state', deepcopy(self.to_dict(self.FIELDS)))
+        if not skip_callback:
+            self._after_save()
+        self._save_initial_state()
+        identity_map.add(self)
         return self
 
+    @classmethod
+    def save_many(cls, objs, skip_callback=False):
+        """
+        save_many saves a list of objects of the class with a single unordered bulk write.
+        Callbacks are run via _before_save_many and _after_save_many which may be overriden
+        to share lookups and writes between objects. Objects failed to be validated or written are skipped,
+        returns a list of (obj, error) tuples for them
+        """
+        from library.db import db
+
+        failed = []
+        valid = []
+        for obj in objs:
+            missing_fields = obj.missing_fields
+            if obj.is_read_only:
+                failed.append((obj, ReadOnlyObject("%s has been loaded as a read-only object" % cls.__name__)))
+            elif len(missing_fields) > 0:
+                failed.append((obj, FieldRequired(missing_fields[0])))
+            else:
+                valid.append(obj)
+
+        if not skip_callback:
+            callback_failed = cls._before_save_many(valid)
+            failed_ids = set([id(x[0]) for x in callback_failed])
+            valid = [x for x in valid if id(x) not in failed_ids]
+            failed += callback_failed
+
+        write_failed = db.save_objs(valid)
+        failed_ids = set([id(x[0]) for x in write_failed])
+        failed += write_failed
+
+        saved = [x for x in valid if id(x) not in failed_ids]
+        if not skip_callback:
+            cls._after_save_many(saved)
+        for obj in saved:
+            obj._save_initial_state()
+            identity_map.add(obj)
+        return failed
+
     def update(self, data, skip_callback=False):
         for field in self.FIELDS:
             if field in data and field not in self.REJECTED_FIELDS and field != "_id":
@@ -110,15 +232,56 @@ class StorableModel(object):
         if not skip_callback:
             self._before_delete()
         db.delete_obj(self)
+        identity_map.discard(self.collection, self._id)
+        if self.TOMBSTONES:
+            from app.models.tombstone import Tombstone
+            Tombstone.record(self.__class__, [self._id])
+        if not skip_callback:
+            self._after_delete()
         self._id = None
         return self
 
     def _before_save(self):
         pass
 
+    def _after_save(self):
+        pass
+
+    @classmethod
+    def _before_save_many(cls, objs):
+        # runs _before_save for every object of a batch, returns a list
+        # of (obj, error) tuples for objects failed to be validated
+        failed = []
+        for obj in objs:
+            try:
+                obj._before_save()
+            except ApiError as e:
+                failed.append((obj, e))
+        return failed
+
+    @classmethod
+    def _after_save_many(cls, objs):
+        # runs _after_save for every saved object of a batch
+        for obj in objs:
+            obj._after_save()
+
     def _before_delete(self):
         pass
 
+    def _after_delete(self):
+        pass
+
+    def _cache_identity(self):
+        """
+        _cache_identity returns a compact hashable representation of the object used in cache
+        keys instead of its full repr. Saved objects are identified by their _id and version,
+        i.e. the optimistic lock field or updated_at, new objects by their whole state
+        """
+        if self.is_new:
+            return self.__class__.__name__, None, freeze(self.to_dict(self.FIELDS, include_restricted=True))
+        version_field = self.OPTIMISTIC_LOCK_FIELD or "updated_at"
+        return self.__class__.__name__, self._id, getattr(self, version_field, None)
+
     def __repr__(self):
         attributes = ["%s=%r" % (a, getattr(self, a))
                       for a in list(self.FIELDS)]
@@ -165,13 +328,24 @@ class StorableModel(object):
         result = dict(dict_data)
         return result
 
+    def _set_stored_fields(self, values):
+        # applies values written to the db bypassing the object, i.e. by a bulk
+        # write, so they don't count as changes of the object
+        for field, value in values.items():
+            setattr(self, field, value)
+            if self._initial_state is not None:
+                self._initial_state[field] = copy_state(value)
+
     def reload(self):
-        tmp = self.__class__.find_one({ "_id": self._id })
+        from library.db import db
+        # the stored object is read bypassing the request cache and the identity map
+        tmp = db.get_obj(self.__class__, self.collection, { "_id": self._id })
         for field in self.FIELDS:
             if field == "_id":
                 continue
             value = getattr(tmp, field)
             setattr(self, field, value)
+        self._save_initial_state()
         return self
 
     @property
@@ -195,17 +369,123 @@ class StorableModel(object):
                 mfields.append(field)
         return mfields
 
+    @classmethod
+    def get_projection(cls, fields):
+        """
+        get_projection returns a list of stored fields required to render the given
+        fields, either stored or computed ones declared in FIELD_DEPENDENCIES.
+        Returns None if fields is None or some of the fields are unknown
+        """
+        if fields is None:
+            return None
+        projection = set(["_id"])
+        if cls.KEY_FIELD is not None:
+            projection.add(cls.KEY_FIELD)
+        for field in fields:
+            if field in cls.FIELDS:
+                projection.add(field)
+            elif field in cls.FIELD_DEPENDENCIES:
+                projection.update(cls.FIELD_DEPENDENCIES[field])
+            else:
+                return None
+        return sorted(projection)
+
+    @classmethod
+    def get_relations(cls, fields):
+        """
+        get_relations returns a list of relations to prefetch to render the given fields
+        """
+        if fields is None:
+            return []
+        relations = set()
+        for field in fields:
+            relations.update(cls.FIELD_RELATIONS.get(field, []))
+        return sorted(relations)
+
+    @classmethod
+    def prefetch(cls, objs, relations):
+        """
+        prefetch loads related objects for a batch of objects with a single query per relation
+        and wires them into the objects so properties decorated with relation() don't query
+        the database one object at a time. Relations are named as in RELATIONS, nested ones
+        are joined with dots, i.e. "group.work_group"
+        """
+        import importlib
+        models = importlib.import_module("app.models")
+
+        nested = {}
+        for relation in relations:
+            name, _, rest = relation.partition(".")
+            nested.setdefault(name, [])
+            if rest:
+                nested[name].append(rest)
+
+        for name, sub_relations in nested.iteritems():
+            id_field, class_name = cls.RELATIONS[name]
+            related_class = getattr(models, class_name)
+            ids = set([getattr(x, id_field, None) for x in objs])
+            ids.discard(None)
+            related = {}
+            if len(ids) > 0:
+                read_only = all([x.is_read_only for x in objs])
+                related_objs = related_class.find_by_ids(list(ids), read_only=read_only)
+                if len(sub_relations) > 0:
+                    related_class.prefetch(related_objs, sub_relations)
+                related = dict([(x._id, x) for x in related_objs])
+            for obj in objs:
+                if not hasattr(obj, id_field):
+                    # partial object loaded without the id field
+                    continue
+                related_id = getattr(obj, id_field)
+                if getattr(obj, "_prefetched", None) is None:
+                    obj._prefetched = {}
+                obj._prefetched[name] = (related_id, related.get(related_id))
+
     @classmethod
     @request_time_cache()
-    def find(cls, query={}, **kwargs):
+    def find(cls, query={}, read_only=False, fields=None, **kwargs):
+        # objects loaded with fields given are partial and read-only
         from library.db import db
-        return db.get_objs(cls, cls.collection, query, **kwargs)
+        projection = cls.get_projection(fields)
+        return db.get_objs(cls, cls.collection, query, read_only=read_only, fields=projection, **kwargs)
 
     @classmethod
     @request_time_cache()
-    def find_one(cls, query, **kwargs):
+    def find_one(cls, query, read_only=False, fields=None, **kwargs):
         from library.db import db
-        return db.get_obj(cls, cls.collection, query, **kwargs)
+        projection = cls.get_projection(fields)
+        # complete objects looked up by id go through the identity map
+        by_id = projection is None and len(kwargs) == 0 and query.keys() == ["_id"] and \
+            isinstance(query["_id"], ObjectId)
+        if by_id:
+            obj = identity_map.get(cls.collection, query["_id"], read_only)
+            if obj is not None:
+                return obj
+        obj = db.get_obj(cls, cls.collection, query, read_only=read_only, fields=projection, **kwargs)
+        if by_id and obj is not None:
+            identity_map.add(obj)
+        return obj
+
+    @classmethod
+    def find_by_ids(cls, ids, read_only=False):
+        """
+        find_by_ids returns a list of complete objects with the given ids in the order of ids,
+        objects loaded during the request already are taken from the identity map and only
+        the rest of them are queried. Ids of objects which don't exist are skipped
+        """
+        objs = {}
+        missing = []
+        for obj_id in ids:
+            obj = identity_map.get(cls.collection, obj_id, read_only)
+            if obj is None:
+                missing.append(obj_id)
+            else:
+                objs[obj_id] = obj
+        if len(missing) > 0:
+            for obj in cls.find({"_id": {"$in": missing}}, read_only=read_only):
+                identity_map.add(obj)
+                objs[obj._id] = obj
+        return [objs[x] for x in ids if x in objs]
 
     @classmethod
     def get(cls, expression, raise_if_none=None):
@@ -237,7 +517,13 @@ class StorableModel(object):
     @classmethod
     def destroy_many(cls, query):
         from library.db import db
-        db.delete_query(cls.collection, query)
+        if cls.TOMBSTONES:
+            from app.models.tombstone import Tombstone
+            obj_ids = [x._id for x in cls.find(query, fields=["_id"])]
+            db.delete_query(cls.collection, {"_id": {"$in": obj_ids}})
+            Tombstone.record(cls, obj_ids)
+        else:
+            db.delete_query(cls.collection, query)
 
     @classmethod
     def update_many(cls, query, attrs):
@@ -248,63 +534,37 @@ class StorableModel(object):
         db.update_query(cls.collection, query, attrs)
 
     @classmethod
-    def ensure_indexes(cls, loud=False, overwrite=False):
-
-        if type(cls.INDEXES) != list and type(cls.INDEXES) != tuple:
-            raise TypeError("INDEXES field must be of type list or tuple")
-
-        from pymongo import ASCENDING, DESCENDING, HASHED
-        from pymongo.errors import OperationFailure
-        from library.db import db
-        from app import app
+    def get_indexes(cls):
+        # may be overriden to build indexes depending on the configuration, i.e. TTL ones
+        return cls.INDEXES
 
-        def parse(key):
-            if key.startswith("-"):
-                key = key[1:]
-                order = DESCENDING
-            elif key.startswith("#"):
-                key = key[1:]
-                order = HASHED
-            else:
-                order = ASCENDING
-                if key.startswith("+"):
-                    key = key[1:]
-            return (key, order)
-
-        for index in cls.INDEXES:
-            if type(index) == str:
-                index = [index]
-            keys = []
-            options = { "sparse": False }
-
-            for subindex in index:
-                if type(subindex) == str:
-                    keys.append(parse(subindex))
-                else:
-                    for key, value in subindex.items():
-                        options[key] = value
-            if loud:
-                app.logger.debug("Creating index with options: %s, %s" % (keys, options))
-
-            try:
-                db.conn[cls.collection].create_index(keys, **options)
-            except OperationFailure as e:
-                if e.details.get("codeName") == "IndexOptionsConflict" or e.details.get("code") == 85:
-                    if overwrite:
-                        if loud:
-                            app.logger.debug("Dropping index %s as conflicting" % keys)
-                        db.conn[cls.collection].drop_index(keys)
-                        if loud:
-                            app.logger.debug("Creating index with options: %s, %s" % (keys, options))
-                        db.conn[cls.collection].create_index(keys, **options)
-                    else:
-                        app.logger.error("Index %s conflicts with exising one, use overwrite param to fix it" % keys)
+    @classmethod
+    def ensure_indexes(cls, loud=False, overwrite=False):
+        ensure_collection_indexes(cls.collection, cls.get_indexes(), loud, overwrite)
 
     @property
     def __dict__(self):
         return dict([x for x in self.to_dict(self.FIELDS).iteritems() if x[1] is not None])
 
 
+def relation(name):
+    """
+    relation decorator makes a relation property return the object wired by
+    StorableModel.prefetch() if the id field hasn't been changed since
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self):
+            prefetched = getattr(self, "_prefetched", None)
+            if prefetched is not None and name in prefetched:
+                related_id, related = prefetched[name]
+                if related_id == getattr(self, self.RELATIONS[name][0], None):
+                    return related
+            return func(self)
+        return wrapper
+    return decorator
+
+
 def save_required(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
@@ -313,3 +573,59 @@ def save_required(func):
             raise ObjectSaveRequired("This object must be saved first")
         return func(*args, **kwargs)
     return wrapper
+
+
+def ensure_collection_indexes(collection, indexes, loud=False, overwrite=False):
+    """
+    ensure_collection_indexes creates indexes given in the INDEXES format (see StorableModel)
+    in the collection. Conflicting indexes are recreated if overwrite is set
+    """
+    if type(indexes) != list and type(indexes) != tuple:
+        raise TypeError("INDEXES field must be of type list or tuple")
+
+    from pymongo import ASCENDING, DESCENDING, HASHED
+    from pymongo.errors import OperationFailure
+    from library.db import db
+    from app import app
+
+    def parse(key):
+        if key.startswith("-"):
+            key = key[1:]
+            order = DESCENDING
+        elif key.startswith("#"):
+            key = key[1:]
+            order = HASHED
+        else:
+            order = ASCENDING
+            if key.startswith("+"):
+                key = key[1:]
+        return (key, order)
+
+    for index in indexes:
+        if type(index) == str:
+            index = [index]
+        keys = []
+        options = { "sparse": False }
+
+        for subindex in index:
+            if type(subindex) == str:
+                keys.append(parse(subindex))
+            else:
+                for key, value in subindex.items():
+                    options[key] = value
+        if loud:
+            app.logger.debug("Creating index with options: %s, %s" % (keys, options))
+
+        try:
+            db.conn[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            if e.details.get("codeName") == "IndexOptionsConflict" or e.details.get("code") == 85:
+                if overwrite:
+                    if loud:
+                        app.logger.debug("Dropping index %s as conflicting" % keys)
+                    db.conn[collection].drop_index(keys)
+                    if loud:
+                        app.logger.debug("Creating index with options: %s, %s" % (keys, options))
+                    db.conn[collection].create_index(keys, **options)
+                else:
+                    app.logger.error("Index %s conflicts with exising one, use overwrite param to fix it" % keys)
@@ -1,6 +1,9 @@
 from storable_model import StorableModel, now
 from library.engine.utils import uuid4_string
+from library.engine.cache import get_generation, new_generation, DEFAULT_CACHE_TIMEOUT
+from library.engine.metrics import count_cache_request
 from datetime import datetime, timedelta
+from hashlib import sha1
 
 
 class Token(StorableModel):
@@ -35,10 +38,85 @@ class Token(StorableModel):
         ["user_id", "type"]
     )
 
+    @classmethod
+    def get_indexes(cls):
+        # expired tokens are removed by mongodb, expired() still has to be checked
+        # as the removal runs once a minute
+        from app import app
+        if app.auth_token_ttl is None:
+            return cls.INDEXES
+        ttl = int(app.auth_token_ttl.total_seconds())
+        return list(cls.INDEXES) + [["created_at", {"expireAfterSeconds": ttl}]]
+
     @property
     def user(self):
         return self.user_class.find_one({"_id": self.user_id})
 
+    @classmethod
+    def find_user(cls, token):
+        """
+        find_user returns the user authenticated by the token string or None if the token
+        doesn't exist or has expired. The user is always read from the db so that changes
+        made by other workers are seen right away, tokens are resolved to user ids via
+        app.local_cache and app.cache if the cache is shared between workers (memcached).
+        The entries are dropped on any save or deletion of the user's tokens via
+        the user's generation
+        """
+        from app import app
+        if not app.cache_shared:
+            # a per-process cache can't be invalidated by other workers
+            token = cls.find_one({"token": token})
+            if token is None or token.expired():
+                return None
+            return token.user
+
+        # tokens come from request headers, hashing makes them safe to use
+        # in memcached keys and keeps them out of the cache
+        cache_key = "Token.%s.user_id" % sha1(token.encode("utf-8")).hexdigest()
+        entry = app.local_cache.get(cache_key)
+        if entry is None:
+            entry = app.cache.get(cache_key)
+            if entry is not None:
+                app.local_cache.set(cache_key, entry)
+
+        if entry is not None:
+            user_id, expires_at, generation = entry
+            if generation is not None and generation == get_generation("User", user_id):
+                count_cache_request("token", "hit")
+                if expires_at is not None and expires_at < now():
+                    return None
+                return cls._user_by_id(user_id)
+
+        count_cache_request("token", "miss")
+        token = cls.find_one({"token": token})
+        if token is None or token.expired():
+            return None
+        # the generation is taken before the entry is built so any change
+        # of the user's tokens made in between makes the entry outdated right away
+        generation = get_generation("User", token.user_id)
+
+        expires_at = None
+        timeout = DEFAULT_CACHE_TIMEOUT
+        if app.auth_token_ttl is not None:
+            expires_at = token.created_at + app.auth_token_ttl
+            timeout = min(timeout, int((expires_at - now()).total_seconds()) + 1)
+        entry = (token.user_id, expires_at, generation)
+        app.cache.set(cache_key, entry, timeout=timeout)
+        app.local_cache.set(cache_key, entry)
+        return cls._user_by_id(token.user_id)
+
+    @classmethod
+    def _user_by_id(cls, user_id):
+        from app.models import User
+        return User.find_one({"_id": user_id})
+
+    def _after_save(self):
+        # tokens are resolved to users via the cache, see find_user
+        new_generation("User", self.user_id)
+
+    def _after_delete(self):
+        new_generation("User", self.user_id)
+
     @property
     def user_class(self):
         if self._user_class is None:
@@ -0,0 +1,60 @@
+from storable_model import StorableModel, now
+
+# tombstones are kept this long, clients syncing from an older token get the full data
+TOMBSTONE_TTL = 7 * 86400
+
+
+class Tombstone(StorableModel):
+    """
+    Tombstone records a deletion of an object of a model with TOMBSTONES set
+    so the deletion can be passed to clients syncing incrementally. Objects moved
+    out of a work group get tombstones with the work_group_id they have left
+    """
+
+    FIELDS = (
+        "_id",
+        "model",
+        "obj_id",
+        "work_group_id",
+        "deleted_at",
+    )
+
+    REQUIRED_FIELDS = (
+        "model",
+        "obj_id",
+        "deleted_at",
+    )
+
+    DEFAULTS = {
+        "deleted_at": now,
+    }
+
+    INDEXES = (
+        ["model", "deleted_at"],
+        ["deleted_at", {"expireAfterSeconds": TOMBSTONE_TTL}],
+    )
+
+    __slots__ = list(FIELDS)
+
+    @classmethod
+    def record(cls, model, obj_ids):
+        deleted_at = now()
+        cls.save_many([cls(model=model.__name__, obj_id=x, deleted_at=deleted_at) for x in obj_ids])
+
+    @classmethod
+    def record_moves(cls, model, moves):
+        # moves is a list of (obj_id, work_group_id) tuples of objects and work groups they have left
+        moved_at = now()
+        cls.save_many([cls(model=model.__name__, obj_id=x, work_group_id=y, deleted_at=moved_at)
+                       for x, y in moves])
+
+    @classmethod
+    def deleted_ids(cls, model, since):
+        query = {"model": model.__name__, "work_group_id": None, "deleted_at": {"$gte": since}}
+        return [x.obj_id for x in cls.find(query, fields=["obj_id"])]
+
+    @classmethod
+    def moved_ids(cls, model, work_group_ids, since):
+        # objects which have left any of the work groups, they may have moved back since then
+        query = {"model": model.__name__, "work_group_id": {"$in": work_group_ids}, "deleted_at": {"$gte": since}}
+        return list(set([x.obj_id for x in cls.find(query, fields=["obj_id"])]))
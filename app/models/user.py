@@ -189,12 +189,10 @@ class User(StorableModel):
         tokens = self.token_class.find({"type": "auth", "user_id": self._id})
         suitable_token = None
         for token in tokens:
-            if token.expired():
-                token.destroy()
-            elif token.close_to_expiration():
+            # expired tokens are left to the TTL index, see Token.get_indexes
+            if token.expired() or token.close_to_expiration():
                 continue
-            else:
-                suitable_token = token
+            suitable_token = token
         if suitable_token is None:
             suitable_token = self.token_class(type="auth", user_id=self._id)
             suitable_token.save()
@@ -1,4 +1,5 @@
-from app.models.storable_model import StorableModel, now
+from app.models.storable_model import StorableModel, now, relation
+from app.models.inventory_generation import InventoryGeneration
 from library.engine.permissions import get_user_from_app_context
 from library.engine.utils import check_lists_are_equal
 
@@ -55,9 +56,22 @@ class WorkGroup(StorableModel):
     INDEXES = [
         [ "name", { "unique": True } ],
         "member_ids",
-        "owner_id"
+        "owner_id",
+        "updated_at",
     ]
 
+    TOMBSTONES = True
+
+    RELATIONS = {
+        "owner": ("owner_id", "User"),
+    }
+
+    FIELD_RELATIONS = {
+        "owner_name": ["owner"],
+        "modification_allowed": ["owner"],
+        "member_list_modification_allowed": ["owner"],
+    }
+
     __slots__ = FIELDS
 
     @property
@@ -68,6 +82,7 @@ class WorkGroup(StorableModel):
         return self._owner_class
 
     @property
+    @relation("owner")
     def owner(self):
         return self.owner_class.find_one({"_id": self.owner_id})
 
@@ -137,12 +152,23 @@ class WorkGroup(StorableModel):
                 not check_lists_are_equal(self.member_ids, self._initial_state.get("member_ids")):
             self.reset_responsibles_cache()
 
+    def _after_save(self):
+        if self._initial_state.get("_id") is None or self.is_dirty:
+            InventoryGeneration.touch(work_group_names=[self.name, self._initial_state.get("name")])
+
+    def _after_delete(self):
+        InventoryGeneration.touch(work_group_names=[self.name])
+
     def touch(self):
         self.updated_at = now()
 
     def reset_responsibles_cache(self):
+        responsibles = self.participant_usernames
         for group in self.groups:
-            group.reset_responsibles_cache(self.participant_usernames)
+            group.reset_responsibles_cache(responsibles)
+            # groups are touched so the clients syncing incrementally get them
+            # and their hosts with the new responsibles
+            group.touch()
             group.save(skip_callback=True)
 
     def _before_delete(self):
@@ -5,6 +5,7 @@ from app.tests.models.test_work_group_model import TestWorkGroupModel
 from app.tests.models.test_storable_model import TestStorableModel
 from app.tests.models.test_network_group_model import TestNetworkGroupModel
 from app.tests.models.test_user_model import TestUserModel
+from app.tests.models.test_tombstone_model import TestTombstoneModel
 
 from app.tests.httpapi.test_account_ctrl import TestAccountCtrl
 from app.tests.httpapi.test_group_ctrl import TestGroupCtrl
@@ -12,9 +13,18 @@ from app.tests.httpapi.test_host_ctrl import TestHostCtrl
 from app.tests.httpapi.test_user_ctrl import TestUserCtrl
 from app.tests.httpapi.test_datacenter_ctrl import TestDatacenterCtrl
 from app.tests.httpapi.test_network_group_ctrl import TestNetworkGroupCtrl
+from app.tests.httpapi.test_metrics_ctrl import TestMetricsCtrl
+from app.tests.httpapi.test_open_ctrl import TestOpenCtrl
 
 from app.tests.utils.test_pbkdf2 import TestPBKDF2
 from app.tests.utils.test_diff import TestDiff
 from app.tests.utils.test_permutation import TestPermutation
 from app.tests.utils.test_ownership import TestOwnership
 from app.tests.utils.test_merge import TestMerge
+from app.tests.utils.test_graph import TestGraph
+from app.tests.utils.test_stream import TestStream
+from app.tests.utils.test_cache import TestCache
+from app.tests.utils.test_profiler import TestProfiler
+from app.tests.utils.test_retry import TestRetry
+from app.tests.utils.test_read_preference import TestReadPreference
+from app.tests.utils.test_action_log import TestActionLog
@@ -23,4 +23,62 @@ class TestAccountCtrl(HttpApiTestCase):
         body = body["data"]
         self.assertIn("_id", body)
         self.assertIn("username", body)
-        self.assertEqual(body["username"], TestAccountCtrl.SUPERVISOR["username"])
\ No newline at end of file
+        self.assertEqual(body["username"], TestAccountCtrl.SUPERVISOR["username"])
+
+    def test_session_persistence(self):
+        client = self.fake_client
+        r = client.post("/api/v1/account/authenticate", data=json.dumps(self.SUPERVISOR), headers={ "Content-Type": "application/json" })
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("Set-Cookie", r.headers)
+
+        # the session hasn't changed so it's not written again
+        r = client.get("/api/v1/account/me")
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn("Set-Cookie", r.headers)
+
+        r = client.post("/api/v1/account/logout")
+        self.assertEqual(r.status_code, 200)
+        r = client.get("/api/v1/account/me")
+        self.assertEqual(r.status_code, 403)
+
+    def test_session_refresh(self):
+        from app import app
+        from library.db import db
+        from datetime import datetime, timedelta
+        lifetime = app.flask.permanent_session_lifetime
+        # the refresh interval is capped by the session lifetime
+        app.flask.permanent_session_lifetime = timedelta(seconds=60)
+        try:
+            client = self.fake_client
+            r = client.post("/api/v1/account/authenticate", data=json.dumps(self.SUPERVISOR), headers={ "Content-Type": "application/json" })
+            self.assertEqual(r.status_code, 200)
+            r = client.get("/api/v1/account/me")
+            self.assertNotIn("Set-Cookie", r.headers)
+
+            # more than half of the lifetime has passed since the last write
+            db.conn["sessions"].update_many({}, {"$set": {"expiration": datetime.utcnow() + timedelta(seconds=20)}})
+            r = client.get("/api/v1/account/me")
+            self.assertEqual(r.status_code, 200)
+            self.assertIn("Set-Cookie", r.headers)
+        finally:
+            app.flask.permanent_session_lifetime = lifetime
+
+    def test_stale_session_cookie(self):
+        from app import app
+        client = self.fake_client
+        # anonymous requests without a cookie don't get one
+        r = client.get("/api/v1/account/me")
+        self.assertEqual(r.status_code, 403)
+        self.assertNotIn("Set-Cookie", r.headers)
+
+        # a cookie of a session which doesn't exist anymore is removed
+        client.set_cookie("localhost", app.flask.session_cookie_name, "unknown-sid")
+        r = client.get("/api/v1/account/me")
+        self.assertEqual(r.status_code, 403)
+        self.assertIn("Set-Cookie", r.headers)
+        self.assertIn("%s=;" % app.flask.session_cookie_name, r.headers["Set-Cookie"])
+
+    def test_token_requests_skip_session(self):
+        r = self.get("/api/v1/account/me")
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn("Set-Cookie", r.headers)
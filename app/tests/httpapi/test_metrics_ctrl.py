@@ -0,0 +1,18 @@
+from httpapi_testcase import HttpApiTestCase
+
+
+class TestMetricsCtrl(HttpApiTestCase):
+
+    def test_metrics(self):
+        self.get("/api/v1/account/me")
+        r = self.fake_client.get("/metrics")
+        self.assertEqual(200, r.status_code)
+        # /api/v1/account is served by the "auth" blueprint
+        self.assertIn('inventoree_http_request_duration_seconds_count{blueprint="auth"', r.data)
+        self.assertIn('inventoree_cache_requests_total{cache="request"', r.data)
+        self.assertIn("inventoree_mongo_command_duration_seconds_count", r.data)
+
+    def test_metrics_forbidden(self):
+        r = self.fake_client.get("/metrics", environ_base={"REMOTE_ADDR": "10.1.2.3"})
+        self.assertEqual(403, r.status_code)
+        self.assertNotIn("inventoree_http_request_duration_seconds", r.data)
@@ -0,0 +1,227 @@
+from httpapi_testcase import HttpApiTestCase
+from datetime import timedelta
+from flask import json
+from app.models import Datacenter, WorkGroup, Group, Host, Tombstone, InventoryGeneration
+from app.models.storable_model import now
+from app import app
+from app.controllers.api.v1.open import sync_token, parse_sync_token, SYNC_TOKEN_HEADER
+
+SYNC_URL = "/api/v1/open/executer_data?since=%s"
+
+
+class TestOpenCtrl(HttpApiTestCase):
+
+    def setUp(self):
+        Datacenter.destroy_all()
+        Group.destroy_all()
+        Host.destroy_all()
+        Tombstone.destroy_all()
+
+        self.dc = Datacenter(name="dc1")
+        self.dc.save()
+        self.group1 = Group(name="group1", work_group_id=self.work_group1._id)
+        self.group1.save()
+        self.group2 = Group(name="group2", work_group_id=self.work_group2._id)
+        self.group2.save()
+        self.host1 = Host(fqdn="host1.example.com", group_id=self.group1._id)
+        self.host1.save()
+        self.host2 = Host(fqdn="host2.example.com", group_id=self.group1._id)
+        self.host2.save()
+        self.host3 = Host(fqdn="host3.example.com", group_id=self.group2._id)
+        self.host3.save()
+
+        # everything has been changed long before the sync token
+        changed_at = now() - timedelta(hours=1)
+        for model in (Datacenter, WorkGroup, Group, Host):
+            model.update_many({}, {"$set": {"updated_at": changed_at}})
+        self.token = sync_token(now() - timedelta(minutes=30))
+
+    def tearDown(self):
+        Datacenter.destroy_all()
+        Group.destroy_all()
+        Host.destroy_all()
+        Tombstone.destroy_all()
+
+    def test_executer_data_full(self):
+        r = self.get("/api/v1/open/executer_data")
+        self.assertEqual(200, r.status_code)
+        self.assertIn(SYNC_TOKEN_HEADER, r.headers)
+        data = json.loads(r.data)
+        self.assertTrue(data["full"])
+        self.assertEqual(3, len(data["data"]["hosts"]))
+
+    def test_executer_data_cached_token(self):
+        url = "/api/v1/open/executer_data?work_groups=Test%20WorkGroup%201"
+        r = self.fake_client.get(url)
+        token = parse_sync_token(r.headers[SYNC_TOKEN_HEADER])
+        cached = self.fake_client.get(url)
+        self.assertEqual(r.data, cached.data)
+        # cached responses get a token of their own
+        self.assertGreaterEqual(parse_sync_token(cached.headers[SYNC_TOKEN_HEADER]), token)
+        self.assertNotIn("token", json.loads(cached.data))
+
+    def test_executer_data_outdated_token(self):
+        token = sync_token(now() - timedelta(days=30))
+        data = self.get_json_data_should_be_successful(SYNC_URL % token)
+        self.assertTrue(data["full"])
+        self.assertEqual(3, len(data["data"]["hosts"]))
+
+    def test_executer_data_invalid_token(self):
+        r = self.get(SYNC_URL % "invalid")
+        self.assertEqual(400, r.status_code)
+
+    def test_executer_data_changes(self):
+        host1 = Host.get(self.host1._id)
+        host1.tags = ["changed"]
+        host1.save()
+        Host.get(self.host2._id).destroy()
+
+        data = self.get_json_data_should_be_successful(SYNC_URL % self.token)
+        self.assertFalse(data["full"])
+        data = data["data"]
+        self.assertListEqual(["host1.example.com"], [x["fqdn"] for x in data["hosts"]])
+        self.assertListEqual([str(self.host2._id)], data["deleted"]["hosts"])
+        self.assertListEqual([], data["groups"])
+        self.assertListEqual([], data["work_groups"])
+        self.assertListEqual([], data["datacenters"])
+
+    def test_executer_data_group_changes(self):
+        group1 = Group.get(self.group1._id)
+        group1.tags = ["changed"]
+        group1.save()
+
+        # hosts of changed groups are returned as their inherited fields are updated
+        data = self.get_json_data_should_be_successful(SYNC_URL % self.token + "&recursive=true")
+        data = data["data"]
+        self.assertListEqual(["group1"], [x["name"] for x in data["groups"]])
+        self.assertItemsEqual(["host1.example.com", "host2.example.com"], [x["fqdn"] for x in data["hosts"]])
+        for host in data["hosts"]:
+            self.assertIn("changed", host["all_tags"])
+
+    def test_executer_data_responsibles_changes(self):
+        work_group = WorkGroup.get(self.work_group1._id)
+        work_group.add_member(self.user)
+        try:
+            data = self.get_json_data_should_be_successful(SYNC_URL % self.token + "&work_groups=Test%20WorkGroup%201")
+            data = data["data"]
+            self.assertListEqual(["group1"], [x["name"] for x in data["groups"]])
+            self.assertItemsEqual(["host1.example.com", "host2.example.com"], [x["fqdn"] for x in data["hosts"]])
+            for item in data["groups"] + data["hosts"]:
+                self.assertIn(self.user.username, item["responsibles_usernames_cache"])
+        finally:
+            work_group.remove_member(self.user)
+
+    def test_executer_data_moved(self):
+        host1 = Host.get(self.host1._id)
+        host1.group_id = self.group2._id
+        host1.save()
+
+        # hosts moved out of the requested work groups are reported as deleted
+        data = self.get_json_data_should_be_successful(SYNC_URL % self.token + "&work_groups=Test%20WorkGroup%201")
+        data = data["data"]
+        self.assertListEqual([], data["hosts"])
+        self.assertListEqual([str(self.host1._id)], data["deleted"]["hosts"])
+
+    def test_executer_data_mass_move(self):
+        group2 = Group.get(self.group2._id)
+        group2.tags = ["changed"]
+        group2.save()
+        payload = {"group_ids": [str(self.group1._id)], "work_group_id": str(self.work_group2._id)}
+        r = self.post_json("/api/v1/groups/mass_move", payload)
+        self.assertEqual(200, r.status_code)
+
+        # the moved group and its hosts are removed from the work group they've left,
+        # unrelated changes of the target work group are not reported there
+        data = self.get_json_data_should_be_successful(SYNC_URL % self.token + "&work_groups=Test%20WorkGroup%201")
+        data = data["data"]
+        self.assertListEqual([], data["groups"])
+        self.assertListEqual([], data["hosts"])
+        self.assertListEqual([str(self.group1._id)], data["deleted"]["groups"])
+        self.assertItemsEqual([str(self.host1._id), str(self.host2._id)], data["deleted"]["hosts"])
+
+        # and returned as changed in the target work group
+        data = self.get_json_data_should_be_successful(SYNC_URL % self.token + "&work_groups=Test%20WorkGroup%202")
+        data = data["data"]
+        self.assertItemsEqual(["group1", "group2"], [x["name"] for x in data["groups"]])
+        self.assertItemsEqual(["host1.example.com", "host2.example.com", "host3.example.com"],
+                              [x["fqdn"] for x in data["hosts"]])
+        self.assertListEqual([], data["deleted"]["groups"])
+        self.assertListEqual([], data["deleted"]["hosts"])
+
+        # hosts are touched so their changes are seen by the clients syncing hosts only
+        host1 = Host.get(self.host1._id)
+        self.assertGreater(host1.updated_at, now() - timedelta(minutes=1))
+
+    def test_executer_data_etag(self):
+        url = "/api/v1/open/executer_data?work_groups=Test%20WorkGroup%201"
+        r = self.fake_client.get(url)
+        self.assertEqual(200, r.status_code)
+        etag = r.headers["ETag"]
+        self.assertIn("Last-Modified", r.headers)
+
+        r = self.fake_client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(304, r.status_code)
+        self.assertEqual("", r.data)
+
+        # changes of other work groups don't affect the response
+        host3 = Host.get(self.host3._id)
+        host3.tags = ["changed"]
+        host3.save()
+        r = self.fake_client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(304, r.status_code)
+
+        host1 = Host.get(self.host1._id)
+        host1.tags = ["changed"]
+        host1.save()
+        r = self.fake_client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(200, r.status_code)
+        self.assertNotEqual(etag, r.headers["ETag"])
+
+    def test_executer_data_etag_datacenters(self):
+        url = "/api/v1/open/executer_data?work_groups=Test%20WorkGroup%201"
+        etag = self.fake_client.get(url).headers["ETag"]
+        dc = Datacenter.get(self.dc._id)
+        dc.description = "changed"
+        dc.save()
+        r = self.fake_client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(200, r.status_code)
+
+    def test_mass_delete_etag(self):
+        url = "/api/v1/open/executer_data?work_groups=Test%20WorkGroup%201"
+        etag = self.fake_client.get(url).headers["ETag"]
+        r = self.post_json("/api/v1/hosts/mass_delete", {"host_ids": [str(self.host2._id)]})
+        self.assertEqual(200, r.status_code)
+        r = self.fake_client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(200, r.status_code)
+
+    def test_rendered_cache(self):
+        url = "/api/v1/open/executer_data?work_groups=Test%20WorkGroup%201"
+        r = self.fake_client.get(url)
+        self.assertEqual(200, r.status_code)
+
+        # changes bypassing the callbacks are not seen until the inventory generation changes
+        Host.update_many({"_id": self.host1._id}, {"$set": {"tags": ["uncached"]}})
+        cached = self.fake_client.get(url)
+        self.assertEqual(r.data, cached.data)
+        self.assertEqual(r.headers["Content-Type"], cached.headers["Content-Type"])
+
+        InventoryGeneration.touch(group_ids=[self.group1._id])
+        r = self.fake_client.get(url)
+        hosts = dict([(x["fqdn"], x) for x in json.loads(r.data)["data"]["hosts"]])
+        self.assertListEqual(["uncached"], hosts["host1.example.com"]["tags"])
+
+    def test_rendered_cache_max_size(self):
+        url = "/api/v1/open/executer_data?work_groups=Test%20WorkGroup%201"
+        app.config.cache["RENDER_CACHE_MAX_SIZE"] = 10
+        try:
+            r = self.fake_client.get(url)
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(2, len(json.loads(r.data)["data"]["hosts"]))
+            # the body is too large to be cached so the next response is rendered again
+            Host.update_many({"_id": self.host1._id}, {"$set": {"tags": ["uncached"]}})
+            r = self.fake_client.get(url)
+            hosts = dict([(x["fqdn"], x) for x in json.loads(r.data)["data"]["hosts"]])
+            self.assertListEqual(["uncached"], hosts["host1.example.com"]["tags"])
+        finally:
+            del(app.config.cache["RENDER_CACHE_MAX_SIZE"])
+
@@ -208,6 +208,7 @@ class TestGroupModel(TestCase):
         self.assertItemsEqual(g3.all_custom_fields, TEST_CUSTOM_FIELDS_RIP_RESULT1)
         g2.remove_all_children()
         g2.destroy()
+        g3.reload()
         self.assertItemsEqual(g3.all_custom_fields, TEST_CUSTOM_FIELDS_RIP_G3)
         g1.add_child(g3)
         self.assertItemsEqual(g3.all_custom_fields, TEST_CUSTOM_FIELDS_RIP_RESULT2)
@@ -302,8 +303,220 @@ class TestGroupModel(TestCase):
             }
         )
 
+    def test_custom_data_parents_order(self):
+        gp = Group(name="gp", work_group_id=self.twork_group._id, local_custom_data={"key": "gp"})
+        gp.save()
+        p1 = Group(name="p1", work_group_id=self.twork_group._id, local_custom_data={"p1": 1})
+        p1.save()
+        p2 = Group(name="p2", work_group_id=self.twork_group._id, local_custom_data={"key": "p2"})
+        p2.save()
+        gp.add_child(p1)
+        c1 = Group(name="c1", work_group_id=self.twork_group._id)
+        c1.save()
+        c2 = Group(name="c2", work_group_id=self.twork_group._id)
+        c2.save()
+        c1.add_parent(p1)
+        c1.add_parent(p2)
+        c2.add_parent(p2)
+        c2.add_parent(p1)
+
+        # custom data of the parents is merged in parent_ids order, the latter wins
+        self.assertDictEqual({"key": "p2", "p1": 1}, c1.custom_data)
+        self.assertDictEqual({"key": "gp", "p1": 1}, c2.custom_data)
+
     def test_hosts_of_new_group(self):
         Host(fqdn="host1.example.com").save()
         Host(fqdn="host2.example.com").save()
         g = Group(name="test_group")
         self.assertEqual(g.hosts.count(), 0)
+
+    def test_closure(self):
+        g1 = Group(name="g1", work_group_id=self.twork_group._id)
+        g1.save()
+        g2 = Group(name="g2", work_group_id=self.twork_group._id)
+        g2.save()
+        g3 = Group(name="g3", work_group_id=self.twork_group._id)
+        g3.save()
+        g4 = Group(name="g4", work_group_id=self.twork_group._id)
+        g4.save()
+        g1.add_child(g2)
+        g1.add_child(g3)
+        g2.add_child(g4)
+        g3.add_child(g4)
+
+        g1 = Group.find_one({"_id": g1._id})
+        g4 = Group.find_one({"_id": g4._id})
+        self.assertItemsEqual([g2._id, g3._id, g4._id], g1.descendant_ids)
+        self.assertItemsEqual([g1._id, g2._id, g3._id], g4.ancestor_ids)
+
+        # g4 is still reachable from g1 via g3
+        g2.remove_child(g4)
+        g1 = Group.find_one({"_id": g1._id})
+        g4 = Group.find_one({"_id": g4._id})
+        self.assertItemsEqual([g2._id, g3._id, g4._id], g1.descendant_ids)
+        self.assertItemsEqual([g1._id, g3._id], g4.ancestor_ids)
+
+        g3.remove_parent(g1)
+        g1 = Group.find_one({"_id": g1._id})
+        g4 = Group.find_one({"_id": g4._id})
+        self.assertItemsEqual([g2._id], g1.descendant_ids)
+        self.assertItemsEqual([g3._id], g4.ancestor_ids)
+
+    def test_rebuild_closure(self):
+        g1 = Group(name="g1", work_group_id=self.twork_group._id)
+        g1.save()
+        g2 = Group(name="g2", work_group_id=self.twork_group._id)
+        g2.save()
+        g1.add_child(g2)
+        Group.update_many({}, {"$set": {"ancestor_ids": [], "descendant_ids": []}})
+
+        outdated = Group.rebuild_closure(dry_run=True)
+        self.assertItemsEqual([g1._id, g2._id], outdated.keys())
+        g2 = Group.find_one({"_id": g2._id})
+        self.assertItemsEqual([], g2.ancestor_ids)
+
+        Group.rebuild_closure()
+        g2 = Group.find_one({"_id": g2._id})
+        self.assertItemsEqual([g1._id], g2.ancestor_ids)
+        self.assertEqual(len(Group.rebuild_closure()), 0)
+
+    def test_update_closure_related_only(self):
+        g1 = Group(name="g1", work_group_id=self.twork_group._id)
+        g1.save()
+        g2 = Group(name="g2", work_group_id=self.twork_group._id)
+        g2.save()
+        g3 = Group(name="g3", work_group_id=self.twork_group._id)
+        g3.save()
+        other = Group(name="other", work_group_id=self.twork_group._id)
+        other.save()
+        g1.add_child(g2)
+        # the index of unrelated groups of the work group is neither read nor written
+        Group.update_many({"_id": other._id}, {"$set": {"descendant_ids": [g1._id]}})
+
+        g2.add_child(g3)
+        g1 = Group.find_one({"_id": g1._id})
+        g3 = Group.find_one({"_id": g3._id})
+        self.assertItemsEqual([g2._id, g3._id], g1.descendant_ids)
+        self.assertItemsEqual([g1._id, g2._id], g3.ancestor_ids)
+        # in-memory instances get the written index
+        self.assertListEqual([g1._id], g2.ancestor_ids)
+        self.assertListEqual([g3._id], g2.descendant_ids)
+        self.assertFalse(g2.is_dirty)
+        other = Group.find_one({"_id": other._id})
+        self.assertListEqual([g1._id], other.descendant_ids)
+
+    def test_effective_fields(self):
+        g1 = Group(name="g1", work_group_id=self.twork_group._id, tags=["tag1"],
+                   custom_fields=TEST_CUSTOM_FIELDS_RIP_G1)
+        g1.save()
+        g2 = Group(name="g2", work_group_id=self.twork_group._id, tags=["tag2"],
+                   custom_fields=TEST_CUSTOM_FIELDS_RIP_G2)
+        g2.save()
+        g3 = Group(name="g3", work_group_id=self.twork_group._id, tags=["tag3"],
+                   custom_fields=TEST_CUSTOM_FIELDS_RIP_G3)
+        g3.save()
+        h = Host(fqdn="host.example.com", group_id=g3._id, tags=["tag4"])
+        h.save()
+        g2.add_child(g3)
+        g1.add_child(g2)
+
+        g3 = Group.find_one({"_id": g3._id})
+        self.assertListEqual(["tag1", "tag2", "tag3"], g3.effective_tags)
+        self.assertItemsEqual(TEST_CUSTOM_FIELDS_RIP_RESULT1, g3.effective_custom_fields)
+        h = Host.find_one({"_id": h._id})
+        self.assertListEqual(["tag1", "tag2", "tag3", "tag4"], h.effective_tags)
+        self.assertItemsEqual(TEST_CUSTOM_FIELDS_RIP_RESULT1, h.effective_custom_fields)
+
+        g1 = Group.find_one({"_id": g1._id})
+        g1.remove_tag("tag1")
+        g1.save()
+        h = Host.find_one({"_id": h._id})
+        self.assertListEqual(["tag2", "tag3", "tag4"], h.effective_tags)
+
+        g2 = Group.find_one({"_id": g2._id})
+        g2.remove_all_children()
+        h = Host.find_one({"_id": h._id})
+        self.assertListEqual(["tag3", "tag4"], h.effective_tags)
+        self.assertItemsEqual(TEST_CUSTOM_FIELDS_RIP_G3, h.effective_custom_fields)
+        self.assertItemsEqual([g2._id], [x._id for x in Group.find_by_tags_recursive(["tag2"])])
+
+    def test_inherited_cache(self):
+        from app import app
+        from library.engine.cache import inherited_cache_stats
+        g1 = Group(name="g1", work_group_id=self.twork_group._id, tags=["tag1"],
+                   local_custom_data={"key1": "value1"})
+        g1.save()
+        g2 = Group(name="g2", work_group_id=self.twork_group._id, tags=["tag2"])
+        g2.save()
+        g1.add_child(g2)
+
+        # a per-process cache couldn't be invalidated by other workers
+        stats = inherited_cache_stats()
+        self.assertDictEqual({"key1": "value1"}, Group.get(g2._id).custom_data)
+        self.assertEqual(stats["misses"], inherited_cache_stats()["misses"])
+
+        app.cache_shared = True
+        try:
+            self.assertDictEqual({"key1": "value1"}, Group.get(g2._id).custom_data)
+            stats = inherited_cache_stats()
+            self.assertDictEqual({"key1": "value1"}, Group.get(g2._id).custom_data)
+            new_stats = inherited_cache_stats()
+            self.assertEqual(stats["misses"], new_stats["misses"])
+            self.assertEqual(stats["local_hits"] + 1, new_stats["local_hits"])
+
+            # changes of the parent invalidate the cached values of the work group at once
+            g1.local_custom_data = {"key1": "value3"}
+            g1.save()
+            self.assertEqual(new_stats["invalidations"] + 1, inherited_cache_stats()["invalidations"])
+            g2 = Group.get(g2._id)
+            self.assertDictEqual({"key1": "value3"}, g2.custom_data)
+
+            # cached values are not shared between callers
+            g2.custom_data["key1"] = "modified"
+            self.assertDictEqual({"key1": "value3"}, g2.custom_data)
+
+            # unsaved changes bypass the cache
+            g2.local_custom_data = {"key2": "value4"}
+            self.assertDictEqual({"key1": "value3", "key2": "value4"}, g2.custom_data)
+
+            # projections load the fields the cache scope depends on
+            partial = Group.find({"_id": g2._id}, fields=["custom_data"])[0]
+            self.assertDictEqual({"custom_data": {"key1": "value3"}}, partial.to_dict(["custom_data"]))
+        finally:
+            app.cache_shared = False
+
+    def test_identity_map(self):
+        from app import app
+        g1 = Group(name="g1", work_group_id=self.twork_group._id)
+        g1.save()
+        g2 = Group(name="g2", work_group_id=self.twork_group._id)
+        g2.save()
+        g1.add_child(g2)
+
+        with app.flask.test_request_context():
+            parent = Group.find_one({"_id": g1._id})
+            self.assertIs(parent, Group.find_one({"_id": g1._id}))
+            child = Group.find_one({"_id": g2._id})
+            self.assertIs(parent, child.parents[0])
+            self.assertIs(child, parent.children[0])
+            # writable instances serve read-only loads but not vice versa
+            self.assertIs(parent, Group.find_one({"_id": g1._id}, read_only=True))
+            self.assertFalse(Group.find_one({"_id": g1._id}, fields=["name"]) is parent)
+
+            # unsaved changes are not shared
+            parent.name = "g1_modified"
+            loaded = Group.find_one({"_id": g1._id})
+            self.assertIsNot(parent, loaded)
+            self.assertEqual("g1", loaded.name)
+            parent.save()
+            self.assertIs(parent, Group.find_one({"_id": g1._id}))
+            self.assertIs(parent, child.parents[0])
+
+            # bulk writes make the instances be loaded again
+            Group.update_many({"_id": g1._id}, {"$set": {"description": "updated"}})
+            loaded = Group.find_one({"_id": g1._id})
+            self.assertIsNot(parent, loaded)
+            self.assertEqual("updated", loaded.description)
+
+        # there's no identity map outside of requests
+        self.assertIsNot(Group.find_one({"_id": g1._id}), Group.find_one({"_id": g1._id}))
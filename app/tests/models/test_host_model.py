@@ -1,9 +1,11 @@
 from unittest import TestCase
-from app.models import WorkGroup, Group, Host, Datacenter, User, NetworkGroup
+from app.models import WorkGroup, Group, Host, Datacenter, User, NetworkGroup, Tombstone
 from app.models.storable_model import ObjectSaveRequired, now
-from library.engine.errors import GroupNotFound, DatacenterNotFound, InvalidTags, InvalidAliases, NetworkGroupNotFound
+from library.engine.errors import GroupNotFound, DatacenterNotFound, InvalidTags, InvalidAliases, NetworkGroupNotFound, \
+    ConcurrentModification
 from pymongo.errors import DuplicateKeyError
 from datetime import timedelta
+from bson.objectid import ObjectId
 
 ANSIBLE_DATA1 = {
     "ansible_vars": {
@@ -117,6 +119,8 @@ class TestHostModel(TestCase):
         h.save()
         self.assertItemsEqual(["tag2", "tag3", "tag4"], h.all_tags)
         g1.add_child(g2)
+        # inherited tags are stored, the instance loaded before the change is outdated
+        h.reload()
         self.assertItemsEqual(["tag1", "tag2", "tag3", "tag4"], h.all_tags)
 
     def test_default_aliases(self):
@@ -274,3 +278,92 @@ class TestHostModel(TestCase):
         self.assertNotEqual(key, key2)
 
         self.assertIsNotNone(Host.get(key2))
+
+    def test_save_many(self):
+        g1 = Group(name="g1", work_group_id=self.twork_group._id, tags=["tag1"])
+        g1.save()
+        h1 = Host(fqdn="host1.example.com")
+        h1.save()
+        h2 = Host(fqdn="host2.example.com", group_id=g1._id)
+        h3 = Host(fqdn="host3.example.com", group_id=ObjectId())
+
+        h1.group_id = g1._id
+        failed = Host.save_many([h1, h2, h3])
+        self.assertEqual(1, len(failed))
+        self.assertIs(h3, failed[0][0])
+        self.assertIsInstance(failed[0][1], GroupNotFound)
+
+        self.assertItemsEqual([h1._id, h2._id], g1.host_ids)
+        h1 = Host.get(h1._id)
+        self.assertListEqual(["tag1"], h1.effective_tags)
+        self.assertItemsEqual(self.twork_group.participant_usernames, h1.responsibles_usernames_cache)
+
+        h4 = Host(fqdn="host1.example.com")
+        failed = Host.save_many([h4])
+        self.assertEqual(1, len(failed))
+        self.assertTrue(h4.is_new)
+
+    def test_save_many_moves(self):
+        wg2 = WorkGroup(name="test_work_group2", owner_id=self.twork_group_owner._id)
+        wg2.save()
+        try:
+            g1 = Group(name="g1", work_group_id=self.twork_group._id)
+            g1.save()
+            g2 = Group(name="g2", work_group_id=self.twork_group._id)
+            g2.save()
+            g3 = Group(name="g3", work_group_id=wg2._id)
+            g3.save()
+            hosts = [Host(fqdn="host%d.example.com" % i, group_id=g1._id) for i in range(3)]
+            Host.save_many(hosts)
+            Tombstone.destroy_all()
+
+            # moves out of the work group are recorded, moves within it are not
+            hosts[0].group_id = g2._id
+            hosts[1].group_id = g3._id
+            hosts[2].group_id = None
+            failed = Host.save_many(hosts)
+            self.assertListEqual([], failed)
+            tombstones = Tombstone.find({"model": "Host"})
+            self.assertItemsEqual([hosts[1]._id, hosts[2]._id], [x.obj_id for x in tombstones])
+            for tombstone in Tombstone.find({"model": "Host"}):
+                self.assertEqual(self.twork_group._id, tombstone.work_group_id)
+        finally:
+            Tombstone.destroy_all()
+            Group.destroy_all()
+            wg2.destroy()
+
+    def test_concurrent_modification(self):
+        h = Host(fqdn="host.example.com")
+        h.save()
+        Host.update_many({"_id": h._id}, {"$set": {"updated_at": now() + timedelta(seconds=1)}})
+        h.description = "description"
+        self.assertRaises(ConcurrentModification, h.save)
+        h.reload()
+        h.description = "description"
+        h.save()
+        self.assertEqual(Host.get(h._id).description, "description")
+
+    def test_prefetch(self):
+        g1 = Group(name="g1", work_group_id=self.twork_group._id)
+        g1.save()
+        g2 = Group(name="g2", work_group_id=self.twork_group._id)
+        g2.save()
+        for i in range(4):
+            h = Host(fqdn="host%d.example.com" % i, group_id=[g1._id, g2._id][i % 2])
+            h.save()
+        h = Host(fqdn="host4.example.com")
+        h.save()
+
+        self.assertListEqual(["group", "group.work_group.owner"],
+                             Host.get_relations(["fqdn", "group_name", "modification_allowed"]))
+        hosts = Host.find({}).sort("fqdn").prefetch(["group.work_group"]).all()
+        self.assertIs(hosts[0].group, hosts[2].group)
+        self.assertIs(hosts[1].group, hosts[3].group)
+        self.assertIsNone(hosts[4].group)
+        self.assertEqual("g2", hosts[1].group_name)
+        self.assertIs(hosts[0].group.work_group, hosts[1].group.work_group)
+        self.assertEqual(self.twork_group.name, hosts[0].work_group_name)
+
+        # prefetched objects are not used once the id has been changed
+        hosts[0].group_id = g2._id
+        self.assertEqual("g2", hosts[0].group_name)
@@ -1,5 +1,8 @@
 from unittest import TestCase
-from app.models.storable_model import StorableModel, FieldRequired
+from app.models.storable_model import StorableModel, FieldRequired, copy_state
+from library.engine.errors import ReadOnlyObject
+from copy import deepcopy
+import gc
 
 CALLABLE_DEFAULT_VALUE = 4
 
@@ -100,3 +103,164 @@ class TestStorableModel(TestCase):
         self.assertEqual(model2.field2, "mymodel_updated")
         self.assertEqual(model3.field2, "mymodel_update_test")
 
+
+    def test_save_many(self):
+        model1 = TestModel(field2="mymodel_save_many")
+        model1.save()
+        model1.field2 = "mymodel_save_many_updated"
+        model2 = TestModel(field2="mymodel_save_many")
+        model3 = TestModel()
+
+        failed = TestModel.save_many([model1, model2, model3])
+        self.assertEqual(1, len(failed))
+        self.assertIs(model3, failed[0][0])
+        self.assertIsInstance(failed[0][1], FieldRequired)
+        self.assertTrue(model3.is_new)
+        self.assertFalse(model2.is_new)
+
+        model1.reload()
+        self.assertEqual(model1.field2, "mymodel_save_many_updated")
+        model2 = TestModel.find_one({"_id": model2._id})
+        self.assertEqual(model2.field2, "mymodel_save_many")
+
+    def test_partial_update(self):
+        model = TestModel(field2="mymodel_partial_update")
+        model.save()
+        TestModel.update_many({"_id": model._id}, {"$set": {"field1": "concurrent_value"}})
+        model.field2 = "mymodel_updated"
+        self.assertTrue(model.is_dirty)
+        self.assertDictEqual({"field2": "mymodel_updated"}, model.get_changes()[0])
+        model.save()
+        self.assertFalse(model.is_dirty)
+
+        model = TestModel.find_one({"_id": model._id})
+        self.assertEqual(model.field1, "concurrent_value")
+        self.assertEqual(model.field2, "mymodel_updated")
+
+    def test_read_only(self):
+        model = TestModel(field2="mymodel_read_only")
+        model.save()
+        model = TestModel.find_one({"_id": model._id}, read_only=True)
+        self.assertTrue(model.is_read_only)
+        model.field2 = "mymodel_updated"
+        self.assertRaises(ReadOnlyObject, model.save)
+        models = TestModel.find({"_id": model._id}, read_only=True).all()
+        self.assertTrue(models[0].is_read_only)
+        failed = TestModel.save_many(models)
+        self.assertIsInstance(failed[0][1], ReadOnlyObject)
+
+    def test_copy_state(self):
+        data = {"list": [1, {"a": [2, 3]}], "dict": {"b": "c"}, "scalar": "d"}
+        copy = copy_state(data)
+        self.assertDictEqual(data, copy)
+        copy["list"][1]["a"].append(4)
+        copy["dict"]["b"] = "e"
+        self.assertListEqual([2, 3], data["list"][1]["a"])
+        self.assertEqual("c", data["dict"]["b"])
+
+    def test_read_only_allocations(self):
+        # read-only hydration must not allocate a copy of nested containers
+        doc = {
+            "field1": {"nested%d" % i: {"list": [i, i + 1]} for i in range(20)},
+            "field2": [{"key": "k%d" % i, "value": [i]} for i in range(20)],
+            "field3": "value",
+        }
+
+        def allocated(read_only):
+            gc.collect()
+            before = len(gc.get_objects())
+            models = [TestModel(_read_only=read_only, **deepcopy(doc)) for _ in range(100)]
+            gc.collect()
+            result = len(gc.get_objects()) - before
+            del models
+            return result
+
+        writable = allocated(False)
+        read_only = allocated(True)
+        self.assertLess(read_only * 1.5, writable)
+
+    def test_projection(self):
+        model = TestModel(field1="value1", field2="mymodel_projection")
+        model.save()
+        self.assertIsNone(TestModel.get_projection(["field2", "unknown_property"]))
+
+        model = TestModel.find_one({"_id": model._id}, fields=["field2"])
+        self.assertTrue(model.is_read_only)
+        self.assertEqual(model.field2, "mymodel_projection")
+        self.assertFalse(hasattr(model, "field1"))
+        self.assertDictEqual({"field2": "mymodel_projection"}, model.to_dict(["field2"]))
+
+        models = TestModel.find({"_id": model._id}).only(["field1"]).all()
+        self.assertEqual(models[0].field1, "value1")
+        self.assertFalse(hasattr(models[0], "field2"))
+
+    def test_cache_identity(self):
+        model1 = TestModel(field1="value1", field2="mymodel_cache_identity")
+        model2 = TestModel(field1="value2", field2="mymodel_cache_identity")
+        self.assertNotEqual(model1._cache_identity(), model2._cache_identity())
+        model1.save()
+        identity = model1._cache_identity()
+        self.assertEqual(("TestModel", model1._id, None), identity)
+        self.assertEqual(identity, TestModel.find_one({"_id": model1._id})._cache_identity())
+
+    def test_request_cache(self):
+        from app import app
+        from flask import request
+        from library.db import RowsCursor
+        from library.engine.cache import request_cache_stats
+        TestModel(field2=["a"], field3="1").save()
+        TestModel(field2=["b"], field3="2").save()
+        TestModel(field2=["c"], field3="3").save()
+
+        with app.flask.test_request_context():
+            request.id = "test_request_cache"
+            stats = request_cache_stats()
+            models = TestModel.find({}).all()
+            self.assertEqual(3, len(models))
+            models[0].field2.append("modified")
+
+            # rows are kept once the cursor has been read
+            cursor = TestModel.find({})
+            self.assertIsInstance(cursor, RowsCursor)
+            self.assertEqual(3, cursor.count())
+            self.assertItemsEqual([["a"], ["b"], ["c"]], [x.field2 for x in cursor])
+            cursor = TestModel.find({}).skip(1).limit(1)
+            self.assertEqual(1, len(cursor.all()))
+            self.assertEqual(3, cursor.count())
+            self.assertEqual(1, cursor.count(True))
+            new_stats = request_cache_stats()
+            self.assertEqual(stats["miss"] + 1, new_stats["miss"])
+            self.assertEqual(stats["hit"] + 2, new_stats["hit"])
+
+            # a cursor which hasn't been read completely is not kept
+            stats = new_stats
+            TestModel.find({"field3": "1"})
+            TestModel.find({"field3": "1"}).limit(1).all()
+            self.assertEqual(1, len(TestModel.find({"field3": "1"}).all()))
+            new_stats = request_cache_stats()
+            self.assertEqual(stats["reexec"] + 2, new_stats["reexec"])
+
+            # writes drop the rows kept
+            model = TestModel.find_one({"field3": "2"})
+            model.field2 = ["d"]
+            model.save()
+            self.assertItemsEqual([["a"], ["c"], ["d"]], [x.field2 for x in TestModel.find({})])
+
+    def test_request_cache_max_rows(self):
+        from app import app
+        from flask import request
+        from library.db import RowsCursor
+        TestModel(field2="a").save()
+        TestModel(field2="b").save()
+        max_rows = app.config.cache.get("REQUEST_CACHE_MAX_ROWS")
+        app.config.cache["REQUEST_CACHE_MAX_ROWS"] = 1
+        try:
+            with app.flask.test_request_context():
+                request.id = "test_request_cache_max_rows"
+                self.assertEqual(2, len(TestModel.find({}).all()))
+                self.assertNotIsInstance(TestModel.find({}), RowsCursor)
+        finally:
+            if max_rows is None:
+                del app.config.cache["REQUEST_CACHE_MAX_ROWS"]
+            else:
+                app.config.cache["REQUEST_CACHE_MAX_ROWS"] = max_rows
@@ -0,0 +1,53 @@
+from unittest import TestCase
+from datetime import timedelta
+from bson.objectid import ObjectId
+from app.models import Datacenter, Tombstone
+from app.models.storable_model import now
+
+
+class TestTombstoneModel(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        Datacenter.destroy_all()
+        Tombstone.destroy_all()
+        Tombstone.ensure_indexes()
+
+    def setUp(self):
+        Datacenter.destroy_all()
+        Tombstone.destroy_all()
+
+    def tearDown(self):
+        Datacenter.destroy_all()
+        Tombstone.destroy_all()
+
+    def test_destroy(self):
+        since = now()
+        dc = Datacenter(name="dc1")
+        dc.save()
+        dc_id = dc._id
+        self.assertListEqual([], Tombstone.deleted_ids(Datacenter, since))
+        dc.destroy()
+        self.assertListEqual([dc_id], Tombstone.deleted_ids(Datacenter, since))
+        self.assertListEqual([], Tombstone.deleted_ids(Datacenter, now() + timedelta(seconds=1)))
+
+    def test_destroy_many(self):
+        since = now()
+        dc_ids = []
+        for name in ("dc1", "dc2", "dc3"):
+            dc = Datacenter(name=name)
+            dc.save()
+            dc_ids.append(dc._id)
+        Datacenter.destroy_many({"name": {"$in": ["dc1", "dc2"]}})
+        self.assertItemsEqual(dc_ids[:2], Tombstone.deleted_ids(Datacenter, since))
+        self.assertEqual(1, Datacenter.find({}).count())
+
+    def test_moves(self):
+        since = now()
+        wg1_id, wg2_id, dc_id = ObjectId(), ObjectId(), ObjectId()
+        Tombstone.record_moves(Datacenter, [(dc_id, wg1_id)])
+        Tombstone.record_moves(Datacenter, [(dc_id, wg1_id)])
+        # moves are not deletions
+        self.assertListEqual([], Tombstone.deleted_ids(Datacenter, since))
+        self.assertListEqual([dc_id], Tombstone.moved_ids(Datacenter, [wg1_id], since))
+        self.assertListEqual([], Tombstone.moved_ids(Datacenter, [wg2_id], since))
@@ -41,4 +41,59 @@ class TestUserModel(TestCase):
         t1.save()
         new_at = u.auth_token
         self.assertEqual(at, new_at, "token should not have changed")
-        self.assertEqual(u.tokens.count(), 1, "the first token should be destroyed due to expiration")
+        # expired tokens are removed by the TTL index rather than in requests
+        self.assertEqual(u.tokens.count(), 2)
+        self.assertIn(["created_at", {"expireAfterSeconds": 100}], Token.get_indexes())
+
+    def test_find_user(self):
+        from app import app
+        u = User(username="test_user", first_name="Test")
+        u.save()
+        token = u.get_auth_token()
+
+        user = Token.find_user(token.token)
+        self.assertEqual(u._id, user._id)
+        self.assertEqual("Test", user.first_name)
+        # users are complete objects which can be saved
+        self.assertFalse(user.is_read_only)
+        self.assertTrue(hasattr(user, "password_hash"))
+        self.assertIsNone(Token.find_user("non-existent-token"))
+
+        # a per-process cache isn't used, other workers couldn't invalidate it
+        self.assertFalse(app.cache_shared)
+        Token.destroy_many({"_id": token._id})
+        self.assertIsNone(Token.find_user(token.token))
+
+        token = u.get_auth_token()
+        token.created_at = now() - timedelta(seconds=120)
+        token.save()
+        self.assertIsNone(Token.find_user(token.token))
+
+    def test_find_user_shared_cache(self):
+        from app import app
+        app.cache_shared = True
+        try:
+            u = User(username="test_user", first_name="Test")
+            u.save()
+            token = u.get_auth_token()
+            self.assertEqual(u._id, Token.find_user(token.token)._id)
+
+            # the token is resolved via the cache, the user is read from the db
+            Token.destroy_many({"_id": token._id})
+            u.first_name = "Changed"
+            u.save()
+            self.assertEqual("Changed", Token.find_user(token.token).first_name)
+
+            # saving or deleting any of the user's tokens drops the cached entries
+            token = u.get_auth_token()
+            self.assertEqual(u._id, Token.find_user(token.token)._id)
+            token.destroy()
+            self.assertIsNone(Token.find_user(token.token))
+
+            # deleted users are not authenticated
+            token = u.get_auth_token()
+            self.assertEqual(u._id, Token.find_user(token.token)._id)
+            u.destroy()
+            self.assertIsNone(Token.find_user(token.token))
+        finally:
+            app.cache_shared = False
@@ -0,0 +1,59 @@
+from unittest import TestCase
+from threading import Event
+from library.engine.action_log import summarize, ActionLogWriter
+
+
+class FakeAction(object):
+
+    def __init__(self, action_type, saved, started=None, block=None):
+        self.action_type = action_type
+        self.saved = saved
+        self.started = started
+        self.block = block
+
+    def save(self):
+        if self.started is not None:
+            self.started.set()
+        if self.block is not None:
+            self.block.wait()
+        self.saved.append(self.action_type)
+
+
+class TestActionLog(TestCase):
+
+    def test_summarize(self):
+        params = {"host_ids": range(5), "group_id": "g1", "nested": {"tags": ["a", "b"]}}
+        summary = summarize(params, max_items=3)
+        self.assertListEqual([0, 1, 2], summary["host_ids"])
+        self.assertDictEqual({"host_ids": 5}, summary["_truncated"])
+        self.assertEqual("g1", summary["group_id"])
+        self.assertDictEqual({"tags": ["a", "b"]}, summary["nested"])
+        # the original params are intact
+        summary["nested"]["tags"].append("c")
+        self.assertListEqual(["a", "b"], params["nested"]["tags"])
+        self.assertEqual(5, len(params["host_ids"]))
+
+    def test_writer(self):
+        saved = []
+        writer = ActionLogWriter(max_size=10)
+        writer.put(FakeAction("host_create", saved))
+        writer.put(FakeAction("host_delete", saved))
+        self.assertTrue(writer.flush(5.0))
+        self.assertListEqual(["host_create", "host_delete"], saved)
+
+    def test_writer_queue_full(self):
+        saved = []
+        started = Event()
+        block = Event()
+        writer = ActionLogWriter(max_size=1)
+        # the first action blocks the thread, the second one fills the queue
+        writer.put(FakeAction("first", saved, started, block))
+        started.wait()
+        writer.put(FakeAction("second", saved))
+        writer.put(FakeAction("third", saved))
+        # the queue is full so the third action has been written synchronously
+        self.assertListEqual(["third"], saved)
+        self.assertFalse(writer.flush(0.1))
+        block.set()
+        self.assertTrue(writer.flush(5.0))
+        self.assertItemsEqual(["first", "second", "third"], saved)
@@ -0,0 +1,60 @@
+from unittest import TestCase
+from library.engine.cache import LocalLRUCache, freeze, _get_cache_key
+from bson.objectid import ObjectId
+
+
+class TestCache(TestCase):
+
+    def test_local_lru_cache(self):
+        c = LocalLRUCache(max_size=2)
+        c.set("a", 1)
+        c.set("b", 2)
+        self.assertEqual(1, c.get("a"))
+        # "b" is the least recently used item now
+        c.set("c", 3)
+        self.assertEqual(2, len(c))
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(1, c.get("a"))
+        self.assertEqual(3, c.get("c"))
+
+        c.set("a", 4)
+        self.assertEqual(4, c.get("a"))
+        self.assertEqual(2, len(c))
+
+        c.delete("a")
+        self.assertEqual("default", c.get("a", "default"))
+        c.clear()
+        self.assertEqual(0, len(c))
+
+    def test_cache_key(self):
+        oid = ObjectId()
+        args = ({"_id": {"$in": [oid]}, "name": "test"},)
+        key = _get_cache_key("pref", "find", args, {"fields": ["name"]})
+        hash(key)
+        # dicts are equal regardless of the key order
+        self.assertEqual(key, _get_cache_key("pref", "find", ({"name": "test", "_id": {"$in": [oid]}},),
+                                             {"fields": ["name"]}))
+        self.assertNotEqual(key, _get_cache_key("pref", "find", args, {"fields": ["_id"]}))
+        # lists and dicts are not mixed up
+        self.assertNotEqual(freeze({"a": 1}), freeze([("a", 1)]))
+
+    def test_cache_key_class(self):
+        from app.models import Host
+        # cls of cached classmethods has _cache_identity but it's not an instance
+        key = _get_cache_key("pref", "find", (Host, {"fqdn": "host"}), {})
+        hash(key)
+        self.assertEqual(Host, key[2][0])
+
+    def test_request_time_cache_classmethod(self):
+        from app import app
+        from app.models import Datacenter
+        from flask import request
+        from library.engine.cache import request_cache_stats
+        with app.flask.test_request_context():
+            request.id = "test_request_time_cache_classmethod"
+            stats = request_cache_stats()
+            self.assertIsNone(Datacenter.find_one({"name": "test_request_time_cache_classmethod"}))
+            self.assertIsNone(Datacenter.find_one({"name": "test_request_time_cache_classmethod"}))
+            new_stats = request_cache_stats()
+            self.assertEqual(stats["miss"] + 1, new_stats["miss"])
+            self.assertEqual(stats["hit"] + 1, new_stats["hit"])
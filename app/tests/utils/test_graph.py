@@ -0,0 +1,100 @@
+from unittest import TestCase
+from library.engine.graph import transitive_closure, postorder, descendant_items
+
+
+class TestGraph(TestCase):
+
+    def test_diamond(self):
+        # 1 -> 2 -> 4, 1 -> 3 -> 4
+        ancestors, descendants = transitive_closure({
+            1: [],
+            2: [1],
+            3: [1],
+            4: [2, 3],
+        })
+        self.assertItemsEqual([], ancestors[1])
+        self.assertItemsEqual([1, 2, 3], ancestors[4])
+        self.assertItemsEqual([2, 3, 4], descendants[1])
+        self.assertItemsEqual([4], descendants[3])
+        self.assertItemsEqual([], descendants[4])
+
+    def test_unknown_parents(self):
+        ancestors, descendants = transitive_closure({
+            1: ["unknown"],
+            2: [1],
+        })
+        self.assertItemsEqual([1], ancestors[2])
+        self.assertNotIn("unknown", descendants)
+
+    def test_cycle(self):
+        ancestors, descendants = transitive_closure({
+            1: [3],
+            2: [1],
+            3: [2],
+        })
+        for node_id in (1, 2, 3):
+            self.assertNotIn(node_id, ancestors[node_id])
+
+    def test_postorder(self):
+        # 1 -> 2 -> 4, 1 -> 3 -> 4
+        order, cycle_edges = postorder({
+            1: [2, 3],
+            2: [4],
+            3: [4],
+            4: [],
+        })
+        self.assertItemsEqual([1, 2, 3, 4], order)
+        self.assertEqual([], cycle_edges)
+        for parent_id, child_id in ((1, 2), (1, 3), (2, 4), (3, 4)):
+            self.assertLess(order.index(child_id), order.index(parent_id))
+
+    def test_postorder_cycle(self):
+        order, cycle_edges = postorder({
+            1: [2],
+            2: [3],
+            3: [1],
+        })
+        self.assertItemsEqual([1, 2, 3], order)
+        self.assertEqual([(3, 1)], cycle_edges)
+
+    def test_descendant_items_diamond(self):
+        # 1 -> 2 -> 4, 1 -> 3 -> 4
+        result, cycle_edges = descendant_items({
+            1: [2, 3],
+            2: [4],
+            3: [4],
+            4: ["unknown"],
+        }, {
+            1: ["h1"],
+            3: ["h3"],
+            4: ["h4"],
+        })
+        self.assertEqual([], cycle_edges)
+        self.assertItemsEqual(["h1", "h3", "h4"], result[1])
+        self.assertItemsEqual(["h4"], result[2])
+        self.assertItemsEqual(["h3", "h4"], result[3])
+        self.assertItemsEqual(["h4"], result[4])
+
+    def test_descendant_items_cycle(self):
+        result, cycle_edges = descendant_items({
+            1: [2],
+            2: [3],
+            3: [1],
+        }, {
+            1: ["h1"],
+            2: ["h2"],
+            3: ["h3"],
+        })
+        self.assertEqual(1, len(cycle_edges))
+        self.assertItemsEqual(["h1", "h2", "h3"], result[1])
+        self.assertItemsEqual(["h2", "h3"], result[2])
+        self.assertItemsEqual(["h3"], result[3])
+
+    def test_descendant_items_deep(self):
+        # a chain deeper than the recursion limit
+        depth = 5000
+        child_ids = dict([(i, [i + 1]) for i in xrange(depth)])
+        child_ids[depth] = []
+        result, cycle_edges = descendant_items(child_ids, {depth: ["leaf"]})
+        self.assertItemsEqual(["leaf"], result[0])
+        self.assertItemsEqual(["leaf"], result[depth - 1])
@@ -1,5 +1,5 @@
 from unittest import TestCase
-from library.engine.utils import merge, convert_keys
+from library.engine.utils import merge, convert_keys, merge_tags, merge_custom_fields
 
 D1 = {
     "field1": 3,
@@ -73,3 +73,18 @@ class TestMerge(TestCase):
 
     def test_convert_keys(self):
         self.assertDictEqual(convert_keys(CK_INPUT), CK_EXPECTED)
+
+    def test_merge_tags(self):
+        self.assertListEqual(["a", "b", "c"], merge_tags(["c", "a"], ["b", "a"], []))
+
+    def test_merge_custom_fields(self):
+        cf1 = [{"key": "k1", "value": "1"}, {"key": "k2", "value": "2"}]
+        cf2 = [{"key": "k2", "value": "overriden 2"}, {"key": "k0", "value": "0"}]
+        self.assertListEqual(
+            [
+                {"key": "k0", "value": "0"},
+                {"key": "k1", "value": "1"},
+                {"key": "k2", "value": "overriden 2"},
+            ],
+            merge_custom_fields(cf1, cf2)
+        )
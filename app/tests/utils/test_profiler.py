@@ -0,0 +1,41 @@
+from unittest import TestCase
+from collections import namedtuple
+from bson.objectid import ObjectId
+from library.engine.profiler import QueryProfile
+
+Event = namedtuple("Event", ["command_name", "command", "connection_id", "request_id", "duration_micros"])
+
+
+class TestProfiler(TestCase):
+
+    @staticmethod
+    def run_query(profile, request_id, collection, query):
+        command = {"find": collection, "filter": query}
+        event = Event("find", command, ("localhost", 27017), request_id, 1000)
+        profile.command_started(event)
+        profile.command_finished(event)
+
+    def test_profile(self):
+        profile = QueryProfile()
+        group_id = ObjectId()
+        self.run_query(profile, 1, "group", {"_id": group_id})
+        self.run_query(profile, 2, "group", {"_id": group_id})
+        for i in range(3):
+            self.run_query(profile, 3 + i, "host", {"_id": ObjectId()})
+        self.run_query(profile, 6, "host", {"fqdn": "host.example.com"})
+
+        self.assertEqual(6, len(profile.queries))
+        self.assertAlmostEqual(0.006, profile.total_time)
+        self.assertEqual("test_profiler.py", profile.queries[0]["call_site"].split(":")[0].split("/")[-1])
+
+        repeated = profile.repeated
+        self.assertEqual(1, len(repeated))
+        self.assertEqual("group", repeated[0]["collection"])
+        self.assertEqual(2, repeated[0]["count"])
+
+        similar = profile.similar
+        self.assertEqual(1, len(similar))
+        self.assertEqual("host", similar[0]["collection"])
+        self.assertEqual(3, similar[0]["count"])
+
+        self.assertEqual("queries=6; time=0.006; repeated=1; similar=1", profile.header())
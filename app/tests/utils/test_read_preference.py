@@ -0,0 +1,44 @@
+from unittest import TestCase
+from app import app
+from library.db import DB
+
+
+class TestReadPreference(TestCase):
+
+    def setUp(self):
+        self.db = DB()
+        self.db._conn = "primary"
+        self.db._ro_conn = "ro"
+        self.db._secondary_conn = "secondary"
+
+    def test_default(self):
+        self.assertEqual("ro", self.db.read_conn)
+        with app.flask.test_request_context("/api/v1/hosts/"):
+            self.assertEqual("ro", self.db.read_conn)
+
+    def test_secondary_reads(self):
+        with app.flask.test_request_context("/api/v1/hosts/"):
+            self.db.allow_secondary_reads()
+            self.assertEqual("secondary", self.db.read_conn)
+        # the read preference doesn't outlive the request
+        with app.flask.test_request_context("/api/v1/hosts/"):
+            self.assertEqual("ro", self.db.read_conn)
+
+    def test_primary_pinned(self):
+        with app.flask.test_request_context("/api/v1/hosts/"):
+            self.db.allow_secondary_reads()
+            self.db.pin_primary()
+            self.assertEqual("primary", self.db.read_conn)
+            # a request can't go back to secondaries once pinned
+            self.db.allow_secondary_reads()
+            self.assertEqual("primary", self.db.read_conn)
+
+    def test_pinned_by_write(self):
+        class Collection(object):
+            def delete_many(self, query):
+                return None
+        self.db._conn = {"hosts": Collection()}
+        with app.flask.test_request_context("/api/v1/open/executer_data"):
+            self.db.allow_secondary_reads()
+            self.db.delete_query("hosts", {})
+            self.assertIs(self.db._conn, self.db.read_conn)
@@ -0,0 +1,113 @@
+from unittest import TestCase
+from pymongo.errors import ServerSelectionTimeoutError
+from library.engine.retry import RetryPolicy, CircuitBreaker
+from library.engine.errors import DatabaseUnavailable
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeCollection(object):
+    """
+    FakeCollection raises ServerSelectionTimeoutError for the first failures calls
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def find_one(self, query, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ServerSelectionTimeoutError("No servers found yet")
+        return {"_id": 1}
+
+
+class TestRetry(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=10.0, clock=self.clock)
+        self.policy = RetryPolicy(ServerSelectionTimeoutError, max_attempts=4, base_delay=0.1, max_delay=2.0,
+                                  timeout=5.0, sleep=self.clock.sleep, clock=self.clock, rand=lambda: 1.0)
+
+    def call(self, collection, deadline=None):
+        return self.policy.call(lambda: collection.find_one({}), self.breaker, DatabaseUnavailable, deadline)
+
+    def test_retry(self):
+        collection = FakeCollection(failures=2)
+        self.assertDictEqual({"_id": 1}, self.call(collection))
+        self.assertEqual(3, collection.calls)
+        self.assertListEqual([0.1, 0.2], self.clock.sleeps)
+        self.assertFalse(self.breaker.is_open)
+
+    def test_jitter(self):
+        policy = RetryPolicy(ServerSelectionTimeoutError, base_delay=0.1, max_delay=2.0, rand=lambda: 0.5)
+        self.assertAlmostEqual(0.05, policy.delay(0))
+        self.assertAlmostEqual(0.4, policy.delay(3))
+        self.assertAlmostEqual(1.0, policy.delay(10))
+
+    def test_deadline(self):
+        collection = FakeCollection(failures=10)
+        breaker = CircuitBreaker(failure_threshold=10, clock=self.clock)
+        self.assertRaises(DatabaseUnavailable, self.policy.call, lambda: collection.find_one({}), breaker,
+                          DatabaseUnavailable, self.clock() + 0.25)
+        # the second retry would have started after the deadline
+        self.assertEqual(2, collection.calls)
+
+    def test_circuit_breaker(self):
+        collection = FakeCollection(failures=100)
+        with self.assertRaises(DatabaseUnavailable) as cm:
+            self.call(collection)
+        self.assertEqual(503, cm.exception.status_code)
+        # the breaker opens after the third failure and rejects the last attempt
+        self.assertEqual(3, collection.calls)
+        self.assertTrue(self.breaker.is_open)
+
+        # fails fast while the breaker is open
+        self.assertRaises(DatabaseUnavailable, self.call, collection)
+        self.assertEqual(3, collection.calls)
+
+        # a failed probe opens the breaker again
+        self.clock.now += 10
+        self.assertRaises(DatabaseUnavailable, self.call, collection)
+        self.assertEqual(4, collection.calls)
+        self.assertTrue(self.breaker.is_open)
+
+        # a successful probe closes it
+        collection.failures = 0
+        self.clock.now += 10
+        self.assertDictEqual({"_id": 1}, self.call(collection))
+        self.assertFalse(self.breaker.is_open)
+
+    def test_other_errors(self):
+        def fail():
+            raise KeyError("not a connection error")
+        # the recovery timeout has passed so the call goes as a probe
+        self.breaker.state = CircuitBreaker.OPEN
+        self.breaker.opened_at = self.clock() - self.breaker.recovery_timeout
+        self.assertRaises(KeyError, self.policy.call, fail, self.breaker, DatabaseUnavailable)
+        self.assertFalse(self.breaker.is_open)
+
+    def test_db(self):
+        from library.db import DB
+        collection = FakeCollection(failures=100)
+        db = DB()
+        db.retry_policy = self.policy
+        db.ro_breaker = self.breaker
+        db._ro_conn = {"hosts": collection}
+        self.assertRaises(DatabaseUnavailable, db.get_obj_id, "hosts", {})
+        self.assertRaises(DatabaseUnavailable, db.get_obj_id, "hosts", {})
+        self.assertEqual(3, collection.calls)
+        self.assertFalse(db.rw_breaker.is_open)
@@ -0,0 +1,38 @@
+from unittest import TestCase
+from library.engine.utils import iter_json, buffered, StreamedList, StreamedDict
+import flask.json as json
+
+
+class TestStream(TestCase):
+
+    def test_iter_json(self):
+        def items():
+            for i in range(3):
+                yield {"id": i}
+        data = {
+            "data": {
+                "list": StreamedList(items()),
+                "dict": StreamedDict((str(i), [i]) for i in range(2)),
+                "empty": StreamedList([]),
+            },
+            "count": 3,
+        }
+        result = json.loads("".join(iter_json(data)))
+        self.assertDictEqual(result, {
+            "data": {
+                "list": [{"id": 0}, {"id": 1}, {"id": 2}],
+                "dict": {"0": [0], "1": [1]},
+                "empty": [],
+            },
+            "count": 3,
+        })
+
+    def test_plain_data(self):
+        data = {"a": [1, 2], "b": {"c": "d"}}
+        chunks = list(iter_json(data))
+        self.assertEqual(1, len(chunks))
+        self.assertDictEqual(data, json.loads(chunks[0]))
+
+    def test_buffered(self):
+        chunks = list(buffered(["ab", "cd", "e"], chunk_size=3))
+        self.assertListEqual(["abcd", "e"], chunks)
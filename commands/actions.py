@@ -1,8 +1,6 @@
 from commands import Command
 from datetime import datetime, timedelta
 
-DEFAULT_ACTION_LOG_TTL = 86400 * 31 * 6 # approximately half a year
-
 
 class Actions(Command):
 
@@ -12,6 +10,7 @@ class Actions(Command):
     def run(self):
         from app import app
         from app.models import ApiAction
+        from app.models.api_action import DEFAULT_ACTION_LOG_TTL
         ttl = app.config.app.get("ACTION_LOG_TTL", DEFAULT_ACTION_LOG_TTL)
         delta = timedelta(seconds=ttl)
         min_date = datetime.utcnow() - delta
@@ -0,0 +1,195 @@
+from commands import Command
+from datetime import datetime
+import resource
+
+
+class Bench(Command):
+
+    DESCRIPTION = "run performance benchmarks against a generated inventory"
+
+    BENCHMARKS = (
+        "ansible_plain",
+        "host_all_tags",
+        "group_structure",
+    )
+
+    SHAPES = (
+        "tree",
+        "wide",
+        "deep",
+        "diamond",
+    )
+
+    def init_argument_parser(self, parser):
+        parser.add_argument("benchmark", type=str, choices=self.BENCHMARKS)
+        parser.add_argument("--hosts", type=int, default=100000, help="number of hosts to generate")
+        parser.add_argument("--groups", type=int, default=5000, help="number of groups to generate")
+        parser.add_argument("--shape", type=str, choices=self.SHAPES, default="tree",
+                            help="shape of the group hierarchy: a 10-ary tree, a single root with all "
+                                 "the other groups as children, a single chain or a chain of diamonds")
+        parser.add_argument("--keep", action="store_true", default=False,
+                            help="keep the generated data in bench_* collections")
+
+    @staticmethod
+    def use_bench_collections():
+        # never touch real data, see also the test command
+        from app.models import WorkGroup, Group, Host, Datacenter, User, ApiAction, Token, NetworkGroup, \
+            Tombstone, InventoryGeneration
+        WorkGroup._collection = 'bench_work_groups'
+        Group._collection = 'bench_groups'
+        Host._collection = 'bench_hosts'
+        Datacenter._collection = 'bench_datacenters'
+        User._collection = 'bench_users'
+        ApiAction._collection = 'bench_api_actions'
+        Token._collection = 'bench_tokens'
+        NetworkGroup._collection = 'bench_network_groups'
+        Tombstone._collection = 'bench_tombstones'
+        InventoryGeneration._collection = 'bench_inventory_generations'
+
+    @staticmethod
+    def parent_indexes(shape, i):
+        # indexes of parents of the i-th group (i > 0) in a hierarchy of the given shape
+        if shape == "wide":
+            return [0]
+        if shape == "deep":
+            return [i - 1]
+        if shape == "diamond":
+            # groups go in layers of two, each group of a layer is a child of both groups
+            # of the previous one, so the number of paths from the root doubles every layer
+            layer = (i + 1) // 2
+            if layer == 1:
+                return [0]
+            return [2 * layer - 3, 2 * layer - 2]
+        return [(i - 1) // 10]
+
+    def generate(self):
+        # generates a work group with a hierarchy of groups and hosts spread over them
+        from app import app
+        from app.models import WorkGroup, Group, Host
+
+        t1 = datetime.now()
+        for model in (WorkGroup, Group, Host):
+            model.destroy_all()
+            model.ensure_indexes()
+
+        work_group = WorkGroup(name="bench")
+        work_group.save(skip_callback=True)
+
+        groups = [Group(name="group%05d" % i, work_group_id=work_group._id, tags=["tag%d" % (i % 10)])
+                  for i in xrange(self.args.groups)]
+        Group.save_many(groups, skip_callback=True)
+        for i, group in enumerate(groups[1:], 1):
+            for parent_index in self.parent_indexes(self.args.shape, i):
+                parent = groups[parent_index]
+                group.parent_ids.append(parent._id)
+                parent.child_ids.append(group._id)
+        Group.save_many(groups, skip_callback=True)
+        Group.rebuild_closure({"work_group_id": work_group._id})
+
+        batch = []
+        for i in xrange(self.args.hosts):
+            group = groups[i % len(groups)]
+            batch.append(Host(
+                fqdn="host%06d.bench.example.com" % i,
+                group_id=group._id,
+                local_custom_data={"ansible_vars": {"host_id": i}},
+            ))
+            if len(batch) == 5000:
+                Host.save_many(batch, skip_callback=True)
+                batch = []
+        Host.save_many(batch, skip_callback=True)
+
+        app.logger.info("Generated %d groups (%s) and %d hosts in %.3f seconds" %
+                        (self.args.groups, self.args.shape, self.args.hosts,
+                         (datetime.now() - t1).total_seconds()))
+        return work_group
+
+    def cleanup(self):
+        from app.models import WorkGroup, Group, Host
+        for model in (WorkGroup, Group, Host):
+            model.destroy_all()
+
+    def measure(self, name, func):
+        from app import app
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t1 = datetime.now()
+        result = func()
+        elapsed = (datetime.now() - t1).total_seconds()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        app.logger.info("%s: %.3f seconds, max RSS %d KB (+%d KB)" %
+                        (name, elapsed, rss_after, rss_after - rss_before))
+        return result
+
+    def bench_ansible_plain(self, work_group):
+        from app import app
+        from library.engine.utils import iter_ansible_inventory
+
+        def render(include_vars):
+            size = 0
+            with app.flask.test_request_context():
+                for chunk in iter_ansible_inventory([work_group._id], include_vars):
+                    size += len(chunk)
+            return size
+
+        size = self.measure("ansible plain", lambda: render(False))
+        app.logger.info("ansible plain: %d bytes rendered" % size)
+        size = self.measure("ansible plain with vars", lambda: render(True))
+        app.logger.info("ansible plain with vars: %d bytes rendered" % size)
+
+    def bench_host_all_tags(self, work_group):
+        from app import app
+        from app.models import Host
+        from flask import request
+        from hashlib import md5
+        from library.engine.cache import _get_cache_key
+        from library.engine.utils import uuid4_string
+
+        hosts = Host.find({}).all()
+
+        def all_tags():
+            with app.flask.test_request_context():
+                request.id = uuid4_string()
+                for host in hosts:
+                    host.all_tags
+                    host.all_tags
+
+        def md5_keys():
+            # the way cache keys used to be built, kept for comparison
+            for host in hosts:
+                "%s(%s.%s)" % ("all_tags", md5(str((host,))).hexdigest(), md5(str({})).hexdigest())
+
+        def tuple_keys():
+            for host in hosts:
+                _get_cache_key("bench", "all_tags", (host,), {})
+
+        self.measure("all_tags of %d hosts" % len(hosts), all_tags)
+        self.measure("md5(str(args)) keys of %d hosts" % len(hosts), md5_keys)
+        self.measure("tuple keys of %d hosts" % len(hosts), tuple_keys)
+
+    def bench_group_structure(self, work_group):
+        from app import app
+        from library.engine.graph import descendant_items
+        from library.engine.utils import full_group_structure
+
+        self.measure("full_group_structure of %d groups" % self.args.groups,
+                     lambda: full_group_structure(work_group._id))
+
+        # the in-memory part alone on growing hierarchies of the same shape,
+        # time is expected to grow linearly with the number of groups
+        for size in (self.args.groups // 4, self.args.groups // 2, self.args.groups):
+            child_ids = dict([(i, []) for i in xrange(size)])
+            for i in xrange(1, size):
+                for parent_index in self.parent_indexes(self.args.shape, i):
+                    child_ids[parent_index].append(i)
+            items = dict([(i, [i]) for i in xrange(size)])
+            self.measure("descendant_items of %d groups" % size, lambda: descendant_items(child_ids, items))
+        app.logger.info("group_structure: %s hierarchy" % self.args.shape)
+
+    def run(self):
+        self.use_bench_collections()
+        work_group = self.generate()
+        try:
+            getattr(self, "bench_" + self.args.benchmark)(work_group)
+        finally:
+            if not self.args.keep:
+                self.cleanup()
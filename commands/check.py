@@ -35,4 +35,10 @@ class Check(Command):
                 if len(cids) + len(pids) > 0:
                     group.save()
                     app.logger.info("Group %s has been fixed. Children removed %d, parents removed %d" %
-                                    (group.name, len(cids), len(pids)))
\ No newline at end of file
+                                    (group.name, len(cids), len(pids)))
+
+        outdated = Group.rebuild_closure(dry_run=not self.args.fix)
+        for group_id in outdated:
+            app.logger.error("Group %s has outdated ancestor_ids/descendant_ids" % group_id)
+        if self.args.fix and len(outdated) > 0:
+            app.logger.info("Ancestor/descendant index has been rebuilt for %d groups" % len(outdated))
@@ -24,7 +24,7 @@ class Convert(Command):
     NAME = "convert"
 
     def init_argument_parser(self, parser):
-        parser.add_argument('action', type=str, choices=['custom', 'responsibles'])
+        parser.add_argument('action', type=str, choices=['custom', 'responsibles', 'effective'])
 
     @staticmethod
     def convert_custom():
@@ -66,8 +66,27 @@ class Convert(Command):
             g.reset_responsibles_cache()
             g.save(skip_callback=True)
 
+    @staticmethod
+    def convert_effective():
+        # relies on ancestor_ids/descendant_ids, run "check --fix" first
+        from app import app
+        from app.models import Host, Group
+
+        for g in Group.find({"parent_ids": {"$size": 0}}):
+            app.logger.debug("Setting effective tags and custom fields for group %s and its descendants" % g.name)
+            g.reset_effective_fields()
+            g.save(skip_callback=True)
+            g.propagate_effective_fields()
+
+        for h in Host.find({"group_id": None}):
+            app.logger.debug("Setting effective tags and custom fields for host %s" % h.fqdn)
+            h.reset_effective_fields()
+            h.save(skip_callback=True)
+
     def run(self):
         if self.args.action == 'custom':
             return self.convert_custom()
         elif self.args.action == 'responsibles':
             return self.convert_responsibles()
+        elif self.args.action == 'effective':
+            return self.convert_effective()
@@ -24,7 +24,10 @@ class Index(Command):
                 if hasattr(obj, "ensure_indexes"):
                     app.logger.info("Creating indexes for %s, collection %s" % (attr, obj.collection))
                     obj.ensure_indexes(True, self.args.overwrite)
-        from library.db import db
+        from app.models.storable_model import ensure_collection_indexes
         app.logger.info("Creating sessions indexes")
-        db.conn["sessions"].create_index("sid", unique=True, sparse=False)
-        db.conn["sessions"].create_index("expiration")
+        # expiration is an absolute time so sessions are removed as soon as they expire
+        ensure_collection_indexes("sessions", (
+            ["sid", {"unique": True}],
+            ["expiration", {"expireAfterSeconds": 0}],
+        ), True, self.args.overwrite)
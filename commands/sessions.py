@@ -12,7 +12,7 @@ class Sessions(Command):
         action = self.args.action[0]
         if action == "count":
             total = db.ro_conn["sessions"].find().count()
-            expired = db.ro_conn["sessions"].find({"expiration": {"$lt": datetime.now()}}).count()
+            expired = db.ro_conn["sessions"].find({"expiration": {"$lt": datetime.utcnow()}}).count()
             print "Total number of sessions: %d, expired: %d" % (total, expired)
             if expired > 0:
                 print "Use <micro.py sessions cleanup> to remove old sessions manually"
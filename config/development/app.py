@@ -11,9 +11,6 @@ ACTION_LOGGING = True
 
 SECURITY_KEY_TTL = 600
 
-SESSIONS_AUTO_CLEANUP = True
-SESSIONS_AUTO_CLEANUP_RAND_TRIGGER = 0.05
-
 GRAVATAR_PATH = "https://sys.mail.ru/avatar/internal"
 
 DEFAULT_GROUP_POSTFIX = "_unknown"
\ No newline at end of file
@@ -7,11 +7,27 @@ FLASK_APP_SETTINGS = {
 PORT = 3000
 STATIC_FOLDER = "static"
 ACTION_LOGGING = True
-
-SESSIONS_AUTO_CLEANUP = True
-SESSIONS_AUTO_CLEANUP_RAND_TRIGGER = 0.05
+# actions are written by a background thread unless ACTION_LOG_ASYNC is False,
+# they're written synchronously while ACTION_LOG_QUEUE_SIZE ones are waiting
+# ACTION_LOG_ASYNC = True
+# ACTION_LOG_QUEUE_SIZE = 10000
+# lists in request params are logged up to this number of items
+# ACTION_LOG_MAX_ITEMS = 100
 
 DEFAULT_GROUP_POSTFIX = "_unknown"
 
 SECURITY_KEY_TTL = 600
 
+# sessions are written when they change or, to slide their expiration forward,
+# once this number of seconds has passed since they were written last
+# SESSION_REFRESH_INTERVAL = 86400
+
+# expired sessions, tokens (AUTH_TOKEN_TTL) and actions older than ACTION_LOG_TTL seconds
+# are removed by mongodb TTL indexes, run the index command with -w after changing them
+# ACTION_LOG_TTL = 16070400
+
+# addresses allowed to read /metrics, None allows any
+# METRICS_ALLOWED_ADDRESSES = ["127.0.0.1", "::1"]
+
+# share of requests profiled with their mongo queries logged, see library/engine/profiler.py
+QUERY_PROFILE_SAMPLE_RATE = 0.01
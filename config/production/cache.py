@@ -3,3 +3,18 @@
 #     'inet6:[cache2.example.com]:11211',
 #     'inet6:[cache3.example.com]:11211'
 # ]
+
+# size of the process-local cache tier in items
+# LOCAL_CACHE_SIZE = 10000
+
+# rendered inventories (ansible, executer_data) are cached in app.cache unless a directory
+# is given, memcached doesn't store items larger than 1MB even compressed
+# RENDER_CACHE_DIR = "/var/cache/inventoree/rendered"
+# RENDER_CACHE_THRESHOLD = 500
+# RENDER_CACHE_TIMEOUT = 3600
+# larger responses are streamed without being cached
+# RENDER_CACHE_MAX_SIZE = 16777216
+# re-render recently requested inventories in background after changes
+# RENDER_CACHE_PREWARM = False
+# queries returning more rows than this are not kept for the rest of a request
+# REQUEST_CACHE_MAX_ROWS = 1000
@@ -6,3 +6,17 @@ MONGO = {
     },
     "dbname":   "inventoree",
 }
+
+# MONGO_RETRY = {
+#     "max_attempts": 4,
+#     "base_delay": 0.1,
+#     "max_delay": 2.0,
+#     "timeout": 5.0,
+# }
+# MONGO_CIRCUIT_BREAKER = {
+#     "failure_threshold": 3,
+#     "recovery_timeout": 10.0,
+# }
+# MONGO_REQUEST_DEADLINE = 10.0
+# reads allowed to go to secondaries (open and list endpoints) tolerate this replication lag
+# MONGO_MAX_STALENESS_SECONDS = 90
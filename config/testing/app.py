@@ -5,4 +5,6 @@ FLASK_APP_SETTINGS = {}
 PORT = 3000
 STATIC_FOLDER = "static"
 ACTION_LOGGING = True
+# actions are computed against the test collections, keep it in line with the tests
+ACTION_LOG_ASYNC = False
 DEFAULT_GROUP_POSTFIX = "_unknown"
\ No newline at end of file
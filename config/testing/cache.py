@@ -3,3 +3,6 @@
 #     'inet6:[cache2.example.com]:11211',
 #     'inet6:[cache3.example.com]:11211'
 # ]
+
+# size of the process-local cache tier in items
+# LOCAL_CACHE_SIZE = 10000
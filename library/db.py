@@ -1,119 +1,386 @@
 from app import app
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
+from pymongo import MongoClient, InsertOne, UpdateOne, monitoring
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo.errors import ServerSelectionTimeoutError, BulkWriteError
 from bson.objectid import ObjectId, InvalidId
-from time import sleep
 from datetime import datetime
-from random import random
-
-MONGO_RETRIES = 6
-MONGO_RETRIES_RO = 6
-RETRY_SLEEP = 3 # 3 seconds
-
-__mongo_retries = MONGO_RETRIES
-__mongo_retries_ro = MONGO_RETRIES_RO
+from functools import wraps
+from flask import g, request, has_request_context, has_app_context
+from library.engine.errors import DatabaseUnavailable
+from library.engine.metrics import MONGO_COMMAND_DURATION
+from library.engine.profiler import query_profile_listener
+from library.engine.retry import RetryPolicy, CircuitBreaker
+from library.engine.cache import drop_request_results
+from library.engine import identity_map
+
+# defaults for MONGO_RETRY and MONGO_CIRCUIT_BREAKER db configuration options
+DEFAULT_RETRY_OPTIONS = {
+    "max_attempts": 4,
+    "base_delay": 0.1,
+    "max_delay": 2.0,
+    "timeout": 5.0,
+}
+DEFAULT_CIRCUIT_BREAKER_OPTIONS = {
+    "failure_threshold": 3,
+    "recovery_timeout": 10.0,
+}
+# seconds since the start of a request after which its db operations are not retried anymore
+DEFAULT_REQUEST_DEADLINE = 10.0
+# fail server selection fast, the retry policy is responsible for waiting
+DEFAULT_SERVER_SELECTION_TIMEOUT_MS = 2000
+# default for MONGO_MAX_STALENESS_SECONDS, 90 is the minimum value mongodb accepts
+DEFAULT_MAX_STALENESS_SECONDS = 90
+
+
+def _request_deadline():
+    if not has_request_context():
+        return None
+    started = getattr(request, "started", None)
+    if started is None:
+        return None
+    return started + app.config.db.get("MONGO_REQUEST_DEADLINE", DEFAULT_REQUEST_DEADLINE)
 
 
 def intercept_mongo_errors_rw(func):
-    def wrapper(*args, **kwargs):
-        global __mongo_retries
-        try:
-            result = func(*args, **kwargs)
-        except ServerSelectionTimeoutError:
-            app.logger.error("ServerSelectionTimeout in db module for read/write operations")
-            __mongo_retries -= 1
-            if __mongo_retries == MONGO_RETRIES/2:
-                app.logger.error("Mongo connection %d retries passed with no result, "
-                                 "trying to reinstall connection" % (MONGO_RETRIES/2))
-                db_obj = args[0]
-                db_obj.reset_conn()
-            if __mongo_retries == 0:
-                __mongo_retries = MONGO_RETRIES
-                app.logger.error("Mongo connection %d retries more passed with no result, giving up" % (MONGO_RETRIES/2))
-                return None
-            else:
-                sleep(RETRY_SLEEP)
-                return wrapper(*args, **kwargs)
-        return result
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return self.retry_policy.call(lambda: func(self, *args, **kwargs), self.rw_breaker,
+                                      DatabaseUnavailable, _request_deadline(), self._on_rw_breaker_open)
     return wrapper
 
 
 def intercept_mongo_errors_ro(func):
-    def wrapper(*args, **kwargs):
-        global __mongo_retries_ro
-        try:
-            result = func(*args, **kwargs)
-        except ServerSelectionTimeoutError:
-            app.logger.error("ServerSelectionTimeout in db module for read-only operations")
-            __mongo_retries_ro -= 1
-            if __mongo_retries_ro == MONGO_RETRIES_RO/2:
-                app.logger.error("Mongo readonly connection %d retries passed, switching "
-                                 "readonly operations to read-write socket" % (MONGO_RETRIES_RO/2))
-                db_obj = args[0]
-                db_obj._ro_conn = db_obj.conn
-            if __mongo_retries_ro == 0:
-                __mongo_retries_ro = MONGO_RETRIES_RO
-                app.logger.error("Mongo connection %d retries more passed with no result, giving up" % (MONGO_RETRIES/2))
-                return None
-            else:
-                sleep(RETRY_SLEEP)
-                return wrapper(*args, **kwargs)
-        return result
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.primary_pinned:
+            # reads pinned to the primary go through the read/write connection
+            return self.retry_policy.call(lambda: func(self, *args, **kwargs), self.rw_breaker,
+                                          DatabaseUnavailable, _request_deadline(), self._on_rw_breaker_open)
+        return self.retry_policy.call(lambda: func(self, *args, **kwargs), self.ro_breaker,
+                                      DatabaseUnavailable, _request_deadline(), self._on_ro_breaker_open)
     return wrapper
 
 
+class CommandMetricsListener(monitoring.CommandListener):
+    """
+    CommandMetricsListener counts and times every command sent to mongo
+    including getMore, so lazy cursors are accounted properly
+    """
+
+    def __init__(self):
+        # collection names of commands in progress, succeeded and failed events don't have them
+        self._collections = {}
+
+    def started(self, event):
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        else:
+            collection = event.command.get(event.command_name)
+        if not isinstance(collection, basestring):
+            collection = ""
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        self._observe(event, "ok")
+
+    def failed(self, event):
+        self._observe(event, "failed")
+
+    def _observe(self, event, result):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name, result).observe(event.duration_micros / 1e6)
+
+
+command_metrics_listener = CommandMetricsListener()
+
+
+def _client_kwargs():
+    # pymongo_extra is documented to be a part of MONGO option but used to be read from the top level
+    client_kwargs = dict(app.config.db.get("pymongo_extra", {}))
+    client_kwargs.update(app.config.db["MONGO"].get("pymongo_extra", {}))
+    client_kwargs.setdefault("serverSelectionTimeoutMS", DEFAULT_SERVER_SELECTION_TIMEOUT_MS)
+    client_kwargs["event_listeners"] = list(client_kwargs.get("event_listeners", [])) + \
+        [command_metrics_listener, query_profile_listener]
+    return client_kwargs
+
+
 class IncompleteObject(Exception):
     pass
 
 class QueryPermissionsUpdateFailed(Exception):
     pass
 
+# objects are prefetched with their relations in batches of this size
+PREFETCH_BATCH_SIZE = 1000
+
+
 class ObjectsCursor(object):
 
-    def __init__(self, cursor, obj_class):
+    def __init__(self, cursor, obj_class, read_only=False, fields=None, query=None, find_kwargs=None):
         self.obj_class = obj_class
         self.cursor = cursor
+        self.read_only = read_only
+        self.fields = fields
+        # query, find() arguments and modifiers are kept to be able
+        # to rebuild the cursor with a projection, see only()
+        self.query = query
+        self.find_kwargs = find_kwargs or {}
+        self.modifiers = []
+        self.relations = None
+        # (max_rows, callbacks) set by materialize()
+        self._materialize = None
 
     def all(self):
         return list(self)
 
     def limit(self, *args, **kwargs):
         self.cursor.limit(*args, **kwargs)
+        self.modifiers.append(("limit", args, kwargs))
         return self
 
     def skip(self, *args, **kwargs):
         self.cursor.skip(*args, **kwargs)
+        self.modifiers.append(("skip", args, kwargs))
         return self
 
     def sort(self, *args, **kwargs):
         self.cursor.sort(*args, **kwargs)
+        self.modifiers.append(("sort", args, kwargs))
         return self
 
-    def __iter__(self):
+    def only(self, fields):
+        """
+        only returns a new cursor fetching just the stored fields required to render
+        the given fields. The cursor itself is returned if it's projected already or
+        the projection can't be built
+        """
+        if self.fields is not None or self.query is None:
+            return self
+        projection = self.obj_class.get_projection(fields)
+        if projection is None:
+            return self
+        cursor = self.cursor.collection.find(self.query, projection=projection, **self.find_kwargs)
+        for name, args, kwargs in self.modifiers:
+            getattr(cursor, name)(*args, **kwargs)
+        objects_cursor = ObjectsCursor(cursor, self.obj_class, True, projection, self.query, self.find_kwargs)
+        objects_cursor.modifiers = self.modifiers[:]
+        objects_cursor.relations = self.relations
+        return objects_cursor
+
+    def prefetch(self, relations):
+        """
+        prefetch makes the cursor load the given relations (see StorableModel.prefetch)
+        for every batch of objects it yields so the number of queries doesn't depend
+        on the number of objects
+        """
+        self.relations = relations or None
+        return self
+
+    def materialize(self, max_rows, callback):
+        """
+        materialize makes the cursor pass a MaterializedResult with copies of the rows
+        to callback once they are all read unless there are more than max_rows of them
+        or the cursor has been modified with limit(), skip() or sort() before that
+        """
+        if self._materialize is None:
+            self._materialize = (max_rows, [])
+        self._materialize[1].append(callback)
+
+    def _items(self):
+        from app.models.storable_model import copy_state
+        if self._materialize is None or len(self.modifiers) > 0:
+            for item in self.cursor:
+                yield item
+            return
+
+        max_rows, callbacks = self._materialize
+        self._materialize = None
+        rows = []
         for item in self.cursor:
-            yield self.obj_class(**item)
+            if rows is not None:
+                if len(rows) < max_rows:
+                    # objects share values with the items, rows must stay intact
+                    rows.append(copy_state(item))
+                else:
+                    rows = None
+            yield item
+        if rows is not None:
+            result = MaterializedResult(tuple(rows), self.obj_class, self.read_only, self.fields,
+                                        self.query, self.find_kwargs)
+            for callback in callbacks:
+                callback(result)
+
+    def __iter__(self):
+        if self.relations is None:
+            for item in self._items():
+                yield self.obj_class(_read_only=self.read_only, _fields=self.fields, **item)
+            return
+
+        batch = []
+        for item in self._items():
+            batch.append(self.obj_class(_read_only=self.read_only, _fields=self.fields, **item))
+            if len(batch) == PREFETCH_BATCH_SIZE:
+                self.obj_class.prefetch(batch, self.relations)
+                for obj in batch:
+                    yield obj
+                batch = []
+        if len(batch) > 0:
+            self.obj_class.prefetch(batch, self.relations)
+            for obj in batch:
+                yield obj
 
     def __getitem__(self, item):
-        return self.obj_class(**self.cursor.__getitem__(item))
+        return self.obj_class(_read_only=self.read_only, _fields=self.fields, **self.cursor.__getitem__(item))
 
     def __getattr__(self, item):
         return getattr(self.cursor, item)
 
 
+class MaterializedResult(object):
+    """
+    MaterializedResult keeps all the rows of a query read by a cursor along with
+    the way they were queried, see ObjectsCursor.materialize(). Rows must never be modified,
+    cursors over them are created with cursor()
+    """
+
+    __slots__ = ("rows", "obj_class", "read_only", "fields", "query", "find_kwargs")
+
+    def __init__(self, rows, obj_class, read_only, fields, query, find_kwargs):
+        self.rows = rows
+        self.obj_class = obj_class
+        self.read_only = read_only
+        self.fields = fields
+        self.query = query
+        self.find_kwargs = find_kwargs
+
+    def cursor(self):
+        return RowsCursor(self)
+
+
+class RowsCursor(ObjectsCursor):
+    """
+    RowsCursor is an ObjectsCursor yielding objects from the rows of a MaterializedResult.
+    skip(), limit() and count() are served from memory while anything else, i.e. sort(),
+    makes it re-issue the query and fall back to a real cursor
+    """
+
+    def __init__(self, result):
+        ObjectsCursor.__init__(self, None, result.obj_class, result.read_only, result.fields,
+                               result.query, result.find_kwargs)
+        self.result = result
+        self._skip = 0
+        self._limit = 0
+
+    @property
+    def is_live(self):
+        return self.cursor is not None
+
+    def _go_live(self):
+        if self.is_live:
+            return
+        from library.engine.cache import count_request_reexec
+        count_request_reexec()
+        cursor = db.get_objs(self.obj_class, self.obj_class.collection, self.query,
+                             read_only=self.read_only, fields=self.fields, **self.find_kwargs).cursor
+        for name, args, kwargs in self.modifiers:
+            getattr(cursor, name)(*args, **kwargs)
+        self.cursor = cursor
+
+    def _rows(self):
+        rows = self.result.rows[self._skip:]
+        if self._limit > 0:
+            rows = rows[:self._limit]
+        return rows
+
+    def limit(self, limit):
+        if self.is_live:
+            return ObjectsCursor.limit(self, limit)
+        self._limit = limit
+        self.modifiers.append(("limit", (limit,), {}))
+        return self
+
+    def skip(self, skip):
+        if self.is_live:
+            return ObjectsCursor.skip(self, skip)
+        self._skip = skip
+        self.modifiers.append(("skip", (skip,), {}))
+        return self
+
+    def sort(self, *args, **kwargs):
+        self._go_live()
+        return ObjectsCursor.sort(self, *args, **kwargs)
+
+    def count(self, with_limit_and_skip=False):
+        if self.is_live:
+            return self.cursor.count(with_limit_and_skip)
+        if with_limit_and_skip:
+            return len(self._rows())
+        return len(self.result.rows)
+
+    def only(self, fields):
+        if self.is_live:
+            return ObjectsCursor.only(self, fields)
+        # complete objects are in memory already
+        return self
+
+    def materialize(self, max_rows, callback):
+        if not self.is_live and len(self.modifiers) == 0 and len(self.result.rows) <= max_rows:
+            callback(self.result)
+
+    def _items(self):
+        from app.models.storable_model import copy_state
+        if self.is_live:
+            for item in ObjectsCursor._items(self):
+                yield item
+            return
+        for row in self._rows():
+            yield copy_state(row)
+
+    def __getitem__(self, item):
+        from app.models.storable_model import copy_state
+        if self.is_live or not isinstance(item, (int, long)):
+            self._go_live()
+            return ObjectsCursor.__getitem__(self, item)
+        return self.obj_class(_read_only=self.read_only, _fields=self.fields, **copy_state(self._rows()[item]))
+
+    def __getattr__(self, item):
+        # any other pymongo cursor method
+        self._go_live()
+        return getattr(self.cursor, item)
+
+
 class DB(object):
     def __init__(self):
         self._conn = None
         self._ro_conn = None
+        self._secondary_conn = None
+        retry_options = dict(DEFAULT_RETRY_OPTIONS)
+        retry_options.update(app.config.db.get("MONGO_RETRY", {}))
+        self.retry_policy = RetryPolicy(ServerSelectionTimeoutError, **retry_options)
+        breaker_options = dict(DEFAULT_CIRCUIT_BREAKER_OPTIONS)
+        breaker_options.update(app.config.db.get("MONGO_CIRCUIT_BREAKER", {}))
+        # breakers are per connection, reads may go on while the primary is down
+        self.rw_breaker = CircuitBreaker(**breaker_options)
+        self.ro_breaker = CircuitBreaker(**breaker_options)
+
+    def _on_rw_breaker_open(self):
+        app.logger.error("Mongo read/write connection is failing, rejecting read/write "
+                         "operations for %.1f seconds" % self.rw_breaker.recovery_timeout)
+
+    def _on_ro_breaker_open(self):
+        app.logger.error("Mongo readonly connection is failing, rejecting readonly "
+                         "operations for %.1f seconds" % self.ro_breaker.recovery_timeout)
 
     def reset_conn(self):
         self._conn = None
 
     def reset_ro_conn(self):
         self._ro_conn = None
+        self._secondary_conn = None
 
     def init_ro_conn(self):
         app.logger.info("Creating a read-only mongo connection")
-        client_kwargs = app.config.db.get("pymongo_extra", {})
+        client_kwargs = _client_kwargs()
         database = app.config.db["MONGO"]['dbname']
         if "uri_ro" in app.config.db["MONGO"]:
             ro_client = MongoClient(host=app.config.db["MONGO"]["uri_ro"], **client_kwargs)
@@ -129,7 +396,7 @@ class DB(object):
 
     def init_conn(self):
         app.logger.info("Creating a read/write mongo connection")
-        client_kwargs = app.config.db.get("pymongo_extra", {})
+        client_kwargs = _client_kwargs()
         client = MongoClient(host=app.config.db["MONGO"]["uri"], **client_kwargs)
         database = app.config.db["MONGO"]['dbname']
 
@@ -152,25 +419,81 @@ class DB(object):
             self.init_ro_conn()
         return self._ro_conn
 
+    @property
+    def secondary_conn(self):
+        # shares the client (and the connection pool) with ro_conn
+        if self._secondary_conn is None:
+            max_staleness = app.config.db.get("MONGO_MAX_STALENESS_SECONDS", DEFAULT_MAX_STALENESS_SECONDS)
+            self._secondary_conn = self.ro_conn.client.get_database(
+                self.ro_conn.name,
+                read_preference=SecondaryPreferred(max_staleness=max_staleness)
+            )
+        return self._secondary_conn
+
+    # READ PREFERENCES
+    #
+    # Reads go to ro_conn unless the current request has allowed reading from
+    # secondaries (open blueprint and list endpoints) or has been pinned to the primary.
+    # A request is pinned to the primary by its first write, or from the start if it's
+    # not a GET one, and stays pinned till its end so it always reads its own writes
+
+    @property
+    def primary_pinned(self):
+        return has_app_context() and getattr(g, "_db_primary_pinned", False)
+
+    @property
+    def secondary_reads_allowed(self):
+        return has_app_context() and getattr(g, "_db_secondary_reads", False) and not self.primary_pinned
+
+    def pin_primary(self):
+        if has_app_context():
+            g._db_primary_pinned = True
+
+    def _written(self, collection=None):
+        # reads following a write during the request must see it, collection is given
+        # for writes changing documents without their instances, see identity_map.forget
+        self.pin_primary()
+        if has_app_context():
+            drop_request_results()
+        if collection is not None:
+            identity_map.forget(collection)
+
+    def allow_secondary_reads(self):
+        if has_app_context():
+            g._db_secondary_reads = True
+
+    @property
+    def read_conn(self):
+        if self.primary_pinned:
+            return self.conn
+        if self.secondary_reads_allowed:
+            return self.secondary_conn
+        return self.ro_conn
+
     @intercept_mongo_errors_ro
-    def get_obj(self, cls, collection, query):
+    def get_obj(self, cls, collection, query, read_only=False, fields=None):
         if type(query) is not dict:
             try:
                 query = { '_id': ObjectId(query) }
             except InvalidId:
                 pass
-        data = self.ro_conn[collection].find_one(query)
+        data = self.read_conn[collection].find_one(query, projection=fields)
         if data:
-            return cls(**data)
+            return cls(_read_only=read_only or fields is not None, _fields=fields, **data)
 
     @intercept_mongo_errors_ro
     def get_obj_id(self, collection, query):
-        return self.ro_conn[collection].find_one(query, projection=())['_id']
+        return self.read_conn[collection].find_one(query, projection=())['_id']
 
     @intercept_mongo_errors_ro
-    def get_objs(self, cls, collection, query, **kwargs):
-        cursor = self.ro_conn[collection].find(query, **kwargs)
-        return ObjectsCursor(cursor, cls)
+    def get_objs(self, cls, collection, query, read_only=False, fields=None, **kwargs):
+        if fields is not None:
+            # partial objects can't be saved
+            read_only = True
+            cursor = self.read_conn[collection].find(query, projection=fields, **kwargs)
+        else:
+            cursor = self.read_conn[collection].find(query, **kwargs)
+        return ObjectsCursor(cursor, cls, read_only, fields, query, kwargs)
 
     def get_objs_by_field_in(self, cls, collection, field, values, **kwargs):
         return self.get_objs(
@@ -184,30 +507,128 @@ class DB(object):
             **kwargs
         )
 
+    @staticmethod
+    def _update_request(obj):
+        # builds a (query, update) pair for a partial update of the object's
+        # changed fields, returns None if nothing has been changed
+        changed, removed = obj.get_changes()
+        if len(changed) == 0 and len(removed) == 0:
+            return None
+        update = {}
+        if len(changed) > 0:
+            update["$set"] = changed
+        if len(removed) > 0:
+            update["$unset"] = dict([(x, "") for x in removed])
+        query = {'_id': obj._id}
+        if obj.OPTIMISTIC_LOCK_FIELD is not None:
+            query[obj.OPTIMISTIC_LOCK_FIELD] = obj._initial_state.get(obj.OPTIMISTIC_LOCK_FIELD)
+        return query, update
+
     @intercept_mongo_errors_rw
     def save_obj(self, obj):
+        from library.engine.errors import ConcurrentModification
+        self._written()
         if obj.is_new:
             data = obj.to_dict(include_restricted=True)    # object to_dict() method should always return all fields
             del(data["_id"])        # although with the new object we shouldn't pass _id=null to mongo
             inserted_id = self.conn[obj.collection].insert_one(data).inserted_id
             obj._id = inserted_id
         else:
-            self.conn[obj.collection].replace_one({'_id': obj._id}, obj.to_dict(include_restricted=True), upsert=True)
+            request = self._update_request(obj)
+            if request is None:
+                return
+            query, update = request
+            if self.conn[obj.collection].update_one(query, update).matched_count == 0:
+                if obj.OPTIMISTIC_LOCK_FIELD is not None and \
+                        self.conn[obj.collection].find_one({'_id': obj._id}, projection=()) is not None:
+                    raise ConcurrentModification("%s %s has been modified by someone else" %
+                                                 (obj.__class__.__name__, obj._id))
+                # the document has been deleted in the meantime
+                self.conn[obj.collection].replace_one({'_id': obj._id}, obj.to_dict(include_restricted=True),
+                                                      upsert=True)
+
+    @intercept_mongo_errors_rw
+    def save_objs(self, objs):
+        """
+        save_objs saves a list of objects of the same collection using a single
+        unordered bulk write. New objects are inserted with ids generated on the
+        client side, existing ones are updated partially like in save_obj.
+        Returns a list of (obj, error) tuples for objects failed to be written
+        """
+        from library.engine.errors import ObjectSaveFailed, ConcurrentModification
+        if len(objs) == 0:
+            return []
+        collection = objs[0].collection
+        lock_field = objs[0].OPTIMISTIC_LOCK_FIELD
+        self._written()
+
+        requests = []
+        request_objs = []
+        for obj in objs:
+            if obj.is_new:
+                obj._id = ObjectId()
+                requests.append(InsertOne(obj.to_dict(include_restricted=True)))
+                request_objs.append(obj)
+            else:
+                request = self._update_request(obj)
+                if request is None:
+                    continue
+                requests.append(UpdateOne(*request))
+                request_objs.append(obj)
+        if len(requests) == 0:
+            return []
+
+        failed = []
+        failed_idx = set()
+        try:
+            result = self.conn[collection].bulk_write(requests, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+            for error in result.get("writeErrors", []):
+                i = error["index"]
+                failed_idx.add(i)
+                if isinstance(requests[i], InsertOne):
+                    request_objs[i]._id = None
+                failed.append((request_objs[i], ObjectSaveFailed(error.get("errmsg", "write error"))))
+
+        updated = [request_objs[i] for i, x in enumerate(requests) if isinstance(x, UpdateOne) and i not in failed_idx]
+        if result.get("nMatched", 0) < len(updated):
+            # some of the documents have been either deleted or modified concurrently
+            projection = [lock_field] if lock_field is not None else ()
+            docs = self.conn[collection].find({'_id': {'$in': [x._id for x in updated]}}, projection=projection)
+            docs = dict([(x['_id'], x) for x in docs])
+            for obj in updated:
+                doc = docs.get(obj._id)
+                if doc is None:
+                    self.conn[collection].replace_one({'_id': obj._id}, obj.to_dict(include_restricted=True),
+                                                      upsert=True)
+                elif lock_field is not None and doc.get(lock_field) != getattr(obj, lock_field):
+                    failed.append((obj, ConcurrentModification("%s %s has been modified by someone else" %
+                                                               (obj.__class__.__name__, obj._id))))
+        return failed
 
     @intercept_mongo_errors_rw
     def delete_obj(self, obj):
         if obj.is_new:
             return
+        self._written()
         self.conn[obj.collection].delete_one({'_id': obj._id})
 
     @intercept_mongo_errors_rw
     def delete_query(self, collection, query):
+        self._written(collection)
         return self.conn[collection].delete_many(query)
 
     @intercept_mongo_errors_rw
     def update_query(self, collection, query, update):
+        self._written(collection)
         return self.conn[collection].update_many(query, update)
 
+    @intercept_mongo_errors_rw
+    def bulk_write(self, collection, requests):
+        self._written(collection)
+        return self.conn[collection].bulk_write(requests, ordered=False)
+
     # SESSIONS
 
     @intercept_mongo_errors_ro
@@ -216,16 +637,17 @@ class DB(object):
 
     @intercept_mongo_errors_rw
     def update_session(self, sid, data, expiration, collection='sessions'):
+        # expired sessions are removed by mongodb, see the index command
         self.conn[collection].update({ 'sid': sid }, { 'sid': sid, 'data': data, 'expiration': expiration }, True)
-        if app.config.app.get("SESSIONS_AUTO_CLEANUP", False):
-            rtrigger = app.config.app.get("SESSIONS_AUTO_CLEANUP_RAND_TRIGGER", 0.05)
-            if random() < rtrigger:
-                app.logger.info("Cleaning up sessions")
-                self.cleanup_sessions()
+
+    @intercept_mongo_errors_rw
+    def delete_session(self, sid, collection='sessions'):
+        self.conn[collection].delete_one({ 'sid': sid })
 
     @intercept_mongo_errors_rw
     def cleanup_sessions(self, collection='sessions'):
-        return self.conn[collection].remove({'expiration': {'$lt': datetime.now() }})["n"]
+        # session expiration times are in UTC, see MongoSessionInterface
+        return self.conn[collection].remove({'expiration': {'$lt': datetime.utcnow() }})["n"]
 
 
 db = DB()
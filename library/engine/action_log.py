@@ -1,12 +1,145 @@
 from flask import g
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock
+import atexit
 import functools
 import json
-import copy
+import os
+import time
 from library.engine.errors import ApiError, handle_other_errors, handle_api_error
 
+# defaults for ACTION_LOG_QUEUE_SIZE and ACTION_LOG_MAX_ITEMS app configuration options
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_MAX_ITEMS = 100
+# actions written by the background thread within one app context
+WRITE_BATCH_SIZE = 100
+# seconds to wait for the queued actions to be written at exit
+EXIT_FLUSH_TIMEOUT = 5.0
+
 action_types = []
 
 
+def summarize(value, max_items=DEFAULT_MAX_ITEMS):
+    """
+    summarize returns a copy of request params to be logged with lists cut to max_items,
+    dicts containing cut lists get a "_truncated" dict with the original lengths of them
+    """
+    if isinstance(value, dict):
+        result = {}
+        truncated = {}
+        for k, v in value.iteritems():
+            if isinstance(v, list) and len(v) > max_items:
+                truncated[k] = len(v)
+            result[k] = summarize(v, max_items)
+        if len(truncated) > 0:
+            result["_truncated"] = truncated
+        return result
+    if isinstance(value, list):
+        return [summarize(x, max_items) for x in value[:max_items]]
+    return value
+
+
+class ActionLogWriter(object):
+    """
+    ActionLogWriter saves ApiAction objects in a background thread so computing their
+    fields and writing them doesn't delay responses. The queue is bounded, once it's full
+    actions are saved in the calling thread
+    """
+
+    def __init__(self, max_size=DEFAULT_QUEUE_SIZE):
+        self.max_size = max_size
+        self.queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = Lock()
+
+    def put(self, action):
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(action)
+        except Full:
+            from app import app
+            app.logger.warn("Action log queue is full, action '%s' is written synchronously" %
+                            action.action_type)
+            self._write([action])
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # neither the thread nor the queue locks survive forking of workers
+                self.queue = Queue(self.max_size)
+                self._pid = os.getpid()
+            self._thread = Thread(target=self._run, name="action-log")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < WRITE_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    @staticmethod
+    def _write(actions):
+        from app import app
+        with app.flask.app_context():
+            for action in actions:
+                try:
+                    action.save()
+                except Exception as e:
+                    app.logger.error("Error writing action '%s': %s" % (action.action_type, e))
+
+    def flush(self, timeout=None):
+        """
+        flush waits for the queued actions to be written, returns False on timeout
+        """
+        if self.queue is None or self._pid != os.getpid():
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks > 0:
+                if deadline is None:
+                    self.queue.all_tasks_done.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+
+_writer = None
+_writer_lock = Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            from app import app
+            _writer = ActionLogWriter(app.config.app.get("ACTION_LOG_QUEUE_SIZE", DEFAULT_QUEUE_SIZE))
+            atexit.register(_writer.flush, EXIT_FLUSH_TIMEOUT)
+    return _writer
+
+
+def write_action(action):
+    from app import app
+    if app.config.app.get("ACTION_LOG_ASYNC", True):
+        get_writer().put(action)
+    else:
+        action.save()
+
+
 def logged_action(action_type):
     global action_types
     action_types.append(action_type)
@@ -26,7 +159,9 @@ def logged_action(action_type):
             else:
                 username = g.user.username
             if request.json is not None:
-                action_args = copy.deepcopy(request.json)
+                # large params, i.e. thousands of host_ids, are not worth logging in full
+                max_items = app.config.app.get("ACTION_LOG_MAX_ITEMS", DEFAULT_MAX_ITEMS)
+                action_args = summarize(request.json, max_items)
             else:
                 action_args = {}
 
@@ -65,7 +200,7 @@ def logged_action(action_type):
                 data = json.loads(response.data)
                 action.errors = data["errors"]
                 app.logger.debug("action '%s' status updated to %s" % (action.action_type, action.status))
-                action.save()
+                write_action(action)
                 raise
             except Exception as e:
                 action.status = "error"
@@ -73,10 +208,10 @@ def logged_action(action_type):
                 data = json.loads(response.data)
                 action.errors = data["errors"]
                 app.logger.debug("action '%s' status updated to %s" % (action.action_type, action.status))
-                action.save()
+                write_action(action)
                 raise
             app.logger.debug("action '%s' status updated to %s" % (action.action_type, action.status))
-            action.save()
+            write_action(action)
             return response
         return wrapper
     return log_action_decorator
@@ -5,14 +5,17 @@ import importlib
 import logging
 import time
 from logging.handlers import WatchedFileHandler
-from flask import Flask, request, session
+from flask import Flask, request, g
 from datetime import timedelta
 from collections import namedtuple
 from library.engine.utils import get_py_files, uuid4_string
 from library.engine.errors import ApiError, handle_api_error, handle_other_errors
 from library.engine.json_encoder import MongoJSONEncoder
-from library.mongo_session import MongoSessionInterface
-from werkzeug.contrib.cache import MemcachedCache, SimpleCache
+from library.mongo_session import MongoSessionInterface, DEFAULT_SESSION_REFRESH_INTERVAL
+from werkzeug.contrib.cache import MemcachedCache, SimpleCache, FileSystemCache
+from library.engine.cache import LocalLRUCache, DEFAULT_LOCAL_CACHE_SIZE
+from library.engine.metrics import REQUEST_DURATION
+from library.engine.profiler import start_request_profile, finish_request_profile
 
 ENVIRONMENT_TYPES = (
     "development",
@@ -53,6 +56,7 @@ class BaseApp(object):
         self.__set_session_expiration()
         self.__set_request_id()
         self.__set_request_times()
+        self.__set_query_profiler()
         self.__set_cache()
         self.__set_token_expiration()
         self.__init_plugins()
@@ -76,8 +80,22 @@ class BaseApp(object):
         self.logger.debug("Setting up the cache")
         if hasattr(self.config, 'cache') and "MEMCACHE_BACKENDS" in self.config.cache:
             self.cache = MemcachedCache(self.config.cache["MEMCACHE_BACKENDS"])
+            self.cache_shared = True
         else:
+            # the cache is per-process, values which must be invalidated
+            # across workers can't be kept in it, see cache_shared
             self.cache = SimpleCache()
+            self.cache_shared = False
+        local_cache_size = DEFAULT_LOCAL_CACHE_SIZE
+        if hasattr(self.config, 'cache'):
+            local_cache_size = self.config.cache.get("LOCAL_CACHE_SIZE", local_cache_size)
+        self.local_cache = LocalLRUCache(local_cache_size)
+        # rendered responses may be too large for memcached, a local directory can be used instead
+        if hasattr(self.config, 'cache') and "RENDER_CACHE_DIR" in self.config.cache:
+            self.render_cache = FileSystemCache(self.config.cache["RENDER_CACHE_DIR"],
+                                                threshold=self.config.cache.get("RENDER_CACHE_THRESHOLD", 500))
+        else:
+            self.render_cache = self.cache
 
     def __load_plugins(self):
         self.plugins = {
@@ -136,11 +154,9 @@ class BaseApp(object):
             self.logger.debug("Authorizer '%s' registered" % authorizer_name)
 
     def __set_session_expiration(self):
+        # sessions are always permanent, see MongoSession
         e_time = self.config.app.get("SESSION_EXPIRATION_TIME", DEFAULT_SESSION_EXPIRATION_TIME)
-        @self.flask.before_request
-        def session_expiration():
-            session.permanent = True
-            self.flask.permanent_session_lifetime = timedelta(seconds=e_time)
+        self.flask.permanent_session_lifetime = timedelta(seconds=e_time)
 
     def __set_request_id(self):
         @self.flask.before_request
@@ -149,16 +165,38 @@ class BaseApp(object):
                 setattr(request, "id", uuid4_string())
 
     def __set_request_times(self):
-        if self.config.log.get("LOG_TIMINGS"):
-            @self.flask.before_request
-            def add_request_started_time():
-                setattr(request, "started", time.time())
-
-            @self.flask.after_request
-            def add_request_time_logging(response):
-                dt = time.time() - request.started
-                self.logger.info("%s completed in %.3fs" % (request.path, dt))
+        log_timings = self.config.log.get("LOG_TIMINGS")
+
+        @self.flask.before_request
+        def add_request_started_time():
+            setattr(request, "started", time.time())
+
+        @self.flask.after_request
+        def add_request_time_metrics(response):
+            if not hasattr(request, "started"):
+                # another before_request handler has responded first
                 return response
+            dt = time.time() - request.started
+            REQUEST_DURATION.labels(request.blueprint or "", request.endpoint or "",
+                                    request.method, response.status_code).observe(dt)
+            if log_timings:
+                self.logger.info("%s completed in %.3fs" % (request.path, dt))
+            return response
+
+    def __set_query_profiler(self):
+        sample_rate = self.config.app.get("QUERY_PROFILE_SAMPLE_RATE", 0)
+
+        @self.flask.before_request
+        def start_query_profile():
+            start_request_profile(sample_rate)
+
+        @self.flask.after_request
+        def finish_query_profile(response):
+            # profiles are revealed to supervisors only as they expose queries
+            # and the code they're made from
+            user = getattr(g, "user", None)
+            reveal = self.envtype == "development" or (user is not None and user.supervisor)
+            return finish_request_profile(response, reveal)
 
     def __prepare_flask(self):
         self.logger.debug("Creating flask app")
@@ -175,7 +213,9 @@ class BaseApp(object):
         self.logger.debug("Setting JSON Encoder")
         self.flask.json_encoder = MongoJSONEncoder
         self.logger.debug("Setting sessions interface")
-        self.flask.session_interface = MongoSessionInterface(collection_name='sessions')
+        refresh_interval = self.config.app.get("SESSION_REFRESH_INTERVAL", DEFAULT_SESSION_REFRESH_INTERVAL)
+        self.flask.session_interface = MongoSessionInterface(collection_name='sessions',
+                                                             refresh_interval=refresh_interval)
         self.flask._register_error_handler(None, ApiError, handle_api_error)
         self.flask._register_error_handler(None, Exception, handle_other_errors)
         self.configure_routes()
@@ -1,14 +1,70 @@
 import functools
+import logging
+import zlib
+from collections import OrderedDict
 from datetime import datetime
+from threading import Lock, Thread
+from uuid import uuid4
 from flask import request, g
+from library.engine.metrics import count_cache_request
 
 DEFAULT_CACHE_PREFIX = 'microeng'
 DEFAULT_CACHE_TIMEOUT = 3600
+DEFAULT_LOCAL_CACHE_SIZE = 10000
+# number of urls of rendered responses remembered to be pre-warmed
+PREWARM_URLS_SIZE = 100
+# default for REQUEST_CACHE_MAX_ROWS cache option, results of larger queries
+# are not kept by request_time_cache
+DEFAULT_REQUEST_CACHE_MAX_ROWS = 1000
+# default for RENDER_CACHE_MAX_SIZE cache option, larger rendered responses
+# are streamed without being buffered and cached
+DEFAULT_RENDER_CACHE_MAX_SIZE = 16 * 1024 * 1024
+# memcached rejects items over 1MB
+RENDER_CACHE_MAX_ITEM_SIZE = 1000 * 1000
+
+_missing = object()
+# request cache entry of a cursor which hasn't been read completely yet
+_pending = object()
+
+
+def freeze(value):
+    """
+    freeze converts a value to a hashable one to be used as a part of a cache key.
+    Objects providing _cache_identity() (i.e. models) are represented by their identity,
+    dicts and lists are converted to tuples recursively
+    """
+    if isinstance(value, type):
+        # classes, i.e. cls of cached classmethods, are hashable as they are
+        return value
+    if hasattr(value, "_cache_identity"):
+        return value._cache_identity()
+    if isinstance(value, dict):
+        return (dict,) + tuple(sorted([(k, freeze(v)) for k, v in value.iteritems()]))
+    if isinstance(value, (list, tuple)):
+        return tuple([freeze(x) for x in value])
+    if isinstance(value, (set, frozenset)):
+        return frozenset([freeze(x) for x in value])
+    return value
 
 
 def _get_cache_key(pref, funcname, args, kwargs):
+    key = (pref, funcname, freeze(args), freeze(kwargs) if kwargs else None)
+    try:
+        hash(key)
+    except TypeError:
+        # unknown unhashable arguments, fall back to their string representation
+        key = (pref, funcname, repr(key))
+    return key
+
+
+def _get_shared_cache_key(key):
     from hashlib import md5
-    key = "%s:%s(%s.%s)" % (pref, funcname, md5(str(args)).hexdigest(), md5(str(kwargs)).hexdigest())
+    return "%s:%s(%s)" % (key[0], key[1], md5(repr(key[2:])).hexdigest())
+
+
+def _get_cached_call(pref, funcname, args, kwargs):
+    # human readable representation of a call, it's expensive
+    # so it should be generated for debug logging only
     kwargs_str = ", ".join(["%s=%s" % (x[0], x[1]) for x in kwargs.items()])
     arguments = ""
     if len(args) > 0:
@@ -18,8 +74,12 @@ def _get_cache_key(pref, funcname, args, kwargs):
     else:
         if len(kwargs) > 0:
             arguments = kwargs
-    cached_call = "%s:%s(%s)" % (pref, funcname, arguments)
-    return key, cached_call
+    return "%s:%s(%s)" % (pref, funcname, arguments)
+
+
+def _debug_enabled():
+    from app import app
+    return app.logger.isEnabledFor(logging.DEBUG)
 
 
 def cached_function(cache_key_prefix=DEFAULT_CACHE_PREFIX, cache_timeout=DEFAULT_CACHE_TIMEOUT, positive_only=False):
@@ -27,17 +87,23 @@ def cached_function(cache_key_prefix=DEFAULT_CACHE_PREFIX, cache_timeout=DEFAULT
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             from app import app
-            cache_key, cached_call = _get_cache_key(cache_key_prefix, func.__name__, args, kwargs)
+            cache_key = _get_shared_cache_key(_get_cache_key(cache_key_prefix, func.__name__, args, kwargs))
             t1 = datetime.now()
 
             if app.cache.has(cache_key):
                 value = app.cache.get(cache_key)
-                app.logger.debug("Cache HIT %s (%.3f seconds)" % (cached_call, (datetime.now() - t1).total_seconds()))
+                count_cache_request("function", "hit")
+                if _debug_enabled():
+                    cached_call = _get_cached_call(cache_key_prefix, func.__name__, args, kwargs)
+                    app.logger.debug("Cache HIT %s (%.3f seconds)" % (cached_call, (datetime.now() - t1).total_seconds()))
             else:
                 value = func(*args, **kwargs)
                 if value or not positive_only:
                     app.cache.set(cache_key, value, timeout=cache_timeout)
-                app.logger.debug("Cache MISS %s (%.3f seconds)" % (cached_call, (datetime.now() - t1).total_seconds()))
+                count_cache_request("function", "miss")
+                if _debug_enabled():
+                    cached_call = _get_cached_call(cache_key_prefix, func.__name__, args, kwargs)
+                    app.logger.debug("Cache MISS %s (%.3f seconds)" % (cached_call, (datetime.now() - t1).total_seconds()))
             return value
         return wrapper
     return cache_decorator
@@ -57,6 +123,40 @@ def check_cache():
         return True
 
 
+# counters by request_time_cache results: a "reexec" is a call of a function
+# which has been called during the request already but its result couldn't be kept
+_request_cache_stats = {
+    "hit": 0,
+    "miss": 0,
+    "reexec": 0,
+}
+
+
+def request_cache_stats():
+    return dict(_request_cache_stats)
+
+
+def count_request_reexec():
+    # a cursor over cached rows has to re-issue its query, see RowsCursor
+    _request_cache_stats["reexec"] += 1
+    count_cache_request("request", "reexec")
+
+
+def drop_request_results():
+    """
+    drop_request_results removes everything kept by request_time_cache so the following
+    calls read the data again. Objects looked up by id are still served by the identity map
+    """
+    request_cache = getattr(g, "_request_local_cache", None)
+    if request_cache is not None:
+        request_cache.clear()
+
+
+def _request_cache_max_rows():
+    from app import app
+    return getattr(app.config, "cache", {}).get("REQUEST_CACHE_MAX_ROWS", DEFAULT_REQUEST_CACHE_MAX_ROWS)
+
+
 def request_time_cache(cache_key_prefix=DEFAULT_CACHE_PREFIX):
     """
     Decorator used for caching data during one api request.
@@ -65,79 +165,294 @@ def request_time_cache(cache_key_prefix=DEFAULT_CACHE_PREFIX):
     I.e. list of 20 hosts included in the same group and inheriting the same set of tags/custom fields
     may produce 20 additional db requests and 20 requests for each parent group recursively. This may be fixed
     by caching db responses in flask "g" store.
+
+    Cursors are not cached themselves: once a cursor is read completely its rows are kept
+    (see ObjectsCursor.materialize) and the following calls get new cursors over them.
+    Until then, or if the cursor has been modified or has more than REQUEST_CACHE_MAX_ROWS
+    rows, calls are re-executed.
     """
     def cache_decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             from app import app
-            from library.db import ObjectsCursor
+            from library.db import ObjectsCursor, MaterializedResult
             try:
                 request_id = request.id
             except (RuntimeError, AttributeError):
                 # cache only if request id is available
                 return func(*args, **kwargs)
-            cache_key, cached_call = _get_cache_key(cache_key_prefix, func.__name__, args, kwargs)
+            cache_key = _get_cache_key(cache_key_prefix, func.__name__, args, kwargs)
             t1 = datetime.now()
 
             if not hasattr(g, "_request_local_cache"):
                 g._request_local_cache = {}
+            request_cache = g._request_local_cache
 
-            if cache_key not in g._request_local_cache:
+            value = request_cache.get(cache_key, _missing)
+            if value is _missing or value is _pending:
+                result = "miss" if value is _missing else "reexec"
                 value = func(*args, **kwargs)
-                g._request_local_cache[cache_key] = value
-                ts = (datetime.now() - t1).total_seconds()
-                app.logger.debug("RequestTimeCache %s MISS %s (%.3f seconds)" % (request_id, cache_key, ts))
+                if isinstance(value, ObjectsCursor):
+                    request_cache[cache_key] = _pending
+
+                    def store(materialized):
+                        request_cache[cache_key] = materialized
+
+                    value.materialize(_request_cache_max_rows(), store)
+                else:
+                    request_cache[cache_key] = value
             else:
-                value = g._request_local_cache[cache_key]
-                if type(value) == ObjectsCursor:
-                    value.cursor.rewind()
+                result = "hit"
+                if isinstance(value, MaterializedResult):
+                    value = value.cursor()
+
+            _request_cache_stats[result] += 1
+            count_cache_request("request", result)
+            if _debug_enabled():
                 ts = (datetime.now() - t1).total_seconds()
-                app.logger.debug("RequestTimeCache %s HIT %s (%.3f seconds)" % (request_id, cache_key, ts))
+                cached_call = _get_cached_call(cache_key_prefix, func.__name__, args, kwargs)
+                app.logger.debug("RequestTimeCache %s %s %s (%.3f seconds)" %
+                                 (request_id, result.upper(), cached_call, ts))
             return value
         return wrapper
     return cache_decorator
 
 
-def _get_custom_data_cache_key(obj):
+class LocalLRUCache(object):
+    """
+    LocalLRUCache is a process-local cache of limited size evicting least recently used items.
+    It's used as a first tier in front of app.cache to save round-trips to memcached.
+    Values are returned as they were stored so callers must not modify them
+    """
+
+    def __init__(self, max_size=DEFAULT_LOCAL_CACHE_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        with self._lock:
+            return self._data.items()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_inherited_cache_stats = {
+    "local_hits": 0,
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+}
+
+
+def inherited_cache_stats():
     from app import app
-    try:
-        model = type(obj).__name__
-        model_id = obj._id
-        return "%s.%s.custom_data" % (model, model_id)
-    except Exception as e:
-        app.logger.error("error generating custom_data cache key: %s" % e)
-        return None
+    stats = dict(_inherited_cache_stats)
+    stats["local_size"] = len(app.local_cache)
+    return stats
+
+
+def _get_generation_key(model_name, obj_id):
+    return "%s.%s.generation" % (model_name, obj_id)
+
+
+def get_generation(model_name, obj_id):
+    """
+    get_generation returns the current generation of an object stored in app.cache.
+    Generations are opaque values replaced by new_generation() whenever values cached
+    for the object become outdated. Losing a generation is safe as it only causes cache misses
+    """
+    from app import app
+    generation_key = _get_generation_key(model_name, obj_id)
+    generation = app.cache.get(generation_key)
+    if generation is None:
+        # another worker may be creating the generation at the same time,
+        # add() keeps the first one so all of them end up using the same value
+        app.cache.add(generation_key, uuid4().hex, timeout=DEFAULT_CACHE_TIMEOUT)
+        generation = app.cache.get(generation_key)
+    return generation
+
+
+def new_generation(model_name, obj_id):
+    from app import app
+    generation_key = _get_generation_key(model_name, obj_id)
+    app.cache.set(generation_key, uuid4().hex, timeout=DEFAULT_CACHE_TIMEOUT)
+    app.logger.debug("%s NEW generation" % generation_key)
 
 
-def cache_custom_data(func):
+def cache_inherited(func):
     """
-    cache_custom_data decorator is used to cache merged custom_data _forever_.
-    invalidating custom data cache should be done using recursive calls to invalidate_custom_data(obj)
+    cache_inherited decorator is used to cache values an object inherits from its parents,
+    i.e. custom_data. Values are shared across requests and workers via app.cache with
+    app.local_cache as a process-local tier in front of it. Nothing is cached unless app.cache
+    is shared (see cache_shared) as other workers couldn't invalidate the values.
+
+    The object's inherited_scope() returns a tuple (model_name, obj_id) of the object all
+    its parents belong to, i.e. the work group of a group. Cache keys include a generation
+    of the scope which is replaced by invalidate_inherited() so outdated values of all
+    the objects of the scope are never read again.
+    New and modified objects are not cached as their values differ from the saved ones.
     """
 
     @functools.wraps(func)
     def wrapper(self):
         from app import app
-        cache_key = _get_custom_data_cache_key(self)
-        if cache_key is None:
+        from app.models.storable_model import copy_state
+        if not app.cache_shared:
             return func(self)
+        if not self.is_read_only and (self.is_new or self.is_dirty):
+            return func(self)
+        scope = self.inherited_scope()
+        if scope is None:
+            return func(self)
+
+        model_name = type(self).__name__
+        generation = get_generation(*scope)
+        if generation is None:
+            return func(self)
+
+        cache_key = "%s.%s.%s.%s" % (model_name, self._id, generation, func.__name__)
+        debug = _debug_enabled()
+        if debug:
+            t1 = datetime.now()
+        value = app.local_cache.get(cache_key, _missing)
+        if value is not _missing:
+            _inherited_cache_stats["local_hits"] += 1
+            count_cache_request("inherited", "local_hit")
+            if debug:
+                app.logger.debug("%s LOCAL HIT (%.3f seconds)" % (cache_key, (datetime.now() - t1).total_seconds()))
+            return copy_state(value)
 
-        t1 = datetime.now()
-        if app.cache.has(cache_key):
-            value = app.cache.get(cache_key)
-            app.logger.debug("%s HIT (%.3f seconds)" % (cache_key, (datetime.now() - t1).total_seconds()))
+        value = app.cache.get(cache_key)
+        if value is not None:
+            _inherited_cache_stats["hits"] += 1
+            count_cache_request("inherited", "hit")
+            if debug:
+                app.logger.debug("%s HIT (%.3f seconds)" % (cache_key, (datetime.now() - t1).total_seconds()))
         else:
+            _inherited_cache_stats["misses"] += 1
+            count_cache_request("inherited", "miss")
             value = func(self)
-            app.cache.set(cache_key, value)
-            app.logger.debug("%s MISS (%.3f seconds)" % (cache_key, (datetime.now() - t1).total_seconds()))
-        return value
+            app.cache.set(cache_key, value, timeout=DEFAULT_CACHE_TIMEOUT)
+            if debug:
+                app.logger.debug("%s MISS (%.3f seconds)" % (cache_key, (datetime.now() - t1).total_seconds()))
+        app.local_cache.set(cache_key, value)
+        return copy_state(value)
 
     return wrapper
 
 
-def invalidate_custom_data(obj):
+def invalidate_inherited(model_name, obj_id):
+    # outdates the values cached by cache_inherited for all the objects of the scope
+    new_generation(model_name, obj_id)
+    _inherited_cache_stats["invalidations"] += 1
+
+
+def get_rendered(key):
+    """
+    get_rendered returns a tuple (content_type, body) of a rendered response
+    stored in app.render_cache or None if there's no such response
+    """
+    from app import app
+    value = app.render_cache.get("rendered.%s" % key)
+    if value is None:
+        count_cache_request("rendered", "miss")
+        return None
+    count_cache_request("rendered", "hit")
+    content_type, body = value
+    return content_type, zlib.decompress(body)
+
+
+def set_rendered(key, content_type, body):
+    # rendered inventories are large and compress well, returns False
+    # if the body is too large to be cached even compressed
+    from app import app
+    body = zlib.compress(body)
+    if len(body) > RENDER_CACHE_MAX_ITEM_SIZE:
+        return False
+    timeout = getattr(app.config, "cache", {}).get("RENDER_CACHE_TIMEOUT", DEFAULT_CACHE_TIMEOUT)
+    app.render_cache.set("rendered.%s" % key, (content_type, body), timeout=timeout)
+    return True
+
+
+def cache_rendered(chunks, key, content_type, url, keys):
+    """
+    cache_rendered passes the chunks of a response body through and stores the body
+    with set_rendered once it's over unless it exceeds RENDER_CACHE_MAX_SIZE, larger
+    bodies are not buffered any further. The url is remembered with remember_rendered_url
+    """
+    from app import app
+    max_size = getattr(app.config, "cache", {}).get("RENDER_CACHE_MAX_SIZE", DEFAULT_RENDER_CACHE_MAX_SIZE)
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        if buffered is not None:
+            size += len(chunk)
+            if size > max_size:
+                buffered = None
+            else:
+                buffered.append(chunk)
+        yield chunk
+    if buffered is not None and set_rendered(key, content_type, b"".join(buffered)):
+        remember_rendered_url(url, keys)
+
+
+_prewarm_urls = LocalLRUCache(PREWARM_URLS_SIZE)
+
+
+def remember_rendered_url(url, keys):
+    """
+    remember_rendered_url registers a url of a cached response depending on the given
+    inventory generation keys to be re-rendered by prewarm_rendered() after they change
+    """
+    _prewarm_urls.set(url, frozenset(keys))
+
+
+def prewarm_rendered(changed_keys):
+    """
+    prewarm_rendered re-renders the remembered responses depending on the changed
+    inventory generation keys in a background thread so their cache entries are
+    ready by the time clients request them
+    """
     from app import app
-    cache_key = _get_custom_data_cache_key(obj)
-    if app.cache.has(cache_key):
-        app.cache.delete(cache_key)
-        app.logger.debug("%s DELETE cache" % cache_key)
+    changed_keys = set(changed_keys)
+    urls = [url for url, keys in _prewarm_urls.items() if keys & changed_keys]
+    if len(urls) == 0:
+        return
+
+    def prewarm():
+        client = app.flask.test_client()
+        for url in urls:
+            try:
+                client.get(url)
+            except Exception as e:
+                app.logger.error("Error pre-warming %s: %s" % (url, e))
+
+    thread = Thread(target=prewarm, name="prewarm-rendered")
+    thread.daemon = True
+    thread.start()
@@ -42,6 +42,10 @@ class Conflict(ApiError):
     status_code = 409
 
 
+class DatabaseUnavailable(ApiError):
+    status_code = 503
+
+
 class IntegrityError(Conflict):
     pass
 
@@ -78,10 +82,22 @@ class ObjectSaveRequired(ApiError):
     pass
 
 
+class ReadOnlyObject(ApiError):
+    pass
+
+
 class FieldRequired(ApiError):
     pass
 
 
+class ObjectSaveFailed(Conflict):
+    pass
+
+
+class ConcurrentModification(Conflict):
+    pass
+
+
 class InvalidTags(IntegrityError):
     pass
 
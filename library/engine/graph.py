@@ -22,4 +22,110 @@ def group_structure(group, fields, host_fields):
     result["hosts"] = [x.to_dict(host_fields) for x in group.hosts]
     result["parents"] = _group_parents_recursive(group, fields, host_fields)["parents"]
     result["children"] = _group_children_recursive(group, fields, host_fields)["children"]
-    return result
\ No newline at end of file
+    return result
+
+
+def transitive_closure(parent_ids):
+    """
+    transitive_closure computes ancestors and descendants of every node of a DAG
+    given as a dict { node_id: [parent_id, ...] }. Parent ids missing in the dict
+    are ignored, cycles (which may exist only due to inconsistent data) are broken.
+
+    Returns a tuple (ancestors, descendants) of dicts { node_id: set(node_ids) }
+    """
+    ancestors = {}
+    in_progress = set()
+
+    for node_id in parent_ids:
+        if node_id in ancestors:
+            continue
+        stack = [node_id]
+        while len(stack) > 0:
+            current = stack[-1]
+            if current in ancestors:
+                stack.pop()
+                continue
+            in_progress.add(current)
+            pending = [x for x in parent_ids[current]
+                       if x in parent_ids and x not in ancestors and x not in in_progress]
+            if len(pending) > 0:
+                stack += pending
+                continue
+            current_ancestors = set()
+            for pid in parent_ids[current]:
+                # parents still in progress form a cycle and are skipped
+                if pid in ancestors:
+                    current_ancestors.add(pid)
+                    current_ancestors.update(ancestors[pid])
+            ancestors[current] = current_ancestors
+            in_progress.discard(current)
+            stack.pop()
+
+    descendants = dict([(x, set()) for x in parent_ids])
+    for node_id, node_ancestors in ancestors.iteritems():
+        for ancestor_id in node_ancestors:
+            descendants[ancestor_id].add(node_id)
+
+    return ancestors, descendants
+
+
+def postorder(child_ids):
+    """
+    postorder returns a list of nodes of a DAG given as a dict { node_id: [child_id, ...] }
+    ordered so that every node goes after all of its descendants, and a list of
+    (node_id, child_id) edges skipped as closing cycles. Child ids missing in the dict
+    are ignored. The traversal is iterative so the depth of the graph is not limited
+    """
+    order = []
+    done = set()
+    in_progress = set()
+    cycle_edges = []
+
+    for root_id in child_ids:
+        if root_id in done:
+            continue
+        in_progress.add(root_id)
+        stack = [(root_id, iter(child_ids[root_id]))]
+        while len(stack) > 0:
+            node_id, children = stack[-1]
+            for child_id in children:
+                if child_id not in child_ids or child_id in done:
+                    continue
+                if child_id in in_progress:
+                    cycle_edges.append((node_id, child_id))
+                    continue
+                in_progress.add(child_id)
+                stack.append((child_id, iter(child_ids[child_id])))
+                break
+            else:
+                stack.pop()
+                in_progress.discard(node_id)
+                done.add(node_id)
+                order.append(node_id)
+
+    return order, cycle_edges
+
+
+def descendant_items(child_ids, items):
+    """
+    descendant_items collects items (i.e. host ids) attached to every node of a DAG given as
+    a dict { node_id: [child_id, ...] } or to any of the node's descendants. items is a dict
+    { node_id: [item, ...] }. Nodes are processed once each, children first, so shared
+    subtrees are not recomputed. A node without items of its own and with a single child
+    gets the very set of the child, so the sets returned must not be modified.
+
+    Returns a tuple (result, cycle_edges) where result is a dict { node_id: set(items) }
+    and cycle_edges is a list of edges skipped as closing cycles, see postorder()
+    """
+    order, cycle_edges = postorder(child_ids)
+    result = {}
+    for node_id in order:
+        own = items.get(node_id) or ()
+        # children closing a cycle are still in progress and are not in the result yet
+        child_sets = [result[x] for x in child_ids[node_id] if x in result]
+        if len(own) == 0 and len(child_sets) == 1:
+            result[node_id] = child_sets[0]
+        else:
+            result[node_id] = set(own).union(*child_sets)
+    return result, cycle_edges
+
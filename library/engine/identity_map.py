@@ -0,0 +1,65 @@
+from flask import g, has_request_context
+
+
+def _get_map():
+    # the map lives as long as the request does
+    if not has_request_context():
+        return None
+    identity_map = getattr(g, "_identity_map", None)
+    if identity_map is None:
+        identity_map = g._identity_map = {}
+    return identity_map
+
+
+def get(collection, obj_id, read_only=False):
+    """
+    get returns the instance of the object loaded during the current request or None.
+    Read-only instances are not returned if a writable one is required, neither are
+    writable instances having unsaved changes as they don't reflect the stored object
+    """
+    identity_map = _get_map()
+    if identity_map is None:
+        return None
+    obj = identity_map.get((collection, obj_id))
+    if obj is None:
+        return None
+    if obj.is_read_only:
+        return obj if read_only else None
+    if obj.is_dirty:
+        return None
+    return obj
+
+
+def add(obj):
+    """
+    add registers a complete (loaded without a projection) saved instance
+    of an object to be returned by get() for the rest of the request
+    """
+    identity_map = _get_map()
+    if identity_map is None or obj.is_new:
+        return
+    key = (obj.collection, obj._id)
+    existing = identity_map.get(key)
+    if existing is not None and obj.is_read_only and not existing.is_read_only:
+        # writable instances serve read-only loads as well
+        return
+    identity_map[key] = obj
+
+
+def discard(collection, obj_id):
+    identity_map = _get_map()
+    if identity_map is not None:
+        identity_map.pop((collection, obj_id), None)
+
+
+def forget(collection):
+    """
+    forget removes all the instances of a collection, it's used after
+    writes changing documents without their instances, i.e. update_many
+    """
+    identity_map = _get_map()
+    if identity_map is None:
+        return
+    for key in identity_map.keys():
+        if key[0] == collection:
+            del identity_map[key]
@@ -0,0 +1,61 @@
+"""
+Prometheus metrics of the application.
+
+Under multi-process servers like uWSGI every worker keeps its own metrics so
+prometheus_multiproc_dir environment variable must point to an empty directory
+writable by all the workers. Values are stored there and aggregated on every
+/metrics request (see extconf/uwsgi/inventoree.ini)
+"""
+import os
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest
+from prometheus_client import multiprocess
+
+MULTIPROC_DIR_VARIABLES = ("prometheus_multiproc_dir", "PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_DURATION = Histogram(
+    "inventoree_http_request_duration_seconds",
+    "HTTP request latency",
+    ["blueprint", "endpoint", "method", "status"]
+)
+
+MONGO_COMMAND_DURATION = Histogram(
+    "inventoree_mongo_command_duration_seconds",
+    "MongoDB command latency",
+    ["collection", "command", "result"]
+)
+
+CACHE_REQUESTS = Counter(
+    "inventoree_cache_requests_total",
+    "Cache lookups",
+    ["cache", "result"]
+)
+
+API_ACTION_WRITE_DURATION = Histogram(
+    "inventoree_api_action_write_duration_seconds",
+    "ApiAction write latency"
+)
+
+
+def multiprocess_mode():
+    for variable in MULTIPROC_DIR_VARIABLES:
+        if os.environ.get(variable):
+            return True
+    return False
+
+
+def count_cache_request(cache, result):
+    CACHE_REQUESTS.labels(cache, result).inc()
+
+
+def render_metrics():
+    """
+    render_metrics returns a tuple (data, content_type) with all the metrics
+    in prometheus text format, aggregated over all the workers in multi-process mode
+    """
+    if multiprocess_mode():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
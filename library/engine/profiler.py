@@ -0,0 +1,223 @@
+"""
+Per-request mongo query profiler.
+
+A profile is started for a request if it's requested explicitly with X-Query-Profile header
+or _debug argument, or if the request is sampled according to QUERY_PROFILE_SAMPLE_RATE
+app configuration option. Every command sent to mongo during the request is recorded with
+its collection, query, duration and the call site it's been issued from.
+
+Repeated identical queries and queries of the same shape (different values only, the typical
+N+1 pattern) are reported in the summary which is logged for sampled requests and returned
+in X-Query-Profile header and _debug payload for requested ones.
+"""
+import os
+import sys
+from collections import OrderedDict
+from random import random
+from flask import g, request, has_app_context
+from bson import json_util
+from pymongo import monitoring
+
+PROFILE_HEADER = "X-Query-Profile"
+PROFILE_ARG = "_debug"
+
+# queries of the same shape issued this many times are reported as N+1
+SIMILAR_QUERIES_THRESHOLD = 3
+
+# frames from these files are skipped when looking for a call site
+SKIP_FILES = (
+    os.path.join("library", "db.py"),
+    os.path.join("library", "engine", "profiler.py"),
+    os.path.join("library", "engine", "cache.py"),
+    os.path.join("app", "models", "storable_model.py"),
+)
+PYMONGO_DIR = os.path.dirname(os.path.dirname(monitoring.__file__))
+
+
+def _source_file(filename):
+    if filename.endswith(".pyc"):
+        return filename[:-1]
+    return filename
+
+
+def _call_site():
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = _source_file(frame.f_code.co_filename)
+        if not filename.startswith(PYMONGO_DIR) and not filename.endswith(SKIP_FILES):
+            return "%s:%d %s" % (filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def _describe(command_name, command):
+    # only selectors are recorded, documents being written may contain sensitive data
+    if command_name == "find":
+        return OrderedDict([(k, command.get(k)) for k in ("filter", "projection", "sort") if k in command])
+    if command_name in ("count", "distinct", "findAndModify", "findandmodify"):
+        return command.get("query")
+    if command_name == "aggregate":
+        return command.get("pipeline")
+    if command_name == "update":
+        return [x.get("q") for x in command.get("updates", [])]
+    if command_name == "delete":
+        return [x.get("q") for x in command.get("deletes", [])]
+    if command_name == "insert":
+        return {"documents": len(command.get("documents", []))}
+    return None
+
+
+def _shape(value):
+    # replaces all the scalar values with placeholders keeping the structure of a query
+    if isinstance(value, dict):
+        return dict([(k, _shape(v)) for k, v in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return [_shape(x) for x in value[:1]]
+    return "?"
+
+
+class QueryProfile(object):
+
+    def __init__(self):
+        self.queries = []
+        self._in_progress = {}
+
+    def command_started(self, event):
+        command_name = event.command_name
+        if command_name == "getMore":
+            collection = event.command.get("collection")
+        else:
+            collection = event.command.get(command_name)
+        self._in_progress[(event.connection_id, event.request_id)] = {
+            "collection": collection if isinstance(collection, basestring) else None,
+            "command": command_name,
+            "query": _describe(command_name, event.command),
+            "call_site": _call_site(),
+        }
+
+    def command_finished(self, event, failed=False):
+        query = self._in_progress.pop((event.connection_id, event.request_id), None)
+        if query is None:
+            return
+        query["duration"] = event.duration_micros / 1e6
+        query["failed"] = failed
+        self.queries.append(query)
+
+    @property
+    def total_time(self):
+        return sum([x["duration"] for x in self.queries])
+
+    def _group(self, key_func, threshold):
+        groups = OrderedDict()
+        for query in self.queries:
+            if query["query"] is None:
+                continue
+            key = (query["collection"], query["command"], json_util.dumps(key_func(query["query"]), sort_keys=True))
+            groups.setdefault(key, []).append(query)
+        result = []
+        for (collection, command, query), items in groups.iteritems():
+            if len(items) < threshold:
+                continue
+            result.append({
+                "collection": collection,
+                "command": command,
+                "query": query,
+                "count": len(items),
+                "duration": sum([x["duration"] for x in items]),
+                "call_sites": sorted(set([x["call_site"] for x in items if x["call_site"] is not None])),
+            })
+        result.sort(key=lambda x: x["count"], reverse=True)
+        return result
+
+    @property
+    def repeated(self):
+        return self._group(lambda x: x, 2)
+
+    @property
+    def similar(self):
+        return self._group(_shape, SIMILAR_QUERIES_THRESHOLD)
+
+    def header(self):
+        return "queries=%d; time=%.3f; repeated=%d; similar=%d" % (
+            len(self.queries), self.total_time, len(self.repeated), len(self.similar))
+
+    def summary(self):
+        return {
+            "queries_count": len(self.queries),
+            "total_time": self.total_time,
+            "repeated": self.repeated,
+            "similar": self.similar,
+            "queries": [dict(x, query=json_util.dumps(x["query"], sort_keys=True)) for x in self.queries],
+        }
+
+
+def current_profile():
+    if not has_app_context():
+        return None
+    return getattr(g, "_query_profile", None)
+
+
+class QueryProfileListener(monitoring.CommandListener):
+    """
+    QueryProfileListener passes mongo commands to the profile of the current request if any
+    """
+
+    def started(self, event):
+        profile = current_profile()
+        if profile is not None:
+            profile.command_started(event)
+
+    def succeeded(self, event):
+        profile = current_profile()
+        if profile is not None:
+            profile.command_finished(event)
+
+    def failed(self, event):
+        profile = current_profile()
+        if profile is not None:
+            profile.command_finished(event, failed=True)
+
+
+query_profile_listener = QueryProfileListener()
+
+
+def profile_requested():
+    return PROFILE_HEADER in request.headers or PROFILE_ARG in request.values
+
+
+def start_request_profile(sample_rate):
+    g._query_profile_requested = profile_requested()
+    g._query_profile_sampled = sample_rate > 0 and random() < sample_rate
+    if g._query_profile_requested or g._query_profile_sampled:
+        g._query_profile = QueryProfile()
+
+
+def finish_request_profile(response, reveal):
+    """
+    finish_request_profile stops the profiling of the current request, logs the summary
+    of sampled requests and adds it to the response if it has been requested and reveal is True.
+    Streamed responses get the header only, the queries made while streaming are not profiled
+    """
+    from app import app
+    from flask import json
+    profile = current_profile()
+    if profile is None:
+        return response
+    g._query_profile = None
+
+    if g._query_profile_sampled:
+        app.logger.info("QueryProfile %s %s: %s" % (request.method, request.path, profile.header()))
+        for item in profile.repeated + profile.similar:
+            app.logger.info("QueryProfile %s %s: %d x %s.%s %s from %s" % (
+                request.method, request.path, item["count"], item["collection"], item["command"],
+                item["query"], ", ".join(item["call_sites"])))
+
+    if g._query_profile_requested and reveal:
+        response.headers[PROFILE_HEADER] = profile.header()
+        if PROFILE_ARG in request.values and response.mimetype == "application/json" \
+                and not response.is_streamed:
+            data = json.loads(response.get_data())
+            if isinstance(data, dict):
+                data[PROFILE_ARG] = profile.summary()
+                response.set_data(json.dumps(data))
+    return response
@@ -0,0 +1,116 @@
+import time
+from random import random
+from threading import Lock
+
+
+class CircuitBreaker(object):
+    """
+    CircuitBreaker stops calls to a failing resource to let callers fail fast.
+    It opens after failure_threshold consecutive failures. Once recovery_timeout
+    has passed a single probe call is let through: the breaker closes if it
+    succeeds and opens again otherwise.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=3, recovery_timeout=10.0, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    @property
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.recovery_timeout:
+                # let a single probe call through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        """
+        record_failure registers a failed call, returns True if the breaker has been opened by it
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+                return True
+            return False
+
+
+class RetryPolicy(object):
+    """
+    RetryPolicy retries calls failed with one of retryable exceptions with jittered
+    exponential backoff until max_attempts is reached or the next attempt would start
+    after the deadline. Calls are made through a circuit breaker and are not made at all
+    while it's open.
+    """
+
+    def __init__(self, retryable, max_attempts=4, base_delay=0.1, max_delay=2.0, timeout=5.0,
+                 sleep=time.sleep, clock=time.time, rand=random):
+        self.retryable = retryable
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.sleep = sleep
+        self.clock = clock
+        self.rand = rand
+
+    def delay(self, attempt):
+        # "full jitter": a random delay up to the exponentially growing cap
+        return min(self.max_delay, self.base_delay * 2 ** attempt) * self.rand()
+
+    def call(self, func, breaker, unavailable, deadline=None, on_open=None):
+        """
+        call runs func and returns its result. unavailable is an exception class raised
+        with a message if the call fails or is rejected by the breaker. deadline is an
+        absolute clock() value limiting the retries, timeout from now is used if it's None.
+        on_open is called with no arguments when the breaker opens due to this call
+        """
+        if deadline is None:
+            deadline = self.clock() + self.timeout
+        last_error = None
+        for attempt in range(self.max_attempts):
+            if not breaker.allow():
+                raise unavailable("circuit breaker is open after recent failures")
+            try:
+                result = func()
+            except self.retryable as e:
+                last_error = e
+                if breaker.record_failure() and on_open is not None:
+                    on_open()
+            except Exception:
+                # any other error means the resource is reachable
+                breaker.record_success()
+                raise
+            else:
+                breaker.record_success()
+                return result
+            if attempt == self.max_attempts - 1:
+                break
+            delay = self.delay(attempt)
+            if self.clock() + delay >= deadline:
+                break
+            self.sleep(delay)
+        raise unavailable("giving up after %d attempts: %s" % (attempt + 1, last_error))
@@ -1,22 +1,120 @@
-from flask import make_response, request, has_request_context, g
+from flask import make_response, request, has_request_context, g, Response
 from bson.objectid import ObjectId, InvalidId
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from uuid import uuid4
 from copy import deepcopy
+from hashlib import sha1
 import flask.json as json
 import os
 import math
 import functools
 
 DEFAULT_DOCUMENTS_PER_PAGE = 20
+STREAM_CHUNK_SIZE = 65536
+ANSIBLE_INVENTORY_HEADER = "# This ansible inventory file was rendered from inventoree database, %s\n" \
+                           "# For more info on inventoree please refer to https://github.com/viert/inventoree\n\n"
 
 
 class Diff(namedtuple('Diff', ('add', 'remove'))):
     pass
 
 
+class StreamedList(object):
+    """
+    StreamedList wraps an iterable (i.e. a cursor or a generator) to be
+    rendered lazily as a json array by json_response
+    """
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+
+class StreamedDict(object):
+    """
+    StreamedDict wraps an iterable of (key, value) pairs to be
+    rendered lazily as a json object by json_response
+    """
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+
+def has_streams(data):
+    # streams are looked for in dict values only
+    if isinstance(data, (StreamedList, StreamedDict)):
+        return True
+    if isinstance(data, dict):
+        for value in data.itervalues():
+            if has_streams(value):
+                return True
+    return False
+
+
+def iter_json(data):
+    """
+    iter_json yields json representation of data chunk by chunk. StreamedList
+    and StreamedDict values are iterated lazily, dicts containing them are
+    walked recursively, everything else is dumped at once
+    """
+    if isinstance(data, StreamedDict) or (isinstance(data, dict) and has_streams(data)):
+        pairs = data if isinstance(data, StreamedDict) else data.iteritems()
+        delimiter = "{"
+        for key, value in pairs:
+            yield delimiter + json.dumps(key) + ":"
+            for chunk in iter_json(value):
+                yield chunk
+            delimiter = ","
+        yield "{}" if delimiter == "{" else "}"
+    elif isinstance(data, StreamedList):
+        delimiter = "["
+        for item in data:
+            yield delimiter
+            for chunk in iter_json(item):
+                yield chunk
+            delimiter = ","
+        yield "[]" if delimiter == "[" else "]"
+    else:
+        yield json.dumps(data)
+
+
+def buffered(chunks, chunk_size=STREAM_CHUNK_SIZE):
+    # joins small chunks to avoid sending lots of tiny pieces to the client
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if len(buf) > 0:
+        yield "".join(buf)
+
+
+def json_stream_response(data, code=200):
+    from flask import Response, stream_with_context
+    return Response(stream_with_context(buffered(iter_json(data))), code, {'Content-Type': 'application/json'})
+
+
+def ndjson_response(items, code=200):
+    """
+    ndjson_response streams an iterable as newline delimited json, one item per line
+    """
+    from flask import Response, stream_with_context
+    lines = (json.dumps(x) + "\n" for x in items)
+    return Response(stream_with_context(buffered(lines)), code, {'Content-Type': 'application/x-ndjson'})
+
+
 def json_response(data, code=200):
     from app import app
+    if has_streams(data):
+        # streamed responses are never indented
+        return json_stream_response(data, code)
     json_kwargs = {}
     if app.config.log.get("DEBUG") or app.envtype == "development":
         json_kwargs["indent"] = 4
@@ -51,8 +149,16 @@ def resolve_id(id):
     return id
 
 
+def iter_dicts(crs, fields=None):
+    if fields is not None and hasattr(crs, "only"):
+        # fetch only what's going to be rendered along with the related objects
+        crs = crs.only(fields).prefetch(crs.obj_class.get_relations(fields))
+    for x in crs:
+        yield x.to_dict(fields)
+
+
 def cursor_to_list(crs, fields=None):
-    return [x.to_dict(fields) for x in crs]
+    return list(iter_dicts(crs, fields))
 
 
 def get_page():
@@ -122,13 +228,18 @@ def paginated_data(data, page=None, limit=None, fields=None, extra=None):
 
     if type(data) == list:
         count = len(data)
-        data = data[(page - 1) * limit:page * limit]
-        data = [x.to_dict(fields=fields) for x in data if isinstance(x, StorableModel)]
+        data = [x for x in data[(page - 1) * limit:page * limit] if isinstance(x, StorableModel)]
+        if len(data) > 0 and all([type(x) is type(data[0]) for x in data]):
+            type(data[0]).prefetch(data, data[0].get_relations(fields))
+        data = [x.to_dict(fields=fields) for x in data]
     elif hasattr(data, "count"):
         count = data.count()
         if limit is not None and page is not None:
             data = data.skip((page-1)*limit).limit(limit)
-        data = cursor_to_list(data, fields=fields)
+            data = cursor_to_list(data, fields=fields)
+        else:
+            # unpaged data is streamed to the client by json_response
+            data = StreamedList(iter_dicts(data, fields=fields))
     else:
         raise RuntimeError("paginated_data accepts either cursor objects or lists")
 
@@ -169,6 +280,7 @@ def full_group_structure(work_group_ids=None, group_fields=None, host_fields=Non
     from datetime import datetime
     from app.models import Group, Host
     from app import app
+    from library.engine.graph import descendant_items
 
     t1 = datetime.now()
     query = {}
@@ -179,38 +291,37 @@ def full_group_structure(work_group_ids=None, group_fields=None, host_fields=Non
         work_group_ids = [resolve_id(x) for x in work_group_ids]
         query["work_group_id"] = {"$in": work_group_ids}
 
-    groups = Group.find(query)
+    groups = Group.find(query, read_only=True, fields=group_fields)
     groups_index = {}
     group_ids = []
     for group in groups:
         group_ids.append(group._id)
         groups_index[str(group._id)] = group.to_dict(fields=group_fields)
     groups = groups_index
-    hosts = Host.find({"group_id": {"$in": group_ids}})
+    hosts = Host.find({"group_id": {"$in": group_ids}}, read_only=True, fields=host_fields)
     hosts = dict([(str(host._id), host.to_dict(fields=host_fields)) for host in hosts])
 
     for group in groups.values():
         group["children"] = {}
         for child_id in group["child_ids"]:
-            group["children"][str(child_id)] = groups[str(child_id)]
+            if str(child_id) in groups:
+                group["children"][str(child_id)] = groups[str(child_id)]
         group["hosts"] = {}
-        group["all_hosts"] = {}
 
     for host_id, host in hosts.items():
         if str(host["group_id"]) in groups:
             groups[str(host["group_id"])]["hosts"][host_id] = host
 
-    def get_all_hosts(group):
-        hosts = {}
-        for k, v in group["hosts"].items():
-            hosts[k] = v
-        for child in group["children"].values():
-            for k, v in get_all_hosts(child).items():
-                hosts[k] = v
-        return hosts
-
-    for group in groups.values():
-        group["all_hosts"] = get_all_hosts(group)
+    # hosts of every group are collected once in a single pass over the groups ordered
+    # children first, so shared subtrees of diamond-shaped hierarchies are not recomputed
+    child_ids = dict([(group_id, group["children"].keys()) for group_id, group in groups.iteritems()])
+    group_host_ids = dict([(group_id, group["hosts"].keys()) for group_id, group in groups.iteritems()])
+    all_host_ids, cycle_edges = descendant_items(child_ids, group_host_ids)
+    if len(cycle_edges) > 0:
+        app.logger.error("full_group_structure: group hierarchy has cycles, links %s ignored" %
+                         ", ".join(["%s->%s" % x for x in cycle_edges]))
+    for group_id, group in groups.iteritems():
+        group["all_hosts"] = dict([(x, hosts[x]) for x in all_host_ids[group_id]])
 
     t2 = datetime.now()
     app.logger.debug("full_group_structure complete in %.3f seconds", (t2-t1).total_seconds())
@@ -226,25 +337,74 @@ def ansible_group_structure(work_group_ids=None, include_vars=True):
         work_group_ids = [resolve_id(x) for x in work_group_ids]
         query["work_group_id"] = { "$in": work_group_ids }
 
-    groups = Group.find(query).all()
-    hosts = Host.find({"group_id": {"$in": [x._id for x in groups]}}).all()
+    groups = Group.find(query, fields=["name", "child_ids"]).all()
+    group_ids = [x._id for x in groups]
+    hosts = Host.find({"group_id": {"$in": group_ids}}, fields=["fqdn", "group_id"])
     result = {}
 
+    group_names = dict([(x._id, x.name) for x in groups])
+    group_hosts = defaultdict(list)
+    all_hosts = []
+    for host in hosts:
+        group_hosts[host.group_id].append(host.fqdn)
+        all_hosts.append(host.fqdn)
+
     for group in groups:
         result[group.name] = {
-            "hosts": [x.fqdn for x in group.hosts],
-            "children": [x.name for x in group.children]
+            "hosts": group_hosts[group._id],
+            "children": [group_names[x] for x in group.child_ids if x in group_names]
         }
-    result["all"] = {"children": ["ungrouped"], "hosts": [x.fqdn for x in hosts]}
+    result["all"] = {"children": ["ungrouped"], "hosts": all_hosts}
     result["ungrouped"] = {}
     if include_vars:
-        result["_meta"] = {"hostvars": {}}
-        for host in hosts:
-            if host.ansible_vars:
-                result["_meta"]["hostvars"][host.fqdn] = host.ansible_vars
+        # host variables make the bulk of the output so they are streamed
+        # from a separate cursor rather than kept in memory
+        def hostvars():
+            hosts = Host.find({"group_id": {"$in": group_ids}}, fields=["fqdn", "ansible_vars"])
+            for host in hosts:
+                if host.ansible_vars:
+                    yield host.fqdn, host.ansible_vars
+        result["_meta"] = {"hostvars": StreamedDict(hostvars())}
     return result
 
 
+def iter_ansible_inventory(work_group_ids, include_vars=False):
+    """
+    iter_ansible_inventory yields a plain text ansible inventory one group section
+    at a time. Hosts of all the groups are fetched with a single query sorted by fqdn,
+    each host line is rendered once and sections merge the lines of a group and its
+    descendants
+    """
+    from datetime import datetime
+    from heapq import merge as merge_sorted
+    from app.models import Group, Host
+
+    yield ANSIBLE_INVENTORY_HEADER % datetime.now().isoformat()
+
+    groups = Group.find({"work_group_id": {"$in": work_group_ids}}, fields=["name", "descendant_ids"]).all()
+    host_fields = ["fqdn", "group_id", "ansible_vars"] if include_vars else ["fqdn", "group_id"]
+    hosts = Host.find({"group_id": {"$in": [x._id for x in groups]}}, fields=host_fields)
+    group_lines = defaultdict(list)
+    for host in hosts.sort("fqdn"):
+        line = host.fqdn
+        if include_vars:
+            ansible_vars = host.ansible_vars
+            if ansible_vars is not None:
+                for key, value in ansible_vars.iteritems():
+                    line += " %s=%s" % (key, value)
+        # lines start with fqdn so they stay sorted by it
+        group_lines[host.group_id].append(line + "\n")
+
+    for group in sorted(groups, key=lambda x: x.name):
+        lines = list(merge_sorted(*[group_lines[x] for x in [group._id] + group.descendant_ids
+                                    if x in group_lines]))
+        if len(lines) > 0:
+            yield "[%s]\n" % group.name
+            yield "".join(lines)
+            if not include_vars:
+                yield "\n\n"
+
+
 def get_app_version():
     from app import app
 
@@ -269,6 +429,67 @@ def json_body_required(func):
     return wrapper
 
 
+def inventory_conditional(get_keys, cached=False, get_headers=None):
+    """
+    inventory_conditional decorator makes an inventory endpoint emit ETag and Last-Modified
+    headers built from generations of the inventory parts get_keys() returns for the current
+    request (see InventoryGeneration) and answer conditional requests with 304 without
+    reading the inventory itself.
+
+    Responses of endpoints with cached set (either a bool or a function of no arguments
+    deciding for the current request) are kept in app.render_cache under the same key, so
+    they are rendered once per inventory change. Such endpoints must not depend on the
+    current user. Cached responses are rendered reading from the primary as they're shared,
+    bodies are cached while they're streamed to the client (see cache_rendered).
+
+    Headers get_headers() returns, if given, are computed before the response and added
+    to it whether it's cached or not, per-request values must be passed this way
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            from werkzeug.http import is_resource_modified
+            from app.models import InventoryGeneration
+            from library.db import db
+            from library.engine.cache import get_rendered, cache_rendered
+            use_cache = cached() if callable(cached) else cached
+            headers = get_headers() if get_headers is not None else {}
+            keys = get_keys()
+            generations, last_modified = InventoryGeneration.get_state(keys)
+            user = getattr(g, "user", None)
+            etag = sha1(repr((
+                request.endpoint,
+                sorted(kwargs.items()),
+                sorted(request.args.items(multi=True)),
+                user._id if user is not None and not use_cache else None,
+                generations,
+            ))).hexdigest()
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = Response(status=304)
+            else:
+                rendered = get_rendered(etag) if use_cache else None
+                if rendered is not None:
+                    content_type, body = rendered
+                    response = Response(body, 200, content_type=content_type)
+                else:
+                    if use_cache:
+                        # data read from a lagging secondary would be cached as the current one
+                        db.pin_primary()
+                    response = func(*args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    if use_cache:
+                        response.response = cache_rendered(response.iter_encoded(), etag, response.content_type,
+                                                           request.full_path, keys)
+            response.headers.extend(headers)
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
+
+
 def filter_query(flt):
     from app import app
     try:
@@ -340,6 +561,29 @@ def merge(dict1, dict2):
     return dict1
 
 
+def merge_tags(*tag_lists):
+    """
+    merge_tags returns a sorted union of all the tag lists given
+    """
+    tags = set()
+    for tag_list in tag_lists:
+        tags.update(tag_list)
+    return sorted(tags)
+
+
+def merge_custom_fields(*cf_lists):
+    """
+    merge_custom_fields merges lists of custom fields overriding values of former
+    lists with the values of latter ones in case of key conflicts.
+    The result is sorted by key
+    """
+    cf_dict = {}
+    for cf_list in cf_lists:
+        for cf in cf_list:
+            cf_dict[cf["key"]] = cf["value"]
+    return [{"key": k, "value": cf_dict[k]} for k in sorted(cf_dict)]
+
+
 def check_dicts_are_equal(dict1, dict2):
     if dict1 == dict2:
         # the same object
@@ -3,42 +3,83 @@ from datetime import datetime, timedelta
 from flask.sessions import SessionInterface, SessionMixin
 from werkzeug.datastructures import CallbackDict
 
+# default for SESSION_REFRESH_INTERVAL, unchanged sessions are written to slide
+# their expiration forward once this number of seconds has passed since the last write.
+# The interval is capped by half of the session lifetime so active sessions never expire
+DEFAULT_SESSION_REFRESH_INTERVAL = 86400
+
+
+def token_authenticated(request):
+    # requests bearing a token never use the session, see AuthController
+    if "X-Api-Auth-Token" in request.headers:
+        return True
+    auth = request.headers.get("Authorization", "").split()
+    return len(auth) == 2 and auth[0] == "Token"
+
 
 class MongoSession(CallbackDict, SessionMixin):
-    def __init__(self, initial=None, sid=None):
-        CallbackDict.__init__(self, initial)
+    def __init__(self, initial=None, sid=None, expiration=None, persistent=True, has_cookie=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
         self.sid = sid
+        # expiration time stored, None for sessions which have never been written
+        self.expiration = expiration
+        # sessions of token-authenticated requests are neither loaded nor written
+        self.persistent = persistent
+        # the request has come with a session cookie, possibly an outdated one
+        self.has_cookie = has_cookie
         self.modified = False
 
+    @property
+    def permanent(self):
+        # all the sessions expire after permanent_session_lifetime
+        return True
+
+    @permanent.setter
+    def permanent(self, value):
+        pass
+
 
 class MongoSessionInterface(SessionInterface):
-    def __init__(self, collection_name='sessions'):
+    def __init__(self, collection_name='sessions', refresh_interval=DEFAULT_SESSION_REFRESH_INTERVAL):
         self.collection_name = collection_name
+        self.refresh_interval = timedelta(seconds=refresh_interval)
 
     def open_session(self, app, request):
         from library.db import db
+        if token_authenticated(request):
+            return MongoSession(persistent=False)
         sid = request.cookies.get(app.session_cookie_name)
         if sid:
             stored_session = db.get_session(sid, collection=self.collection_name)
             if stored_session:
                 if stored_session.get('expiration') > datetime.utcnow():
-                    return MongoSession(initial=stored_session['data'], sid=stored_session['sid'])
-        else:
-            sid = str(uuid4())
-        return MongoSession(sid=sid)
+                    return MongoSession(initial=stored_session['data'], sid=stored_session['sid'],
+                                        expiration=stored_session['expiration'], has_cookie=True)
+            return MongoSession(sid=sid, has_cookie=True)
+        return MongoSession(sid=str(uuid4()))
 
     def save_session(self, app, session, response):
         from library.db import db
+        if not session.persistent:
+            return
         domain = self.get_cookie_domain(app)
         if not session:
-            response.delete_cookie(app.session_cookie_name, domain=domain)
+            if session.modified and session.expiration is not None:
+                # i.e. logout, the stored session must not be valid anymore
+                db.delete_session(session.sid, collection=self.collection_name)
+            if session.modified or session.has_cookie:
+                # expired or unknown cookies are removed too
+                response.delete_cookie(app.session_cookie_name, domain=domain)
             return
 
-        if session.modified:
-            expiration = self.get_expiration_time(app, session)
-            if not expiration:
-                expiration = datetime.utcnow() + timedelta(hours=1)
-            db.update_session(session.sid, session, expiration, collection=self.collection_name)
-            response.set_cookie(app.session_cookie_name, session.sid,
-                                expires=self.get_expiration_time(app, session),
-                                httponly=True, domain=domain)
+        expiration = self.get_expiration_time(app, session)
+        if not session.modified:
+            # unchanged sessions are written only to keep them from expiring
+            refresh_interval = min(self.refresh_interval, app.permanent_session_lifetime // 2)
+            if session.expiration is None or session.expiration + refresh_interval > expiration:
+                return
+        db.update_session(session.sid, session, expiration, collection=self.collection_name)
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=expiration, httponly=True, domain=domain)